@@ -0,0 +1,63 @@
+"""
+Concurrent throughput of the chat completion call, blocking vs async.
+
+"before" awaits coroutines that call the blocking `answer_to_prompt` (what the
+`/agents/chat-agent` route used to do), "after" uses `aanswer_to_prompt`.
+Both run against the local fake completion server.
+
+    python benchmarks/bench_async_chat.py --requests 200 --concurrency 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+import openai
+
+from agentsfwrk import integrations, providers
+from fake_llm_server import serve_in_thread
+
+def new_service():
+    service = integrations.OpenAIIntegrationService(
+        context = {"role": "system", "content": "You are a benchmark agent."},
+        instruction = {"role": "user", "content": "Answer in JSON."}
+    )
+    service.add_chat_history(messages = [{"role": "assistant", "content": "Hi!"}])
+    return service
+
+async def blocking_call():
+    return new_service().answer_to_prompt(model = "gpt-3.5-turbo", prompt = "Hello", max_tokens = 100)
+
+async def async_call():
+    return await new_service().aanswer_to_prompt(model = "gpt-3.5-turbo", prompt = "Hello", max_tokens = 100)
+
+async def run(call, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await call()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    await providers.close_aiosession()
+
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type = int, default = 200)
+    parser.add_argument("--concurrency", type = int, default = 50)
+    parser.add_argument("--latency", type = float, default = 0.2)
+    parser.add_argument("--port", type = int, default = 8100)
+    args = parser.parse_args()
+
+    with serve_in_thread(port = args.port, latency = args.latency) as api_base:
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or "fake-key"
+        for name, call in (("before (blocking)", blocking_call), ("after (async)", async_call)):
+            elapsed = asyncio.run(run(call, args.requests, args.concurrency))
+            print(f"{name:20s} {args.requests} requests in {elapsed:.2f}s -> {args.requests / elapsed:.1f} req/s")
+
+if __name__ == "__main__":
+    main()
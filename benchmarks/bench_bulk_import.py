@@ -0,0 +1,79 @@
+"""
+Import throughput of historical messages: one `create_conversation_message` (and
+commit) per row, what a replay through the API amounted to, vs the bulk insert of
+`agents.crud`, and the bulk endpoint with a JSON or NDJSON body.
+
+    python benchmarks/bench_bulk_import.py --rows 50000
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+
+from agents import crud
+from agents.api.schemas import AgentCreate, ConversationCreate, MessageCreate
+from agents.database import SessionLocal
+from agents.main import app
+from agentsfwrk.logger import setup_applevel_logger
+
+def make_messages(rows: int, conversation_id: str) -> list:
+    return [
+        {
+            "conversation_id": conversation_id,
+            "user_message": f"Question {i}: " + "tell me more. " * 10,
+            "agent_message": f"Answer {i}: " + "here is more. " * 20,
+        }
+        for i in range(rows)
+    ]
+
+def report(name: str, rows: int, elapsed: float):
+    print(f"{name:24s} {rows:7d} rows in {elapsed:7.2f}s -> {rows / elapsed:9.0f} rows/s")
+
+async def main(rows: int, single_rows: int):
+    setup_applevel_logger(level = "WARNING", async_mode = False)
+    db = SessionLocal()
+    agent = crud.create_agent(db, AgentCreate(
+        context = "You are a benchmark agent.", first_message = "Hi!",
+        response_shape = '{"answer": "string"}', instructions = "Answer."
+    ))
+    conversation_id = crud.create_conversation(db, ConversationCreate(agent_id = agent.id)).id
+
+    # One row at a time is slow, it runs on fewer rows.
+    start = time.perf_counter()
+    for mes in make_messages(single_rows, conversation_id):
+        crud.create_conversation_message(db, MessageCreate(**mes), conversation_id)
+    report("one commit per row", single_rows, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    crud.create_messages(db, crud.message_rows([MessageCreate(**mes) for mes in make_messages(rows, conversation_id)], conversation_id))
+    report("crud bulk insert", rows, time.perf_counter() - start)
+    db.close()
+
+    await app.router.startup()
+    async with httpx.AsyncClient(app = app, base_url = "http://bench", timeout = 300) as client:
+        messages = make_messages(rows, conversation_id)
+        for name, content, content_type in (
+            ("endpoint JSON", json.dumps(messages), "application/json"),
+            ("endpoint NDJSON", "\n".join(json.dumps(mes) for mes in messages), "application/x-ndjson"),
+        ):
+            start = time.perf_counter()
+            response = await client.post(
+                "/agents/bulk/create-messages", content = content, headers = {"content-type": content_type}
+            )
+            response.raise_for_status()
+            report(name, response.json()["count"], time.perf_counter() - start)
+    await app.router.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type = int, default = 50000)
+    parser.add_argument("--single-rows", type = int, default = 2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.single_rows))
@@ -0,0 +1,74 @@
+"""
+Memory and throughput of extracting the messages of an agent: loaded at once through
+the ORM and serialized with the `Message` schema (what `/get-messages` does per
+conversation) vs the streaming export, as NDJSON and Parquet. The peak memory is the one
+allocated by Python while the rows are encoded (tracemalloc), the bytes are discarded.
+
+    python benchmarks/bench_export.py --conversations 20 --messages 5000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from agents import crud, export, models
+from agents.api.schemas import AgentCreate, ConversationImport, Message
+from agents.database import SessionLocal, engine
+from agentsfwrk.logger import setup_applevel_logger
+
+def setup(conversations: int, messages: int) -> tuple:
+    models.Base.metadata.create_all(bind = engine)
+    db = SessionLocal()
+    agent = crud.create_agent(db, AgentCreate(
+        context = "You are a benchmark agent.", first_message = "Hi!",
+        response_shape = '{"answer": "string"}', instructions = "Answer."
+    ))
+    agent_id = agent.id
+    transcript = [
+        {"user_message": f"Question {i}: " + "tell me more. " * 10, "agent_message": f"Answer {i}: " + "here is more. " * 20}
+        for i in range(messages)
+    ]
+    ids = crud.create_conversations(db, [ConversationImport(agent_id = agent_id, messages = transcript) for _ in range(conversations)])
+    db.close()
+    return agent_id, ids
+
+def load_all(agent_id: str, chunk_size: int) -> int:
+    db = SessionLocal()
+    messages = db.query(models.Message).join(models.Conversation).filter(models.Conversation.agent_id == agent_id).all()
+    data = "\n".join(Message.from_orm(mes).json() for mes in messages).encode()
+    db.close()
+    return len(data)
+
+def stream(agent_id: str, chunk_size: int, format: str) -> int:
+    chunks = export.export_chunks("messages", agent_id = agent_id, chunk_size = chunk_size)
+    return sum(len(data) for data in export.encode_chunks("messages", chunks, format))
+
+def main(conversations: int, messages: int, chunk_size: int):
+    setup_applevel_logger(level = "WARNING", async_mode = False)
+    agent_id, _ = setup(conversations, messages)
+    rows = conversations * messages
+
+    for name, run in (
+        ("load at once", lambda: load_all(agent_id, chunk_size)),
+        ("export NDJSON", lambda: stream(agent_id, chunk_size, "ndjson")),
+        ("export Parquet", lambda: stream(agent_id, chunk_size, "parquet")),
+    ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        size = run()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:15s} {rows:8d} rows in {elapsed:6.2f}s -> {rows / elapsed:8.0f} rows/s, {size / 1e6:7.1f} MB, peak memory {peak / 1e6:7.1f} MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type = int, default = 20)
+    parser.add_argument("--messages", type = int, default = 5000)
+    parser.add_argument("--chunk-size", type = int, default = export.EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+    main(args.conversations, args.messages, args.chunk_size)
@@ -0,0 +1,90 @@
+"""
+Query count and latency of `/agents/get-agents` with many agents.
+
+Counts the SQL statements per request through the SQLAlchemy `before_cursor_execute`
+event and fails if the listing issues more queries than: one for the agents, one for
+the conversation counts and one per 500 agents for the conversations (`selectinload`
+batches), i.e. no query per agent.
+
+    python benchmarks/bench_get_agents.py --agents 2000 --conversations 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import agents.models
+from agents.api.routes import get_db
+from agents.main import app
+
+SELECTIN_BATCH = 500
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type = int, default = 2000)
+    parser.add_argument("--conversations", type = int, default = 3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}", connect_args = {"check_same_thread": False})
+        agents.models.Base.metadata.create_all(bind = engine)
+        SessionBench = sessionmaker(bind = engine)
+
+        db = SessionBench()
+        agent_rows = [
+            {"id": str(uuid.uuid4()), "context": "c", "first_message": "hi", "response_shape": "{}", "instructions": "i"}
+            for _ in range(args.agents)
+        ]
+        db.execute(agents.models.Agent.__table__.insert(), agent_rows)
+        db.execute(agents.models.Conversation.__table__.insert(), [
+            {"id": str(uuid.uuid4()), "agent_id": row["id"]}
+            for row in agent_rows for _ in range(args.conversations)
+        ])
+        db.commit()
+        db.close()
+
+        def get_bench_db():
+            db = SessionBench()
+            try:
+                yield db
+            finally:
+                db.close()
+        app.dependency_overrides[get_db] = get_bench_db
+
+        queries = []
+        event.listen(engine, "before_cursor_execute", lambda *_: queries.append(1))
+
+        failed = False
+        with TestClient(app) as client:
+            for params in (
+                {"limit": 1000},
+                {"limit": 1000, "include_conversations": False},
+                {"limit": 100, "skip": 500},
+            ):
+                queries.clear()
+                start = time.perf_counter()
+                response = client.get("/agents/get-agents", params = params)
+                elapsed = time.perf_counter() - start
+                response.raise_for_status()
+                returned = len(response.json())
+                print(f"{str(params):50s} {returned:5d} agents {len(queries):3d} queries {elapsed * 1000:8.1f} ms")
+
+                max_queries = 2
+                if params.get("include_conversations", True):
+                    max_queries += -(-returned // SELECTIN_BATCH)
+                failed = failed or len(queries) > max_queries
+
+        app.dependency_overrides.clear()
+
+    if failed:
+        print("FAIL: the listing issued queries per agent")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Message retrieval on a long conversation: loading every message and sorting it
+in Python (what each chat turn used to do) vs the indexed, ordered keyset queries.
+
+    python benchmarks/bench_get_messages.py --messages 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import agents.crud
+import agents.models
+
+def seed(db, messages: int):
+    agent_id, conversation_id = str(uuid.uuid4()), str(uuid.uuid4())
+    db.execute(agents.models.Agent.__table__.insert(), [{
+        "id": agent_id, "context": "c", "first_message": "hi", "response_shape": "{}", "instructions": "i"
+    }])
+    db.execute(agents.models.Conversation.__table__.insert(), [{"id": conversation_id, "agent_id": agent_id}])
+    start = datetime.utcnow() - timedelta(seconds = messages)
+    db.execute(agents.models.Message.__table__.insert(), [
+        {
+            "id": str(uuid.uuid4()),
+            "timestamp": start + timedelta(seconds = i),
+            "user_message": f"user message {i}",
+            "agent_message": f"agent message {i}",
+            "conversation_id": conversation_id
+        }
+        for i in range(messages)
+    ])
+    db.commit()
+
+    return conversation_id
+
+def timed(name: str, fn, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:45s} {elapsed * 1000:10.2f} ms  ({len(result)} rows)")
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type = int, default = 100_000)
+    parser.add_argument("--page", type = int, default = 20)
+    parser.add_argument("--repeat", type = int, default = 20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        agents.models.Base.metadata.create_all(bind = engine)
+        db = sessionmaker(bind = engine)()
+
+        conversation_id = seed(db, args.messages)
+        print(f"Seeded a conversation with {args.messages} messages")
+
+        def load_all_and_sort():
+            db.expunge_all()
+            messages = agents.crud.get_conversation(db, conversation_id).messages
+            messages.sort(key = lambda x: x.timestamp)
+            return messages
+
+        def tail():
+            db.expunge_all()
+            return agents.crud.get_messages(db, conversation_id, limit = args.page)
+
+        timed("before: lazy load all + sort", load_all_and_sort, max(1, args.repeat // 10))
+        page = timed("after: tail page", tail, args.repeat)
+        previous = timed("after: previous page (before cursor)",
+                         lambda: agents.crud.get_messages(db, conversation_id, before = page[0].id, limit = args.page), args.repeat)
+        timed("after: next page (after cursor)",
+              lambda: agents.crud.get_messages(db, conversation_id, after = previous[0].id, limit = args.page), args.repeat)
+
+        plan = db.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM messages WHERE conversation_id = :c "
+            "ORDER BY timestamp DESC, id DESC LIMIT 20"
+        ), {"c": conversation_id}).all()
+        print("Tail query plan:", "; ".join(row[-1] for row in plan))
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Throughput and latency of the job queue (`agents.jobs`): jobs enqueued at once, then run
+by workers sharing the table (as the app and `python -m agents.jobs` would), each
+handler taking `--job-time` seconds like a completion. Every job must run exactly once.
+
+    python benchmarks/bench_jobs.py --jobs 2000 --workers 2 --concurrency 16
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections import Counter
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from agents import models
+from agents.database import dispose_engines, engine
+from agents.jobs import JobQueue
+
+async def main(jobs: int, workers: int, concurrency: int, job_time: float):
+    models.Base.metadata.create_all(bind = engine)
+    runs = Counter()
+    queues = [JobQueue(concurrency = concurrency, poll_interval = 0.05, max_queued = jobs) for _ in range(workers)]
+    for queue in queues:
+        @queue.handler("bench")
+        async def run(payload: dict):
+            runs[payload["n"]] += 1
+            await asyncio.sleep(job_time)
+
+    start = time.perf_counter()
+    for n in range(jobs):
+        await queues[0].enqueue("bench", {"n": n}, key = f"bench-{n}")
+    enqueued = time.perf_counter() - start
+    print(f"enqueued {jobs} jobs in {enqueued:.2f}s ({jobs / enqueued:.0f} jobs/s)")
+
+    start = time.perf_counter()
+    for queue in queues:
+        await queue.start()
+    while len(runs) < jobs:
+        await asyncio.sleep(0.05)
+    # Let the last outcomes be saved.
+    while any(queue.running_count for queue in queues):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for queue in queues:
+        await queue.stop()
+
+    status = await queues[0].status(sample = jobs)
+    latency = status["latency"]["bench"]
+    print(
+        f"ran {jobs} jobs in {elapsed:.2f}s ({jobs / elapsed:.0f} jobs/s, {workers} workers x {concurrency}), "
+        f"runs per job: {sorted(set(runs.values()))}, "
+        f"wait p50 {latency['wait_p50']:.2f}s p95 {latency['wait_p95']:.2f}s, run p50 {latency['run_p50'] * 1e3:.0f} ms"
+    )
+    await dispose_engines()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type = int, default = 2000)
+    parser.add_argument("--workers", type = int, default = 2)
+    parser.add_argument("--concurrency", type = int, default = 16)
+    parser.add_argument("--job-time", type = float, default = 0.05)
+    args = parser.parse_args()
+    asyncio.run(main(args.jobs, args.workers, args.concurrency, args.job_time))
@@ -0,0 +1,91 @@
+"""
+Latency of the chat route with the different logging modes: synchronous handlers
+(what the app used to do), queued to a listener thread (text or JSON), sampled,
+and logging off. The app runs in-process with the fake provider, the logs go to
+files in a temporary folder.
+
+    python benchmarks/bench_logging.py --requests 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+TMP = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(TMP, 'bench.db')}")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+# The client-side limiter would pace the requests, the fake provider has no quota.
+os.environ.setdefault("LLM_RPM", "1000000")
+os.environ.setdefault("LLM_TPM", "1000000000")
+
+import httpx
+
+from agents.database import Base, engine
+from agents.main import app
+from agentsfwrk.logger import setup_applevel_logger, stop_logging
+
+MODES = {
+    "sync text": {"async_mode": False},
+    "async text": {"async_mode": True},
+    "async json": {"async_mode": True, "fmt": "json"},
+    "async json 10%": {"async_mode": True, "fmt": "json", "sample_rate": 0.1},
+    "off": {"level": "CRITICAL"},
+}
+
+async def run(client: httpx.AsyncClient, conversation_ids: list, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/agents/chat-agent", json = {
+                "conversation_id": conversation_ids[i % len(conversation_ids)],
+                "message": f"Hello number {i}, " + "tell me more. " * 20,
+            })
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return latencies, elapsed
+
+async def main(requests: int, concurrency: int):
+    Base.metadata.create_all(bind = engine)
+    await app.router.startup()
+    async with httpx.AsyncClient(app = app, base_url = "http://bench") as client:
+        agent = (await client.post("/agents/create-agent", json = {
+            "context": "You are a benchmark agent.", "first_message": "Hi!",
+            "response_shape": '{"answer": "string"}', "instructions": "Answer.",
+        })).json()
+        # New conversations per mode, so the histories are the same length for all.
+        conversations = {
+            name: [
+                (await client.post("/agents/create-conversation", json = {"agent_id": agent["id"]})).json()["id"]
+                for _ in range(concurrency)
+            ]
+            for name in MODES
+        }
+
+        for name, settings in MODES.items():
+            conversation_ids = conversations[name]
+            with open(os.path.join(TMP, f"{name}.out"), "w") as stream:
+                setup_applevel_logger(file_name = os.path.join(TMP, f"{name}.log"), stream = stream, **settings)
+                await run(client, conversation_ids, concurrency, concurrency)  # warm up
+                latencies, elapsed = await run(client, conversation_ids, requests, concurrency)
+                stop_logging()
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000
+            size = os.path.getsize(os.path.join(TMP, f"{name}.log")) / 1e6
+            print(f"{name:16s} p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  {requests / elapsed:7.1f} req/s  log {size:6.2f} MB")
+    await app.router.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type = int, default = 500)
+    parser.add_argument("--concurrency", type = int, default = 20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,103 @@
+"""
+Recall and latency of the message memory (`agents.memory`) on a synthetic corpus:
+messages of random words (Zipf distributed), spread over agents and conversations.
+Each query is a few content words of a message (not among the most frequent ones, like
+stop words) plus noise words, it is recalled when that message is in the top k. The searches run over all the messages, those of an agent, and
+those of a conversation.
+
+    python benchmarks/bench_memory.py --messages 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import numpy as np
+
+from agents.memory import MessageMemory
+from agentsfwrk.embeddings import HashingEmbedder
+
+def make_corpus(messages: int, agents: int, conversation_size: int, vocabulary: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    words = np.array([f"word{i}" for i in range(vocabulary)])
+    weights = 1 / np.arange(1, vocabulary + 1)
+    weights /= weights.sum()
+    for start in range(0, messages, 10000):
+        count = min(10000, messages - start)
+        user = words[rng.choice(vocabulary, size = (count, 12), p = weights)]
+        agent = words[rng.choice(vocabulary, size = (count, 25), p = weights)]
+        for i in range(count):
+            index = start + i
+            conversation = index // conversation_size
+            yield {
+                "id": f"message-{index}",
+                "conversation_id": f"conversation-{conversation}",
+                "agent_id": f"agent-{conversation % agents}",
+                "user_message": " ".join(user[i]),
+                "agent_message": " ".join(agent[i]),
+            }
+
+def percentile(values: list, fraction: float) -> float:
+    return sorted(values)[int(len(values) * fraction)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type = int, default = 1000000)
+    parser.add_argument("--agents", type = int, default = 100)
+    parser.add_argument("--conversation-size", type = int, default = 100)
+    parser.add_argument("--vocabulary", type = int, default = 50000)
+    parser.add_argument("--queries", type = int, default = 500)
+    parser.add_argument("--query-words", type = int, default = 4)
+    parser.add_argument("--common-words", type = int, default = 200, help = "Most frequent words, never in the queries")
+    parser.add_argument("--noise-words", type = int, default = 2)
+    parser.add_argument("--top-k", type = int, default = 4)
+    parser.add_argument("--dim", type = int, default = 256)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "memory_index")
+    memory = MessageMemory(path = path, scope = "agent", top_k = args.top_k, min_score = 0, embedder = HashingEmbedder(args.dim))
+
+    rng = random.Random(1)
+    targets = {f"message-{rng.randrange(args.messages)}" for _ in range(args.queries)}
+    corpus = {}
+
+    def rows():
+        # Keep the target messages of the queries on the way.
+        for row in make_corpus(args.messages, args.agents, args.conversation_size, args.vocabulary):
+            if row["id"] in targets:
+                corpus[row["id"]] = row
+            yield row
+
+    start = time.perf_counter()
+    memory.index_rows(rows())
+    memory.index.flush()
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print(f"Indexed {len(memory.index)} messages in {elapsed:.1f}s ({len(memory.index) / elapsed:.0f} messages/s), {size / 1e6:.0f} MB on disk")
+
+    queries = []
+    for row in corpus.values():
+        content = sorted({word for word in row["user_message"].split() if int(word[4:]) >= args.common_words})
+        words = rng.sample(content, min(args.query_words, len(content)))
+        words += [f"word{rng.randrange(args.common_words, args.vocabulary)}" for _ in range(args.noise_words)]
+        queries.append((row, " ".join(words)))
+
+    for scope in ("all", "agent", "conversation"):
+        latencies, recalled = [], 0
+        for row, query in queries:
+            vector = memory.embedder.embed([query])[0]
+            filters = {"conversation": {"conversation_id": row["conversation_id"]}, "agent": {"agent_id": row["agent_id"]}}.get(scope, {})
+            start = time.perf_counter()
+            results = memory.index.search(vector, args.top_k, **filters)
+            latencies.append(time.perf_counter() - start)
+            recalled += row["id"] in {message_id for message_id, _ in results}
+        print(
+            f"{scope:12s} recall@{args.top_k} {recalled / len(queries):.3f}  "
+            f"p50 {percentile(latencies, 0.5) * 1e3:7.2f} ms  p99 {percentile(latencies, 0.99) * 1e3:7.2f} ms"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Latency of saving a chat turn: a commit per message in the threadpool (what the
+chat route used to do) vs queuing it in the write-behind `MessageWriter`.
+
+    python benchmarks/bench_message_writer.py --conversations 50 --turns 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+import agents.crud
+import agents.models
+from agents.api import schemas
+from agents.database import create_async_db_engine, create_db_engine
+from agents.writer import MessageWriter
+
+def report(name: str, latencies: list, elapsed: float):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{name:25s} p50 {p50:8.3f} ms  p99 {p99:8.3f} ms  mean {statistics.mean(latencies) * 1000:8.3f} ms"
+          f"  {len(latencies) / elapsed:8.1f} turns/s")
+
+async def main(conversations: int, turns: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_db_engine(url)
+        agents.models.Base.metadata.create_all(bind = engine)
+        SessionBench = sessionmaker(bind = engine)
+        db = SessionBench()
+        agent = agents.crud.create_agent(db, schemas.AgentCreate(
+            context = "c", first_message = "hi", response_shape = "{}", instructions = "i"
+        ))
+        conversation_ids = [
+            agents.crud.create_conversation(db, schemas.ConversationCreate(agent_id = agent.id)).id
+            for _ in range(conversations)
+        ]
+        db.close()
+        message = schemas.MessageCreate(user_message = "user", agent_message = "agent")
+
+        def commit_message(conversation_id):
+            db = SessionBench()
+            try:
+                agents.crud.create_conversation_message(db, message, conversation_id)
+            finally:
+                db.close()
+
+        async def run(save):
+            latencies = []
+
+            async def conversation(conversation_id):
+                for _ in range(turns):
+                    start = time.perf_counter()
+                    await save(conversation_id)
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(conversation(conversation_id) for conversation_id in conversation_ids))
+            return latencies, time.perf_counter() - start
+
+        latencies, elapsed = await run(lambda conversation_id: run_in_threadpool(commit_message, conversation_id))
+        report("commit per message", latencies, elapsed)
+
+        async_engine = create_async_db_engine(url)
+        writer = MessageWriter(session_factory = async_sessionmaker(async_engine, expire_on_commit = False))
+        await writer.start()
+        latencies, elapsed = await run(lambda conversation_id: writer.submit(conversation_id, message))
+        start = time.perf_counter()
+        await writer.stop()
+        report("write-behind queue", latencies, elapsed)
+        print(f"final flush on stop: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        async with async_sessionmaker(async_engine)() as adb:
+            stored = (await adb.execute(select(func.count(agents.models.Message.id)))).scalar()
+        print(f"messages stored: {stored} (expected {2 * conversations * turns})")
+        await async_engine.dispose()
+        engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type = int, default = 50)
+    parser.add_argument("--turns", type = int, default = 20)
+    args = parser.parse_args()
+    asyncio.run(main(args.conversations, args.turns))
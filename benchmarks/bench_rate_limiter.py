@@ -0,0 +1,69 @@
+"""
+Bursts against a provider that enforces a requests per second limit with 429s,
+with the client-side limiter effectively off vs set to the provider limit.
+
+    python benchmarks/bench_rate_limiter.py --requests 200 --max-rps 20
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+import openai
+
+from agentsfwrk import integrations, providers, ratelimit
+from agentsfwrk.logger import APP_LOGGER_NAME
+from fake_llm_server import create_app, serve_in_thread
+
+# The retries are expected, keep their logs out of the results.
+logging.getLogger(APP_LOGGER_NAME).setLevel(logging.CRITICAL)
+
+async def burst(model: str, requests: int):
+    latencies = []
+
+    async def one(i: int):
+        service = integrations.OpenAIIntegrationService(
+            context = {"role": "system", "content": "You are a benchmark agent."},
+            instruction = None
+        )
+        start = time.perf_counter()
+        response = await service.aanswer_to_prompt(model = model, prompt = f"Hello {i}", max_tokens = 50)
+        latencies.append(time.perf_counter() - start)
+        return response["answer"] != integrations.FALLBACK_ANSWER
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    await providers.close_aiosession()
+
+    latencies.sort()
+    return sum(results), elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type = int, default = 200)
+    parser.add_argument("--max-rps", type = float, default = 20)
+    parser.add_argument("--latency", type = float, default = 0.05)
+    parser.add_argument("--port", type = int, default = 8100)
+    args = parser.parse_args()
+
+    app = create_app(latency = args.latency, max_rps = args.max_rps)
+    with serve_in_thread(port = args.port, app = app) as api_base:
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or "fake-key"
+        limiters = {
+            "no limiter": ratelimit.ModelLimiter(rpm = 1e9, tpm = 1e12, max_concurrency = 10000, timeout = 120),
+            # A small bucket so the burst is spread out instead of sent at once.
+            "limiter": ratelimit.ModelLimiter(rpm = args.max_rps * 60, tpm = 1e12, max_concurrency = 64, timeout = 120),
+        }
+        for name, limiter in limiters.items():
+            limiter.requests.capacity = limiter.requests.tokens = min(limiter.requests.capacity, args.max_rps)
+            model = f"fake-{name.replace(' ', '-')}"
+            ratelimit._limiters[f"openai/{model}"] = limiter
+            calls, rate_limited = app.state.calls, app.state.rate_limited
+            ok, elapsed, p50, p95 = asyncio.run(burst(model, args.requests))
+            print(f"{name:12s} ok {ok}/{args.requests}  upstream calls {app.state.calls - calls:4d}"
+                  f"  429s {app.state.rate_limited - rate_limited:4d}  total {elapsed:6.2f}s  p50 {p50:6.2f}s  p95 {p95:6.2f}s")
+
+if __name__ == "__main__":
+    main()
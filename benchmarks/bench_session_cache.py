@@ -0,0 +1,72 @@
+"""
+Time to prepare a chat turn (`load_chat_state`) with the conversation session loaded
+from the database on every turn (what the route used to do) vs kept in the session cache.
+
+    python benchmarks/bench_session_cache.py --conversations 200 --messages 20 --turns 2000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from agents import crud
+from agents.api.routes import load_chat_state
+from agents.api.schemas import AgentCreate, ConversationCreate, MessageCreate
+from agents.database import SessionLocal
+from agents.sessions import session_cache
+from agentsfwrk.logger import setup_applevel_logger
+
+def setup(conversations: int, messages: int) -> list:
+    db = SessionLocal()
+    agent = crud.create_agent(db, AgentCreate(
+        context = "You are a benchmark agent.", first_message = "Hi!",
+        response_shape = '{"answer": "string"}', instructions = "Answer."
+    ))
+    ids = []
+    for _ in range(conversations):
+        conversation = crud.create_conversation(db, ConversationCreate(agent_id = agent.id))
+        for i in range(messages):
+            crud.create_conversation_message(db, MessageCreate(
+                user_message = f"Question {i}: " + "tell me more. " * 10,
+                agent_message = f"Answer {i}: " + "here is more. " * 20,
+            ), conversation.id)
+        ids.append(conversation.id)
+    db.close()
+    return ids
+
+def run(ids: list, turns: int, cached: bool) -> list:
+    latencies = []
+    for _ in range(turns):
+        conversation_id = random.choice(ids)
+        if not cached:
+            session_cache.delete(conversation_id)
+        db = SessionLocal()
+        start = time.perf_counter()
+        load_chat_state(db, conversation_id)
+        latencies.append(time.perf_counter() - start)
+        db.close()
+    return sorted(latencies)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type = int, default = 200)
+    parser.add_argument("--messages", type = int, default = 20)
+    parser.add_argument("--turns", type = int, default = 2000)
+    args = parser.parse_args()
+
+    setup_applevel_logger(level = "WARNING", async_mode = False)
+    ids = setup(args.conversations, args.messages)
+    run(ids, args.conversations, cached = True)  # warm up, fills the cache
+    for name, cached in (("database", False), ("session cache", True)):
+        latencies = run(ids, args.turns, cached)
+        p50 = latencies[len(latencies) // 2] * 1e6
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+        print(f"{name:14s} p50 {p50:8.1f} us  p99 {p99:8.1f} us  ({len(session_cache)} sessions, {session_cache.size_bytes / 1e3:.0f} KB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Burst of identical first prompts, with and without request coalescing (single-flight).
+
+    python benchmarks/bench_single_flight.py --requests 200 --latency 0.5
+"""
+import argparse
+import asyncio
+import time
+
+import openai
+
+from agentsfwrk import integrations, providers
+from fake_llm_server import create_app, serve_in_thread
+
+async def burst(requests: int):
+    latencies = []
+
+    async def one():
+        service = integrations.OpenAIIntegrationService(
+            context = {"role": "system", "content": "You are a benchmark agent."},
+            instruction = None
+        )
+        service.add_chat_history(messages = [{"role": "assistant", "content": "Hi! How can I help?"}])
+        start = time.perf_counter()
+        await service.aanswer_to_prompt(model = "gpt-3.5-turbo", prompt = "What are your opening hours?", temperature = 0.5)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    await providers.close_aiosession()
+
+    latencies.sort()
+    return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type = int, default = 200)
+    parser.add_argument("--latency", type = float, default = 0.5)
+    parser.add_argument("--port", type = int, default = 8100)
+    args = parser.parse_args()
+
+    app = create_app(latency = args.latency)
+    with serve_in_thread(port = args.port, app = app) as api_base:
+        openai.api_base = api_base
+        openai.api_key = openai.api_key or "fake-key"
+        for enabled in (False, True):
+            integrations.SINGLE_FLIGHT = enabled
+            calls = app.state.calls
+            elapsed, p50, p99 = asyncio.run(burst(args.requests))
+            print(f"single-flight {'on ' if enabled else 'off'}  upstream calls {app.state.calls - calls:4d}"
+                  f"  total {elapsed:6.2f}s  p50 {p50:6.2f}s  p99 {p99:6.2f}s")
+        print("collapsed calls:", integrations.single_flight.stats())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Parse throughput of large structured replies.
+
+Compares `json.loads` (what the integrations used to do, it fails on any malformed
+reply) with `agentsfwrk.structured`: the repairing `loads`, the validation against a
+compiled response shape, and following a streamed reply with `IncrementalJSONParser`
+vs trying `json.loads` on the whole text after every delta.
+
+    python benchmarks/bench_structured_parse.py --items 2000 --repeat 20
+"""
+import argparse
+import json
+import time
+
+from agentsfwrk import structured
+
+SHAPE = {
+    "answer": "The answer to the user",
+    "intent": "bool",
+    "items": [{"name": "string", "score": "number", "tags": ["string"]}],
+}
+
+def make_reply(items: int) -> str:
+    data = {
+        "answer": "Here is what I found. " * 50,
+        "intent": True,
+        "items": [
+            {"name": f"item {i}", "score": i / 3, "tags": ["a", "b", f"tag\n{i}"]}
+            for i in range(items)
+        ],
+    }
+    return json.dumps(data, indent = 2)
+
+def malformed(reply: str) -> dict:
+    return {
+        "fenced": f"Sure, here it is:\n```json\n{reply}\n```",
+        "trailing commas": reply.replace("]\n    }", "],\n    }").replace("\n  ]", ",\n  ]"),
+        "cut off": reply[:int(len(reply) * 0.9)],
+    }
+
+def throughput(fn, text: str, repeat: int) -> str:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        try:
+            fn(text)
+        except ValueError:
+            return "fails"
+    elapsed = (time.perf_counter() - start) / repeat
+    return f"{len(text) / elapsed / 1e6:7.1f} MB/s ({elapsed * 1000:6.2f} ms)"
+
+def stream_naive(deltas):
+    text = ""
+    for delta in deltas:
+        text += delta
+        try:
+            return json.loads(text)
+        except ValueError:
+            continue
+
+def stream_incremental(deltas):
+    parser = structured.IncrementalJSONParser()
+    for delta in deltas:
+        parser.feed(delta)
+        if parser.done:
+            return parser.result()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type = int, default = 2000)
+    parser.add_argument("--repeat", type = int, default = 20)
+    parser.add_argument("--delta-size", type = int, default = 16)
+    args = parser.parse_args()
+
+    reply = make_reply(args.items)
+    validator = structured.compile_shape(SHAPE)
+    print(f"reply size: {len(reply) / 1e6:.2f} MB")
+
+    for name, text in {"valid": reply, **malformed(reply)}.items():
+        print(f"{name:16s} json.loads  {throughput(json.loads, text, args.repeat)}")
+        print(f"{name:16s} loads       {throughput(structured.loads, text, args.repeat)}")
+        print(f"{name:16s} + validate  {throughput(validator.parse, text, args.repeat)}")
+
+    start = time.perf_counter()
+    for _ in range(10000):
+        structured.compile_shape(SHAPE)
+    print(f"compile_shape (cached): {(time.perf_counter() - start) / 10000 * 1e6:.1f} us")
+
+    # The naive streaming parse is quadratic, keep its reply small.
+    small = make_reply(max(1, args.items // 20))
+    deltas = [small[i:i + args.delta_size] for i in range(0, len(small), args.delta_size)]
+    for name, fn in (("naive", stream_naive), ("incremental", stream_incremental)):
+        start = time.perf_counter()
+        assert fn(deltas) is not None
+        print(f"stream {name:12s} {len(deltas)} deltas ({len(small) / 1e3:.0f} KB) in {(time.perf_counter() - start) * 1000:8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Token counting throughput: the old estimate (characters / 4), the tokenizer counts
+(`tiktoken` when installed, the approximation otherwise) of new texts, and the memoized
+counts of texts seen before, like the agent prompts and history replayed on every turn.
+Then the budgeting of a whole chat prompt (`fit_messages`), cold and warm.
+
+    python benchmarks/bench_tokens.py --texts 20000
+"""
+import argparse
+import random
+import time
+
+from agents import tokens
+
+WORDS = (
+    "the user asked about their order and the agent answered with the delivery date, "
+    "refund policy, tracking number 1Z999AA10123456784, and a link: https://example.com/help?q=orders"
+).split()
+
+def make_texts(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k = rng.randint(10, 120))) + f" #{seed}-{i}" for i in range(count)]
+
+def report(name: str, count: int, elapsed: float, unit: str = "texts"):
+    print(f"{name:34s} {count / elapsed:12.0f} {unit}/s  ({elapsed * 1e6 / count:8.2f} us each)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type = int, default = 20000)
+    parser.add_argument("--prompts", type = int, default = 2000)
+    args = parser.parse_args()
+
+    encoding = tokens._get_encoding(tokens.DEFAULT_MODEL)
+    print(f"Tokenizer: {encoding.name if encoding is not None else 'approximation (tiktoken not available)'}")
+    texts = make_texts(args.texts, 0)
+
+    start = time.perf_counter()
+    for text in texts:
+        len(text) // 4 + 1
+    report("estimate (characters / 4)", len(texts), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for text in texts:
+        tokens.count_tokens(text)
+    report("count, new texts", len(texts), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for text in texts:
+        tokens.count_tokens(text)
+    report("count, memoized", len(texts), time.perf_counter() - start)
+
+    # A prompt: the agent prefix, a summary, 10 turns of history and the user message.
+    history = make_texts(args.prompts + 21, 1)
+    prompts = []
+    for i in range(args.prompts):
+        messages = [{"role": "system", "content": texts[0]}, {"role": "assistant", "content": texts[1]}, {"role": "system", "content": texts[2]}]
+        messages += [{"role": "user" if j % 2 else "assistant", "content": history[i + j]} for j in range(20)]
+        messages.append({"role": "user", "content": history[i + 20]})
+        prompts.append(messages)
+    tokens._count_tokens.cache_clear()
+    start = time.perf_counter()
+    for messages in prompts:
+        tokens.fit_messages(messages, "gpt-3.5-turbo", 1000)
+    report("fit_messages, consecutive turns", len(prompts), time.perf_counter() - start, "prompts")
+    start = time.perf_counter()
+    for messages in prompts:
+        tokens.fit_messages(messages, "gpt-3.5-turbo", 1000)
+    report("fit_messages, all memoized", len(prompts), time.perf_counter() - start, "prompts")
+    print(f"memoized counts: {tokens._count_tokens.cache_info()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Latency of the chat turns over HTTP (a request per turn, on kept-alive connections) vs
+a WebSocket session per conversation (`/agents/ws/{conversation_id}`). The app runs with
+uvicorn and the in-process fake provider, so the times are the per-turn overhead of the
+service, not of a completion. Each client chats in its own conversation, one turn after
+the other.
+
+    python benchmarks/bench_websocket.py --clients 20 --turns 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+from load_test import ROOT, wait_ready
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_app(port: int, folder: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(folder, 'agents.db')}",
+        "LLM_PROVIDER": "fake",
+        # Without the limits of the provider, the turns would be paced by the requests
+        # and tokens/min of the governor (the streamed ones keep their estimated tokens).
+        "LLM_RPM": "1e9",
+        "LLM_TPM": "1e9",
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+        "PYTHONPATH": os.pathsep.join(filter(None, [os.path.join(ROOT, "src"), env.get("PYTHONPATH")])),
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "agents.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd = folder,
+        env = env,
+        stdout = subprocess.DEVNULL,
+    )
+
+async def http_client(client: httpx.AsyncClient, conversation_id: str, turns: int, latencies: list):
+    for turn in range(turns):
+        start = time.perf_counter()
+        response = await client.post("/agents/chat-agent", json = {"conversation_id": conversation_id, "message": f"Turn {turn}"})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+async def sse_client(client: httpx.AsyncClient, conversation_id: str, turns: int, latencies: list):
+    for turn in range(turns):
+        start = time.perf_counter()
+        async with client.stream("POST", "/agents/chat-agent/stream", json = {"conversation_id": conversation_id, "message": f"Turn {turn}"}) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("event: end"):
+                    break
+        latencies.append(time.perf_counter() - start)
+
+async def websocket_client(url: str, conversation_id: str, turns: int, latencies: list):
+    async with websockets.connect(f"{url}/agents/ws/{conversation_id}") as websocket:
+        await websocket.recv()
+        for turn in range(turns):
+            start = time.perf_counter()
+            await websocket.send(json.dumps({"message": f"Turn {turn}"}))
+            while True:
+                event = json.loads(await websocket.recv())
+                if event["type"] == "ping":
+                    await websocket.send(json.dumps({"type": "pong"}))
+                elif event["type"] in ("end", "error"):
+                    break
+            latencies.append(time.perf_counter() - start)
+
+def percentile(values: list, fraction: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+async def main(clients: int, turns: int):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as folder:
+        app = start_app(port, folder)
+        try:
+            await wait_ready(f"{url}/", app)
+            limits = httpx.Limits(max_connections = clients, max_keepalive_connections = clients)
+            async with httpx.AsyncClient(base_url = url, limits = limits, timeout = 60) as client:
+                agent = (await client.post("/agents/create-agent", json = {
+                    "context": "You are a benchmark agent.", "first_message": "Hi!",
+                    "response_shape": '{"answer": "string"}', "instructions": "Answer."
+                })).json()
+
+                async def conversations():
+                    return [
+                        (await client.post("/agents/create-conversation", json = {"agent_id": agent["id"]})).json()["id"]
+                        for _ in range(clients)
+                    ]
+
+                for name, run in (
+                    ("http", lambda conversation_id, latencies: http_client(client, conversation_id, turns, latencies)),
+                    ("http stream", lambda conversation_id, latencies: sse_client(client, conversation_id, turns, latencies)),
+                    ("websocket", lambda conversation_id, latencies: websocket_client(url.replace("http", "ws"), conversation_id, turns, latencies)),
+                ):
+                    latencies = []
+                    ids = await conversations()
+                    start = time.perf_counter()
+                    await asyncio.gather(*(run(conversation_id, latencies) for conversation_id in ids))
+                    elapsed = time.perf_counter() - start
+                    print(
+                        f"{name:12s} {len(latencies):6d} turns in {elapsed:6.2f}s -> {len(latencies) / elapsed:7.0f} turns/s, "
+                        f"p50 {percentile(latencies, 0.5) * 1e3:6.1f} ms, p95 {percentile(latencies, 0.95) * 1e3:6.1f} ms"
+                    )
+        finally:
+            app.terminate()
+            app.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type = int, default = 20)
+    parser.add_argument("--turns", type = int, default = 50)
+    args = parser.parse_args()
+    asyncio.run(main(args.clients, args.turns))
@@ -0,0 +1,200 @@
+"""
+Local fake of the OpenAI completion API used by the benchmarks.
+
+It answers `/v1/chat/completions` (plain and streamed) and `/v1/completions` after
+a configurable latency, and can inject server errors and 429s at a given rate or
+enforce a requests per second limit with 429s.
+
+Run it standalone:
+    python benchmarks/fake_llm_server.py --port 8100 --latency 0.2
+
+and point the service to it with `OPENAI_API_BASE=http://127.0.0.1:8100/v1`.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_ANSWER = '{"answer": "Hello there, this is a fake answer from the local completion server."}'
+
+def create_app(
+    latency: float = 0.1,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    answer: str = DEFAULT_ANSWER,
+    token_delay: float = 0.0,
+    max_rps: float = 0.0
+) -> FastAPI:
+    """
+    Create the fake completion server app.
+    """
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.rate_limited = 0
+    app.state.errors = 0
+    recent = collections.deque()
+
+    def over_limit() -> bool:
+        if not max_rps:
+            return False
+        now = time.monotonic()
+        while recent and recent[0] < now - 1:
+            recent.popleft()
+        if len(recent) >= max_rps:
+            return True
+        recent.append(now)
+        return False
+
+    def failure():
+        roll = random.random()
+        if roll < rate_limit_rate or over_limit():
+            app.state.rate_limited += 1
+            return JSONResponse(
+                status_code = 429,
+                content = {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers = {"retry-after": "1"}
+            )
+        if roll < rate_limit_rate + error_rate:
+            app.state.errors += 1
+            return JSONResponse(
+                status_code = 500,
+                content = {"error": {"message": "The server had an error", "type": "server_error"}}
+            )
+        return None
+
+    def usage(messages, text):
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        completion_tokens = len(text) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.calls += 1
+        body = await request.json()
+        await asyncio.sleep(latency)
+        error = failure()
+        if error is not None:
+            return error
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "fake-model")
+
+        if body.get("stream"):
+            async def events():
+                words = answer.split(" ")
+                for i, word in enumerate(words):
+                    delta = {"content": word if i == 0 else " " + word}
+                    if i == 0:
+                        delta["role"] = "assistant"
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    if token_delay:
+                        await asyncio.sleep(token_delay)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type = "text/event-stream")
+
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop"
+                }
+            ],
+            "usage": usage(body.get("messages", []), answer)
+        }
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        app.state.calls += 1
+        body = await request.json()
+        await asyncio.sleep(latency)
+        error = failure()
+        if error is not None:
+            return error
+
+        prompt = body.get("prompt", "")
+        return {
+            "id": f"cmpl-{uuid.uuid4().hex}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-model"),
+            "choices": [{"index": 0, "text": answer, "finish_reason": "stop"}],
+            "usage": usage([{"content": prompt}], answer)
+        }
+
+    return app
+
+@contextlib.contextmanager
+def serve_in_thread(host: str = "127.0.0.1", port: int = 8100, app: FastAPI = None, **kwargs):
+    """
+    Run the fake server (`app`, or one created with `kwargs`) in a background thread
+    for the duration of the block. Yields the base url to use as `openai.api_base`.
+    """
+    app = app or create_app(**kwargs)
+    server = uvicorn.Server(uvicorn.Config(app, host = host, port = port, log_level = "warning"))
+    thread = threading.Thread(target = server.run, daemon = True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://{host}:{port}/v1"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Fake OpenAI compatible completion server")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8100)
+    parser.add_argument("--latency", type = float, default = 0.1, help = "Seconds before answering")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Fraction of 500 responses")
+    parser.add_argument("--rate-limit-rate", type = float, default = 0.0, help = "Fraction of 429 responses")
+    parser.add_argument("--token-delay", type = float, default = 0.0, help = "Seconds between streamed tokens")
+    parser.add_argument("--max-rps", type = float, default = 0.0, help = "Requests per second before answering 429s")
+    args = parser.parse_args()
+
+    app = create_app(
+        latency = args.latency,
+        error_rate = args.error_rate,
+        rate_limit_rate = args.rate_limit_rate,
+        token_delay = args.token_delay,
+        max_rps = args.max_rps
+    )
+    uvicorn.run(app, host = args.host, port = args.port, log_level = "warning")
+
+if __name__ == "__main__":
+    main()
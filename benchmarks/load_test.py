@@ -0,0 +1,347 @@
+"""
+End-to-end load test of the service.
+
+Starts `agents.main:app` with uvicorn (on a fresh SQLite database in a temporary
+folder) and the local fake completion server, both in their own process, then
+drives a mix of `create-agent`, `create-conversation`, `chat-agent` and
+`get-messages` requests from `--concurrency` clients for `--duration` seconds.
+
+It reports the p50/p95/p99 latencies and the throughput of each kind of request,
+the completion retries and rejections (from `/metrics`) and the growth of the
+database, and saves everything as JSON so runs of different commits can be compared:
+
+    python benchmarks/load_test.py --concurrency 50 --duration 30 --latency 0.2
+    python benchmarks/load_test.py --compare benchmarks/results/load_test_<commit>_<time>.json
+
+The mix is given as weights, e.g. `--mix chat=70,messages=20,conversation=8,agent=2`.
+The app gets the environment of the script, e.g. `LLM_TPM` to lift the client-side
+limiter or `MESSAGE_WRITE_BEHIND=false` to compare settings.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+
+DEFAULT_MIX = "chat=70,messages=20,conversation=8,agent=2"
+OPERATIONS = ("chat", "messages", "conversation", "agent")
+
+MESSAGES = [
+    "Hi! Can you help me plan a trip to Lisbon?",
+    "What should I pack for a week of hiking? " * 3,
+    "Summarize what we talked about so far.",
+    "I'd like a recipe with what I have at home: eggs, rice, spinach and some cheese.",
+    "Tell me more. " * 20,
+]
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in filter(None, (part.strip() for part in mix.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r} in the mix, use {', '.join(OPERATIONS)}")
+        weights[name] = float(weight)
+    return weights
+
+def percentile(values: list, q: float) -> float:
+    """
+    Nearest-rank percentile of sorted `values`.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+def db_size(path: str) -> int:
+    """
+    Size of the data in the database, the file sizes alone would miss what is
+    still in the WAL (or count it twice after a checkpoint).
+    """
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    return (page_count - freelist_count) * page_size
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd = ROOT, stderr = subprocess.DEVNULL, text = True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Process exited with code {process.returncode} before getting ready")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+def start_fake_llm(args, port: int) -> subprocess.Popen:
+    return subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS, "fake_llm_server.py"),
+        "--port", str(port),
+        "--latency", str(args.latency),
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+    ])
+
+def start_app(args, port: int, llm_port: int, folder: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(folder, 'agents.db')}",
+        "LLM_PROVIDER": "openai",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{llm_port}/v1",
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY") or "fake-key",
+        "LOG_LEVEL": env.get("LOG_LEVEL", "INFO"),
+        "PYTHONPATH": os.pathsep.join(filter(None, [os.path.join(ROOT, "src"), env.get("PYTHONPATH")])),
+    })
+    # The app writes its log file in the working directory.
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "agents.main:app",
+            "--port", str(port), "--workers", str(args.workers), "--log-level", "warning",
+        ],
+        cwd = folder,
+        env = env,
+        stdout = subprocess.DEVNULL,
+    )
+
+class LoadTest:
+    """
+    Closed-loop clients: each one sends a request drawn from the mix as soon as its
+    previous one is answered.
+    """
+    def __init__(self, client: httpx.AsyncClient, weights: dict) -> None:
+        self.client = client
+        self.operations = list(weights)
+        self.weights = list(weights.values())
+        self.agents = []
+        self.conversations = []
+        self.latencies = {name: [] for name in self.operations}
+        self.errors = {name: {} for name in self.operations}
+
+    async def create_agent(self):
+        response = await self.client.post("/agents/create-agent", json = {
+            "context": "You are a helpful assistant for a load test.",
+            "first_message": "Hi! How can I help you today?",
+            "response_shape": '{"answer": "string"}',
+            "instructions": "Answer briefly.",
+        })
+        response.raise_for_status()
+        self.agents.append(response.json()["id"])
+        return response
+
+    async def create_conversation(self):
+        response = await self.client.post(
+            "/agents/create-conversation", json = {"agent_id": random.choice(self.agents)}
+        )
+        response.raise_for_status()
+        self.conversations.append(response.json()["id"])
+        return response
+
+    async def chat(self):
+        return await self.client.post("/agents/chat-agent", json = {
+            "conversation_id": random.choice(self.conversations),
+            "message": random.choice(MESSAGES),
+        })
+
+    async def messages(self):
+        return await self.client.get(
+            "/agents/get-messages", params = {"conversation_id": random.choice(self.conversations), "limit": 20}
+        )
+
+    async def request(self, name: str):
+        call = {
+            "agent": self.create_agent,
+            "conversation": self.create_conversation,
+            "chat": self.chat,
+            "messages": self.messages,
+        }[name]
+        start = time.perf_counter()
+        try:
+            response = await call()
+            outcome = None if response.status_code < 400 else str(response.status_code)
+        except httpx.HTTPStatusError as e:
+            outcome = str(e.response.status_code)
+        except httpx.HTTPError as e:
+            outcome = type(e).__name__
+        elapsed = time.perf_counter() - start
+        if outcome is None:
+            self.latencies[name].append(elapsed)
+        else:
+            self.errors[name][outcome] = self.errors[name].get(outcome, 0) + 1
+
+    async def client_loop(self, deadline: float):
+        while time.monotonic() < deadline:
+            await self.request(random.choices(self.operations, self.weights)[0])
+
+    async def run(self, concurrency: int, duration: float) -> float:
+        for latencies in self.latencies.values():
+            latencies.clear()
+        for errors in self.errors.values():
+            errors.clear()
+        start = time.perf_counter()
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(self.client_loop(deadline) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        results = {}
+        every, errors = [], {}
+        for name in self.operations:
+            latencies = sorted(self.latencies[name])
+            every += latencies
+            for outcome, count in self.errors[name].items():
+                errors[outcome] = errors.get(outcome, 0) + count
+            results[name] = summarize(latencies, self.errors[name], elapsed)
+        results["total"] = summarize(sorted(every), errors, elapsed)
+        return results
+
+def summarize(latencies: list, errors: dict, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies) + sum(errors.values()),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+def metric_totals(text: str, names: tuple) -> dict:
+    """
+    Sum of the samples of some metrics in the Prometheus text format.
+    """
+    totals = {name: 0.0 for name in names}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        name = line.split("{", 1)[0].split(" ", 1)[0]
+        if name in totals:
+            totals[name] += float(line.rsplit(" ", 1)[1])
+    return totals
+
+def print_results(results: dict):
+    print(f"{'':14s} {'requests':>9s} {'errors':>7s} {'req/s':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    for name, result in results["requests"].items():
+        print(
+            f"{name:14s} {result['requests']:9d} {sum(result['errors'].values()):7d} {result['throughput']:8.1f}"
+            f" {result['p50_ms']:9.1f} {result['p95_ms']:9.1f} {result['p99_ms']:9.1f}"
+        )
+    database = results["database"]
+    print(
+        f"database: {database['size_before'] / 1e6:.2f} MB -> {database['size_after'] / 1e6:.2f} MB"
+        f" (+{database['growth'] / 1e6:.2f} MB)"
+    )
+    print("completions: " + ", ".join(f"{name} {value:g}" for name, value in results["metrics"].items()))
+
+def print_comparison(results: dict, baseline: dict):
+    print(f"\ncompared to {baseline['commit']} ({baseline['timestamp']}):")
+    for name, result in results["requests"].items():
+        before = baseline["requests"].get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("throughput", "p50_ms", "p95_ms", "p99_ms"):
+            if before[key]:
+                changes.append(f"{key} {(result[key] - before[key]) / before[key] * 100:+6.1f}%")
+        print(f"{name:14s} " + "  ".join(changes))
+
+async def main(args):
+    weights = parse_mix(args.mix)
+    folder = tempfile.mkdtemp(prefix = "load_test_")
+    llm_port, app_port = free_port(), free_port()
+    url = f"http://127.0.0.1:{app_port}"
+
+    fake_llm = start_fake_llm(args, llm_port)
+    app = start_app(args, app_port, llm_port, folder)
+    try:
+        await wait_ready(f"http://127.0.0.1:{llm_port}/docs", fake_llm)
+        await wait_ready(url, app)
+
+        limits = httpx.Limits(max_connections = args.concurrency, max_keepalive_connections = args.concurrency)
+        async with httpx.AsyncClient(base_url = url, limits = limits, timeout = args.timeout) as client:
+            test = LoadTest(client, weights)
+            for _ in range(args.agents):
+                await test.create_agent()
+            for _ in range(args.conversations):
+                await test.create_conversation()
+
+            if args.warmup:
+                await test.run(args.concurrency, args.warmup)
+            size_before = db_size(os.path.join(folder, "agents.db"))
+            elapsed = await test.run(args.concurrency, args.duration)
+            metrics = metric_totals(
+                (await client.get("/metrics")).text, ("llm_retries_total", "llm_rejected_total", "llm_tokens_total")
+            )
+    finally:
+        # uvicorn flushes the write-behind queue on shutdown.
+        for process in (app, fake_llm):
+            process.terminate()
+        for process in (app, fake_llm):
+            process.wait()
+    size_after = db_size(os.path.join(folder, "agents.db"))
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+        "config": vars(args),
+        "elapsed": elapsed,
+        "requests": test.report(elapsed),
+        "database": {"size_before": size_before, "size_after": size_after, "growth": size_after - size_before},
+        "metrics": metrics,
+    }
+    print_results(results)
+
+    output = args.output or os.path.join(
+        BENCHMARKS, "results", f"load_test_{results['commit']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent = 2)
+    print(f"results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(results, json.load(file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "End-to-end load test against the fake completion server")
+    parser.add_argument("--concurrency", type = int, default = 20, help = "Concurrent clients")
+    parser.add_argument("--duration", type = float, default = 30, help = "Seconds of measured load")
+    parser.add_argument("--warmup", type = float, default = 3, help = "Seconds of load before measuring")
+    parser.add_argument("--mix", default = DEFAULT_MIX, help = "Weights of the requests")
+    parser.add_argument("--agents", type = int, default = 5, help = "Agents created before the load")
+    parser.add_argument("--conversations", type = int, default = 50, help = "Conversations created before the load")
+    parser.add_argument("--workers", type = int, default = 1, help = "uvicorn workers of the app")
+    parser.add_argument("--latency", type = float, default = 0.2, help = "Seconds the fake completions take")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Fraction of 500s from the fake server")
+    parser.add_argument("--rate-limit-rate", type = float, default = 0.0, help = "Fraction of 429s from the fake server")
+    parser.add_argument("--timeout", type = float, default = 120, help = "Client timeout of each request")
+    parser.add_argument("--output", help = "JSON file of the results (default: benchmarks/results/...)")
+    parser.add_argument("--compare", help = "JSON results of a previous run to compare with")
+    asyncio.run(main(parser.parse_args()))
@@ -1,20 +1,50 @@
-from typing import List
-
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError, parse_obj_as
 from sqlalchemy.orm import Session
 
 import agents.api.schemas
 import agents.crud
+import agents.export
 import agents.models
-from agents.database import SessionLocal, engine
-from agents.processing import (craft_agent_chat_context,
-                               craft_agent_chat_first_message,
-                               craft_agent_chat_instructions)
-from agentsfwrk import integrations, logger
+from agents.database import AsyncSessionLocal, SessionLocal, engine, upgrade_schema
+from agents.history import build_history, load_session, summarize_history
+from agents.jobs import JOBS_ENABLED, JobQueueFullError, job_queue
+from agents.memory import message_memory
+from agents.sessions import session_cache
+from agents.tokens import ContextLimitError, fit_messages
+from agents.writer import message_writer
+from agents.processing import agent_prompt_cache, craft_agent_prompt
+from agentsfwrk import integrations, logger, metrics
+from agentsfwrk.providers import UnknownProviderError, get_provider
 
 log = logger.get_logger(__name__)
 
 agents.models.Base.metadata.create_all(bind = engine)
+upgrade_schema(engine, agents.models.Base.metadata)
+
+# Most rows a bulk request can create.
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", 100000))
+# Verify whether the conversations reached the goal of their agent after every turn
+# (a completion per turn, run by the job queue).
+VERIFY_GOAL = os.getenv("VERIFY_GOAL", "false").lower() == "true"
+
+# WebSocket chat sessions, see `chat_websocket`: most sessions open in the process, seconds
+# between the heartbeats and without any message from the client before closing, messages
+# the client can send ahead of the answers, and seconds a send to a client can take.
+WS_MAX_SESSIONS = int(os.getenv("WS_MAX_SESSIONS", 1000))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", 20))
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", 60))
+WS_MAX_PENDING = int(os.getenv("WS_MAX_PENDING", 4))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 30))
 
 # Router basic information
 router = APIRouter(
@@ -31,30 +61,79 @@ def get_db():
     finally:
         db.close()
 
+# Dependency: Used to get an async database session (AsyncSession) in our endpoints.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # Root endpoint for the router.
 @router.get("/")
 async def agents_root():
     return {"message": "Hello there conversational ai!"}
 
 @router.get("/get-agents", response_model = List[agents.api.schemas.Agent])
-async def get_agents(db: Session = Depends(get_db)):
+async def get_agents(
+    skip: int = Query(default = 0, ge = 0),
+    limit: int = Query(default = 100, gt = 0, le = 1000),
+    include_conversations: bool = True,
+    db: Session = Depends(get_db)
+):
     """
-    Get all agents endpoint.
-    """
-    log.info("Getting all agents")
-    db_agents = agents.crud.get_agents(db)
-    log.info(f"Agents: {db_agents}")
+    Get the agents endpoint, paginated with `skip` and `limit`.
 
-    return db_agents
+    Each agent comes with its `conversation_count`. The nested `conversations` list can
+    be left out (returned empty) with `include_conversations=false`.
+    """
+    log.info("Getting agents (skip: %s, limit: %s, include_conversations: %s)", skip, limit, include_conversations)
+    db_agents = agents.crud.get_agents(db, skip = skip, limit = limit, include_conversations = include_conversations)
+    counts = agents.crud.count_conversations(db, [db_agent.id for db_agent in db_agents])
+    log.info("Got %d agents", len(db_agents))
+
+    # NOTE: The response is built explicitly so the conversations relationship is never
+    # lazy loaded when it was left out.
+    return [
+        agents.api.schemas.Agent(
+            id                  = db_agent.id,
+            timestamp           = db_agent.timestamp,
+            context             = db_agent.context,
+            first_message       = db_agent.first_message,
+            response_shape      = db_agent.response_shape,
+            instructions        = db_agent.instructions,
+            provider            = db_agent.provider,
+            model               = db_agent.model,
+            params              = db_agent.params,
+            conversations       = db_agent.conversations if include_conversations else [],
+            conversation_count  = counts.get(db_agent.id, 0)
+        )
+        for db_agent in db_agents
+    ]
 
 @router.post("/create-agent", response_model = agents.api.schemas.Agent)
 async def create_agent(agent: agents.api.schemas.AgentCreate, db: Session = Depends(get_db)):
     """
     Create an agent endpoint.
     """
-    log.info(f"Creating agent: {agent.json()}")
-    db_agent = agents.crud.create_agent(db, agent)
-    log.info(f"Agent created with id: {db_agent.id}")
+    log.debug("Creating agent: %s", agent)
+    # NOTE: Writes run in the threadpool, a blocked event loop can't let the message
+    # writer finish the transaction this write would be waiting on.
+    db_agent = await run_in_threadpool(agents.crud.create_agent, db, agent)
+    log.info("Agent created with id: %s", db_agent.id)
+
+    return db_agent
+
+@router.post("/update-agent", response_model = agents.api.schemas.Agent)
+async def update_agent(agent: agents.api.schemas.AgentUpdate, db: Session = Depends(get_db)):
+    """
+    Update an agent endpoint. Only the given fields are updated.
+    """
+    log.debug("Updating agent: %s", agent)
+    db_agent = await run_in_threadpool(agents.crud.update_agent, db, agent)
+    if db_agent is None:
+        raise HTTPException(status_code = 404, detail = "Agent not found.")
+
+    # The conversations of the agent pick up the new prompt on their next turn.
+    agent_prompt_cache.delete(db_agent.id)
+    log.info("Agent updated with id: %s", db_agent.id)
 
     return db_agent
 
@@ -63,9 +142,9 @@ async def get_conversations(agent_id: str, db: Session = Depends(get_db)):
     """
     Get all conversations for an agent endpoint.
     """
-    log.info(f"Getting all conversations for agent id: {agent_id}")
+    log.info("Getting all conversations for agent id: %s", agent_id)
     db_conversations = agents.crud.get_conversations(db, agent_id)
-    log.info(f"Conversations: {db_conversations}")
+    log.debug("Got %d conversations", len(db_conversations))
 
     return db_conversations
 
@@ -74,25 +153,400 @@ async def create_conversation(conversation: agents.api.schemas.ConversationCreat
     """
     Create a conversation linked to an agent
     """
-    log.info(f"Creating conversation assigned to agent id: {conversation.agent_id}")
-    db_conversation = agents.crud.create_conversation(db, conversation)
-    log.info(f"Conversation created with id: {db_conversation.id}")
+    log.info("Creating conversation assigned to agent id: %s", conversation.agent_id)
+    db_conversation = await run_in_threadpool(agents.crud.create_conversation, db, conversation)
+    log.info("Conversation created with id: %s", db_conversation.id)
 
     return db_conversation
 
 @router.get("/get-messages", response_model = List[agents.api.schemas.Message])
-async def get_messages(conversation_id: str, db: Session = Depends(get_db)):
+async def get_messages(
+    conversation_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(default = None, gt = 0),
+    db: Session = Depends(get_db)
+):
     """
-    Get all messages for a conversation endpoint.
+    Get the messages for a conversation endpoint, ordered by timestamp.
+
+    Paginate with the id of a message as cursor: `before` returns the older messages,
+    `after` the newer ones, and `limit` the size of the page (the most recent messages
+    unless `after` is given). Without parameters all messages are returned.
     """
-    log.info(f"Getting all messages for conversation id: {conversation_id}")
-    db_messages = agents.crud.get_messages(db, conversation_id)
-    log.info(f"Messages: {db_messages}")
+    log.info("Getting messages for conversation id: %s (before: %s, after: %s, limit: %s)", conversation_id, before, after, limit)
+    # NOTE: Messages still in the write-behind queue are included, read before the database
+    # so a message is never missed if it gets written in between.
+    pending = message_writer.pending(conversation_id) if message_writer.running else []
+    db_messages = agents.crud.get_messages(db, conversation_id, before = before, after = after, limit = limit, pending = pending)
+    log.debug("Got %d messages", len(db_messages))
 
     return db_messages
 
+########################################
+# Export endpoints
+########################################
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+def _export_response(table: str, format: str, **filters) -> StreamingResponse:
+    # NOTE: The chunks are read from the database and encoded in the threadpool, Starlette
+    # iterates the (sync) generator there, one chunk at a time.
+    chunks = agents.export.encode_chunks(table, agents.export.export_chunks(table, **filters), format)
+    return StreamingResponse(
+        chunks,
+        media_type = EXPORT_MEDIA_TYPES[format],
+        headers = {"Content-Disposition": f'attachment; filename="{table}.{format}"'}
+    )
+
+@router.get("/export/messages")
+async def export_messages(
+    agent_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    format: str = Query(default = "ndjson", regex = "^(ndjson|parquet)$")
+):
+    """
+    Export the messages, with the agent of their conversation, of an agent (all agents if
+    not given) and sent in [`since`, `until`). One row per message:
+    ```
+    {"id": "string", "conversation_id": "string", "agent_id": "string", "timestamp": "datetime", "user_message": "string", "agent_message": "string"}
+    ```
+    The rows are streamed from the database in chunks, as NDJSON or a Parquet file.
+    """
+    log.info("Exporting messages as %s (agent id: %s, since: %s, until: %s)", format, agent_id, since, until)
+
+    return _export_response("messages", format, agent_id = agent_id, since = since, until = until)
+
+@router.get("/export/conversations")
+async def export_conversations(
+    agent_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    format: str = Query(default = "ndjson", regex = "^(ndjson|parquet)$")
+):
+    """
+    Export the conversations (with their summary) of an agent (all agents if not given)
+    and created in [`since`, `until`), streamed like the messages export.
+    """
+    log.info("Exporting conversations as %s (agent id: %s, since: %s, until: %s)", format, agent_id, since, until)
+
+    return _export_response("conversations", format, agent_id = agent_id, since = since, until = until)
+
+########################################
+# Bulk endpoints
+########################################
+async def read_bulk_rows(request: Request, schema) -> list:
+    """
+    Read the rows of a bulk request: a JSON list, or one JSON object per line with
+    an `application/x-ndjson` content type.
+    """
+    body = await request.body()
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            rows = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = f"Invalid JSON: {e}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code = 422, detail = "Expected a list of rows.")
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code = 413, detail = f"At most {BULK_MAX_ROWS} rows per request.")
+    try:
+        return parse_obj_as(List[schema], rows)
+    except ValidationError as e:
+        raise HTTPException(status_code = 422, detail = e.errors())
+
+def _check_exist(db: Session, model, ids: set, name: str):
+    missing = agents.crud.missing_ids(db, model, ids)
+    if missing:
+        raise HTTPException(status_code = 404, detail = f"{name} not found: {', '.join(sorted(missing)[:10])}")
+
+def _bulk_create_conversations(db: Session, conversations: list) -> List[str]:
+    _check_exist(db, agents.models.Agent, {conversation.agent_id for conversation in conversations}, "Agents")
+    return agents.crud.create_conversations(db, conversations)
+
+def _bulk_create_messages(db: Session, messages: list) -> List[str]:
+    conversation_ids = {mes.conversation_id for mes in messages}
+    _check_exist(db, agents.models.Conversation, conversation_ids, "Conversations")
+    rows = agents.crud.message_rows(messages)
+    agents.crud.create_messages(db, rows)
+    # The cached sessions of the conversations don't have the new messages.
+    for conversation_id in conversation_ids:
+        session_cache.delete(conversation_id)
+    return [row["id"] for row in rows]
+
+@router.post("/bulk/create-agents", response_model = agents.api.schemas.BulkCreateResponse)
+async def bulk_create_agents(request: Request, db: Session = Depends(get_db)):
+    """
+    Create agents in a single transaction. The body is a list of agents (as for
+    `/create-agent`), in JSON or NDJSON (`Content-Type: application/x-ndjson`).
+    Returns the ids of the agents, in the same order.
+    """
+    rows = await read_bulk_rows(request, agents.api.schemas.AgentCreate)
+    ids = await run_in_threadpool(agents.crud.create_agents, db, rows)
+    log.info("Created %d agents", len(ids))
+
+    return agents.api.schemas.BulkCreateResponse(count = len(ids), ids = ids)
+
+@router.post("/bulk/create-conversations", response_model = agents.api.schemas.BulkCreateResponse)
+async def bulk_create_conversations(request: Request, db: Session = Depends(get_db)):
+    """
+    Create conversations in a single transaction, optionally with the `messages` of
+    their transcripts:
+    ```
+    {"agent_id": "string", "messages": [{"user_message": "string", "agent_message": "string", "timestamp": "datetime"}]}
+    ```
+    The body is a list of them, in JSON or NDJSON (`Content-Type: application/x-ndjson`).
+    Returns the ids of the conversations, in the same order.
+    """
+    rows = await read_bulk_rows(request, agents.api.schemas.ConversationImport)
+    ids = await run_in_threadpool(_bulk_create_conversations, db, rows)
+    log.info("Created %d conversations", len(ids))
+
+    return agents.api.schemas.BulkCreateResponse(count = len(ids), ids = ids)
+
+@router.post("/bulk/create-messages", response_model = agents.api.schemas.BulkCreateResponse)
+async def bulk_create_messages(request: Request, db: Session = Depends(get_db)):
+    """
+    Create messages of existing conversations in a single transaction, e.g. to import
+    historical transcripts:
+    ```
+    {"conversation_id": "string", "user_message": "string", "agent_message": "string", "timestamp": "datetime"}
+    ```
+    The messages without `timestamp` get the import time, in the order they are given.
+    The body is a list of them, in JSON or NDJSON (`Content-Type: application/x-ndjson`).
+    Returns the ids of the messages, in the same order.
+    """
+    rows = await read_bulk_rows(request, agents.api.schemas.MessageBulkCreate)
+    ids = await run_in_threadpool(_bulk_create_messages, db, rows)
+    log.info("Created %d messages", len(ids))
+
+    return agents.api.schemas.BulkCreateResponse(count = len(ids), ids = ids)
+
+########################################
+# Job endpoints
+########################################
+@router.get("/jobs/status", response_model = agents.api.schemas.JobQueueStatus)
+async def get_jobs_status():
+    """
+    Get the state of the job queue (summaries and goal verifications run after the chat
+    turns): the jobs waiting (`depth`, refused past `max_queued`), the age of the oldest
+    one, the jobs of each kind by status, and the latency (p50 and p95 seconds of waiting
+    and running) of the recently finished ones.
+    """
+    return await job_queue.status()
+
+@router.get("/jobs/{job_id}", response_model = agents.api.schemas.Job)
+async def get_job(job_id: str):
+    """
+    Get a job, with its result (e.g. the goal verification) once it's done.
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code = 404, detail = "Job not found.")
+
+    return job
+
+def load_chat_state(db: Session, conversation_id: str, query: str = None):
+    """
+    Load the conversation session and build the prompt messages for a chat turn, with
+    the service of the agent's provider and the agent prompt (model and params to use),
+    see `build_chat_state`.
+    This can do (blocking) database I/O, so async endpoints run it in the threadpool.
+    """
+    session = get_chat_session(db, conversation_id)
+    if session is None:
+        return None, None, None, False
+
+    return build_chat_state(db, session, query)
+
+def get_chat_session(db: Session, conversation_id: str):
+    """
+    Get the session of a conversation (None if it doesn't exist), from the cache or
+    loaded from the database.
+    """
+    # NOTE: A conversation with a cached session needs no database access, the session
+    # is kept up to date with the messages of the turns and the summaries.
+    session = session_cache.get(conversation_id)
+    if session is None:
+        loaded_at = time.monotonic()
+        with metrics.stage("conversation_lookup"):
+            conversation = agents.crud.get_conversation(db, conversation_id)
+        if not conversation:
+            return None
+
+        # NOTE: Load the recent messages (in order by timestamp) that can fit the context
+        # window policy, older messages are replayed through the conversation summary.
+        # The pending messages are read before the database, so a message is never missed
+        # if it gets written in between.
+        with metrics.stage("history_load"):
+            pending = message_writer.pending(conversation.id) if message_writer.running else None
+            session = load_session(db, conversation, pending = pending)
+        session_cache.set(session, loaded_at)
+
+    return session
+
+def build_chat_state(db: Session, session, query: str = None):
+    """
+    Build the prompt messages for a chat turn from the session of the conversation.
+    Given the user message (`query`), the prompt is fit in the context of the model, the
+    `max_tokens` of the agent params sized to the room left (`ContextLimitError` when
+    there is not enough), and with the message memory enabled, the past messages
+    relevant to it are recalled into the prompt.
+    The database is only used for an agent prompt not cached and the memory recall.
+    """
+    log.debug("Conversation id: %s", session.conversation_id)
+
+    # NOTE: We are crafting the context first and passing the chat messages in a list
+    # appending the first message (the approach from the agent) to it.
+    # The agent prompt is built once and shared by all the conversations of the agent,
+    # the agent row is only loaded when it's not cached.
+    with metrics.stage("prompt_build"):
+        agent_prompt = agent_prompt_cache.get(session.agent_id)
+        if agent_prompt is None:
+            agent_prompt = craft_agent_prompt(agents.crud.get_agent(db, session.agent_id))
+            agent_prompt_cache.set(session.agent_id, agent_prompt)
+    chat_messages = [agent_prompt["first_message"]]
+
+    # NOTE: Append to the conversation the messages of the session that fit the context
+    # window policy. If there are no messages, then this has no effect.
+    # With the memory, the older messages are replaced by the ones relevant to the user message.
+    memories = None
+    if query is not None and message_memory.enabled:
+        with metrics.stage("memory_search"):
+            memories = message_memory.recall(db, session, query)
+    history_messages, should_summarize = build_history(session, memories = memories, recent_messages = message_memory.recent_messages)
+    chat_messages += history_messages
+
+    service = integrations.OpenAIIntegrationService(
+        context = agent_prompt["context"],
+        instruction = agent_prompt["instructions"],
+        provider = get_provider(agent_prompt["provider"])
+    )
+    service.add_chat_history(messages = chat_messages)
+
+    # NOTE: Check the prompt fits the context of the model before calling it, dropping
+    # the older history if needed, and size the completion to the room left.
+    if query is not None:
+        with metrics.stage("token_budget"):
+            messages, max_tokens = fit_messages(
+                service.messages + [{"role": "user", "content": query}],
+                agent_prompt["model"],
+                agent_prompt["params"].get("max_tokens")
+            )
+        service.messages = messages[:-1]
+        agent_prompt = {**agent_prompt, "params": {**agent_prompt["params"], "max_tokens": max_tokens}}
+
+    # NOTE: Give the connection back to the pool while the completion runs. The request
+    # session would otherwise hold it until the response (and its background summary,
+    # which needs a connection too) is done, and concurrent chats exhaust the pool.
+    # The session checks out a connection again if it's used later.
+    db.close()
+
+    return session, service, agent_prompt, should_summarize
+
+def _create_chat_message(conversation_id: str, user_message: str, agent_message: str, db: Session = None):
+    # A session is opened when the one of the request might be gone.
+    session = db or SessionLocal()
+    try:
+        return agents.crud.create_conversation_message(
+            db = session,
+            conversation_id = conversation_id,
+            message = agents.api.schemas.MessageCreate(
+                user_message = user_message,
+                agent_message = agent_message,
+            ),
+        )
+    finally:
+        if db is None:
+            session.close()
+
+async def save_chat_message(conversation_id: str, user_message: str, agent_message: str, db: Session = None, agent_id: str = None):
+    """
+    Save a chat interaction. With the write-behind queue running the message is queued
+    and written in a batch, out of the response latency, otherwise it's written in the
+    threadpool. The message is added to the conversation session, if it's cached, and
+    to the message memory of the agent (`agent_id`).
+    """
+    if message_writer.running:
+        db_message = await message_writer.submit(
+            conversation_id,
+            agents.api.schemas.MessageCreate(
+                user_message = user_message,
+                agent_message = agent_message,
+            )
+        )
+    else:
+        db_message = await run_in_threadpool(_create_chat_message, conversation_id, user_message, agent_message, db)
+    session_cache.add_message(db_message)
+    if agent_id is not None:
+        message_memory.add(db_message, agent_id)
+
+    return db_message
+
+@job_queue.handler("summarize")
+async def summarize_job(payload: dict):
+    if not await summarize_history(payload["conversation_id"]):
+        raise RuntimeError("The summary could not be written")
+
+@job_queue.handler("verify_goal")
+async def verify_goal_job(payload: dict) -> dict:
+    """
+    Verify whether a conversation reached the goal of its agent, the result is the
+    answer of the model in the format of the agent instructions.
+    """
+    db = SessionLocal()
+    try:
+        session, service, agent_prompt, _ = await run_in_threadpool(load_chat_state, db, payload["conversation_id"])
+    finally:
+        db.close()
+    if session is None:
+        raise LookupError("Conversation not found")
+
+    return await service.averify_goal_conversation(agent_prompt["model"], **agent_prompt["params"])
+
+async def enqueue_turn_jobs(session, message_id: Optional[str], should_summarize: bool):
+    """
+    Queue the work that follows a chat turn: the summary of the conversation once enough
+    messages are out of the window, and with `VERIFY_GOAL` the goal verification of the
+    turn (`message_id`). Without the job queue the summary is written right away.
+    Meant to run after the response has been sent to the user.
+    """
+    if not JOBS_ENABLED:
+        if should_summarize:
+            await summarize_history(session.conversation_id)
+        return
+
+    jobs = []
+    if should_summarize:
+        # The job reads the messages to fold from the database, they must be written first.
+        if message_writer.running:
+            await message_writer.drain()
+        # One summary per state of the conversation, the turns until it's written get the same job.
+        until = session.summary_until.isoformat() if session.summary_until else "start"
+        jobs.append(("summarize", f"summarize:{session.conversation_id}:{until}"))
+    if VERIFY_GOAL and message_id is not None:
+        jobs.append(("verify_goal", f"verify_goal:{session.conversation_id}:{message_id}"))
+    for kind, key in jobs:
+        try:
+            job = await job_queue.enqueue(kind, {"conversation_id": session.conversation_id}, key = key)
+        except JobQueueFullError as e:
+            log.warning(f"Job {kind} of conversation {session.conversation_id} not queued: {e}")
+            continue
+        except Exception as e:
+            log.error(f"Exception occurred queuing job {kind} of conversation {session.conversation_id}: {e}")
+            continue
+        if kind == "summarize" and job.status == "done":
+            # Written by a worker of another process, the cached session doesn't have it.
+            session_cache.delete(session.conversation_id)
+
 @router.post("/chat-agent", response_model = agents.api.schemas.ChatAgentResponse)
-async def chat_completion(message: agents.api.schemas.UserMessage, db: Session = Depends(get_db)):
+async def chat_completion(
+    message: agents.api.schemas.UserMessage,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db)
+):
     """
     Get a response from the GPT model given a message from the client using the chat
     completion endpoint.
@@ -105,12 +559,20 @@ async def chat_completion(message: agents.api.schemas.UserMessage, db: Session =
     }
     ```
     """
-    log.info(f"User conversation id: {message.conversation_id}")
-    log.info(f"User message: {message.message}")
+    log.info("User conversation id: %s", message.conversation_id)
+    log.debug("User message: %s", message.message)
 
-    conversation = agents.crud.get_conversation(db, message.conversation_id)
-
-    if not conversation:
+    # NOTE: Database access is blocking, so it runs in the threadpool while the
+    # completion itself is awaited. Nothing in this endpoint blocks the event loop.
+    try:
+        session, service, agent_prompt, should_summarize = await run_in_threadpool(load_chat_state, db, message.conversation_id, message.message)
+    except ContextLimitError as e:
+        raise HTTPException(status_code = 413, detail = str(e))
+    except UnknownProviderError as e:
+        # The agent was saved with a provider that is no longer configured.
+        raise HTTPException(status_code = 422, detail = str(e))
+
+    if not session:
         # If there are no conversations, we can choose to create one on the fly OR raise an exception.
         # Which ever you choose, make sure to uncomment when necessary.
 
@@ -118,87 +580,393 @@ async def chat_completion(message: agents.api.schemas.UserMessage, db: Session =
         # conversation = agents.crud.create_conversation(db, message.conversation_id)
 
         # Option 2:
-        return HTTPException(
+        raise HTTPException(
             status_code = 404,
             detail = "Conversation not found. Please create conversation first."
         )
 
-    log.info(f"Conversation id: {conversation.id}")
-
-    # NOTE: We are crafting the context first and passing the chat messages in a list
-    # appending the first message (the approach from the agent) to it.
-    context = craft_agent_chat_context(conversation.agent.context)
-    chat_messages = [craft_agent_chat_first_message(conversation.agent.first_message)]
-
-    # NOTE: Append to the conversation all messages until the last interaction from the agent
-    # If there are no messages, then this has no effect.
-    # Otherwise, we append each in order by timestamp (which makes logical sense).
-    hist_messages = conversation.messages
-    hist_messages.sort(key = lambda x: x.timestamp, reverse = False)
-    if len(hist_messages) > 0:
-        for mes in hist_messages:
-            log.info(f"Conversation history message: {mes.user_message} | {mes.agent_message}")
-            chat_messages.append(
-                {
-                    "role": "user",
-                    "content": mes.user_message
-                }
-            )
-            chat_messages.append(
-                {
-                    "role": "assistant",
-                    "content": mes.agent_message
-                }
-            )
-    # NOTE: We could control the conversation by simply adding
-    # rules to the length of the history.
-    # if len(hist_messages) > 10:
-    #     # Finish the conversation gracefully.
-    #     log.info("Conversation history is too long, finishing conversation.")
-    #     api_response = agents.api.schemas.ChatAgentResponse(
-    #         conversation_id = message.conversation_id,
-    #         response        = "This conversation is over, good bye."
-    #     )
-    #     return api_response
-
     # Send the message to the AI agent and get the response
-    service = integrations.OpenAIIntegrationService(
-        context = context,
-        instruction = craft_agent_chat_instructions(
-            conversation.agent.instructions,
-            conversation.agent.response_shape
+    # NOTE: The model and sampling params are the ones of the agent, or the defaults.
+    with metrics.stage("llm"):
+        response = await service.aanswer_to_prompt(
+            model               = agent_prompt["model"],
+            prompt              = message.message,
+            response_shape      = agent_prompt["response_shape"],
+            **agent_prompt["params"]
         )
-    )
-    service.add_chat_history(messages = chat_messages)
-
-    response = service.answer_to_prompt(
-        # We can test different OpenAI models.
-        model               = "gpt-3.5-turbo",
-        prompt              = message.message,
-        # We can test different parameters too.
-        temperature         = 0.5,
-        max_tokens          = 1000,
-        frequency_penalty   = 0.5,
-        presence_penalty    = 0
-    )
 
-    log.info(f"Agent response: {response}")
+    log.debug("Agent response: %s", response)
 
     # Prepare response to the user
     api_response = agents.api.schemas.ChatAgentResponse(
         conversation_id = message.conversation_id,
-        response        = response.get('answer')
+        response        = response.get('answer'),
+        data            = response.get('data')
     )
 
     # Save interaction to database
-    db_message = agents.crud.create_conversation_message(
-        db = db,
-        conversation_id = conversation.id,
-        message = agents.api.schemas.MessageCreate(
+    with metrics.stage("db_write"):
+        db_message = await save_chat_message(
+            conversation_id = session.conversation_id,
             user_message = message.message,
             agent_message = response.get('answer'),
-        ),
-    )
-    log.info(f"Conversation message id {db_message.id} saved to database")
+            db = db,
+            agent_id = session.agent_id
+        )
+    log.info("Conversation message id %s saved to database", db_message.id)
+
+    # Queue the summary of the older messages and the goal verification after responding.
+    background_tasks.add_task(enqueue_turn_jobs, session, db_message.id, should_summarize)
 
     return api_response
+
+# Keep a reference to the streaming completions running in the background,
+# otherwise the event loop could garbage collect them mid-flight.
+_stream_tasks = set()
+
+@router.post("/chat-agent/stream")
+async def chat_completion_stream(message: agents.api.schemas.UserMessage, db: Session = Depends(get_db)):
+    """
+    Same as the chat completion endpoint but the response is streamed back as
+    Server-Sent Events while the model generates it.
+
+    Each token delta is sent as `data: {"delta": "string"}`, and the stream ends with
+    an `end` event carrying the full response:
+    ```
+    event: end
+    data: {"conversation_id": "string", "response": "string"}
+    ```
+    """
+    log.info("User conversation id: %s", message.conversation_id)
+    log.debug("User message: %s", message.message)
+
+    try:
+        session, service, agent_prompt, should_summarize = await run_in_threadpool(load_chat_state, db, message.conversation_id, message.message)
+    except ContextLimitError as e:
+        raise HTTPException(status_code = 413, detail = str(e))
+    except UnknownProviderError as e:
+        # The agent was saved with a provider that is no longer configured.
+        raise HTTPException(status_code = 422, detail = str(e))
+
+    if not session:
+        raise HTTPException(
+            status_code = 404,
+            detail = "Conversation not found. Please create conversation first."
+        )
+
+    conversation_id = session.conversation_id
+    deltas = asyncio.Queue()
+
+    async def generate():
+        # NOTE: The completion runs in its own task and pushes deltas to a queue.
+        # If the client disconnects only the response is cancelled, the completion
+        # finishes and the assembled message is still saved to the database.
+        chunks = []
+        start = time.perf_counter()
+        try:
+            async for delta in service.astream_answer_to_prompt(
+                model               = agent_prompt["model"],
+                prompt              = message.message,
+                response_shape      = agent_prompt["response_shape"],
+                **agent_prompt["params"]
+            ):
+                if not chunks:
+                    metrics.stage_seconds.observe(time.perf_counter() - start, stage = "llm_first_token")
+                chunks.append(delta)
+                deltas.put_nowait(delta)
+            metrics.stage_seconds.observe(time.perf_counter() - start, stage = "llm")
+        except Exception as e:
+            log.error(f"Exception occurred while streaming the response: {e}")
+        finally:
+            deltas.put_nowait(None)
+            response = "".join(chunks)
+            log.debug("Agent response: %s", response)
+            db_message = None
+            if response:
+                with metrics.stage("db_write"):
+                    db_message = await save_chat_message(conversation_id, message.message, response, agent_id = session.agent_id)
+                log.info("Conversation message id %s saved to database", db_message.id)
+            await enqueue_turn_jobs(session, db_message.id if db_message else None, should_summarize)
+
+    task = asyncio.create_task(generate())
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+
+    async def events():
+        chunks = []
+        while (delta := await deltas.get()) is not None:
+            chunks.append(delta)
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+
+        end = agents.api.schemas.ChatAgentResponse(
+            conversation_id = conversation_id,
+            response        = "".join(chunks),
+            data            = service.structured_answer
+        )
+        yield f"event: end\ndata: {end.json()}\n\n"
+
+    return StreamingResponse(events(), media_type = "text/event-stream")
+
+########################################
+# WebSocket chat
+########################################
+# The open WebSocket chat sessions of the process.
+chat_channels = set()
+
+class ChatChannel:
+    """
+    Chat session of a WebSocket connection to a conversation.
+
+    The session of the conversation is loaded once and kept up to date with the turns of
+    the connection (and the summary once it's written), so the prompt of a turn is built
+    in memory. The turns run one at a time, in the order the messages are received.
+
+    The deltas of an answer are sent as fast as the client reads them: the completion
+    never waits for the client, the deltas produced while a send is in progress are
+    merged into the next one. A client that doesn't read for `WS_SEND_TIMEOUT` seconds,
+    or sends nothing (not even a `pong`) for `WS_HEARTBEAT_TIMEOUT` seconds, is
+    disconnected; the turn in progress still completes and is saved.
+    """
+    def __init__(self, websocket: WebSocket, session) -> None:
+        self.websocket = websocket
+        self.session = session
+        self.closed = False
+        # The summary of the conversation is being written, the session picks it up on
+        # the next turns.
+        self.summarizing = False
+        self.last_received = time.monotonic()
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, event: dict) -> bool:
+        """
+        Send an event to the client, false when the connection is closed.
+        """
+        if self.closed:
+            return False
+        try:
+            async with self._send_lock:
+                await asyncio.wait_for(self.websocket.send_text(json.dumps(event)), WS_SEND_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            log.warning("WebSocket client of conversation %s is not reading, closing", self.session.conversation_id)
+            await self.close(1008, "Not reading")
+        except Exception:
+            self.closed = True
+        return False
+
+    async def close(self, code: int = 1000, reason: str = None):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.websocket.close(code = code, reason = reason)
+        except Exception:
+            pass
+
+    async def run(self):
+        """
+        Answer the messages of the client until it disconnects.
+        """
+        queries = asyncio.Queue(maxsize = WS_MAX_PENDING)
+        receiver = asyncio.create_task(self._receive(queries))
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            await self.send({"type": "ready", "conversation_id": self.session.conversation_id})
+            while not self.closed:
+                query = await queries.get()
+                if query is None or self.closed:
+                    break
+                await self.turn(query)
+        finally:
+            receiver.cancel()
+            heartbeat.cancel()
+            await self.close()
+
+    async def _receive(self, queries: asyncio.Queue):
+        try:
+            while not self.closed:
+                try:
+                    event = await self.websocket.receive_json()
+                except (KeyError, ValueError):
+                    await self.send({"type": "error", "status": 400, "detail": "Expected a JSON text message."})
+                    continue
+                self.last_received = time.monotonic()
+                kind = event.get("type", "message") if isinstance(event, dict) else None
+                if kind == "pong":
+                    continue
+                if kind == "ping":
+                    await self.send({"type": "pong"})
+                    continue
+                message = event.get("message") if kind == "message" else None
+                if not isinstance(message, str) or not message:
+                    await self.send({"type": "error", "status": 422, "detail": "Expected {\"message\": \"string\"}."})
+                    continue
+                try:
+                    queries.put_nowait(message)
+                except asyncio.QueueFull:
+                    await self.send({"type": "error", "status": 429, "detail": f"At most {WS_MAX_PENDING} messages can wait for an answer."})
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            if not self.closed:
+                log.error(f"Exception occurred receiving from the WebSocket of conversation {self.session.conversation_id}: {e}")
+        finally:
+            self.closed = True
+            try:
+                queries.put_nowait(None)
+            except asyncio.QueueFull:
+                # The turns loop sees the connection closed on its next message.
+                pass
+
+    async def _heartbeat(self):
+        while not self.closed:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            if time.monotonic() - self.last_received > WS_HEARTBEAT_TIMEOUT:
+                log.info("WebSocket client of conversation %s timed out", self.session.conversation_id)
+                await self.close(4408, "Heartbeat timeout")
+                return
+            await self.send({"type": "ping"})
+
+    async def _refresh_summary(self):
+        """
+        Apply the summary of the conversation to the session once it's written.
+        """
+        db = SessionLocal()
+        try:
+            conversation = await run_in_threadpool(agents.crud.get_conversation, db, self.session.conversation_id)
+        finally:
+            db.close()
+        if conversation is not None and conversation.summary_until != self.session.summary_until:
+            self.session.fold(conversation.summary, conversation.summary_until)
+            self.summarizing = False
+
+    async def turn(self, query: str):
+        """
+        Answer a message of the client, streaming the deltas of the answer and then the
+        `end` event, like the Server-Sent Events of `/chat-agent/stream`.
+        """
+        if self.summarizing:
+            await self._refresh_summary()
+        db = SessionLocal()
+        try:
+            session, service, agent_prompt, should_summarize = await run_in_threadpool(build_chat_state, db, self.session, query)
+        except ContextLimitError as e:
+            await self.send({"type": "error", "status": 413, "detail": str(e)})
+            return
+        except UnknownProviderError as e:
+            await self.send({"type": "error", "status": 422, "detail": str(e)})
+            return
+        finally:
+            db.close()
+
+        chunks = []
+        produced = asyncio.Event()
+        finished = False
+
+        async def complete():
+            # NOTE: The completion runs in its own task, if the client disconnects the
+            # answer is still saved to the conversation.
+            nonlocal finished
+            start = time.perf_counter()
+            try:
+                async for delta in service.astream_answer_to_prompt(
+                    model               = agent_prompt["model"],
+                    prompt              = query,
+                    response_shape      = agent_prompt["response_shape"],
+                    **agent_prompt["params"]
+                ):
+                    if not chunks:
+                        metrics.stage_seconds.observe(time.perf_counter() - start, stage = "llm_first_token")
+                    chunks.append(delta)
+                    produced.set()
+                metrics.stage_seconds.observe(time.perf_counter() - start, stage = "llm")
+            except Exception as e:
+                log.error(f"Exception occurred while streaming the response: {e}")
+
+            response = "".join(chunks)
+            db_message = None
+            try:
+                if response:
+                    with metrics.stage("db_write"):
+                        db_message = await save_chat_message(session.conversation_id, query, response, agent_id = session.agent_id)
+                    self.session.append(db_message)
+                    log.info("Conversation message id %s saved to database", db_message.id)
+                self.summarizing = self.summarizing or should_summarize
+            finally:
+                finished = True
+                produced.set()
+            await enqueue_turn_jobs(session, db_message.id if db_message else None, should_summarize)
+
+        task = asyncio.create_task(complete())
+        _stream_tasks.add(task)
+        task.add_done_callback(_stream_tasks.discard)
+
+        sent = 0
+        while True:
+            if sent < len(chunks):
+                delta, sent = "".join(chunks[sent:]), len(chunks)
+                if not await self.send({"type": "delta", "delta": delta}):
+                    return
+                continue
+            if finished:
+                break
+            await produced.wait()
+            produced.clear()
+
+        end = agents.api.schemas.ChatAgentResponse(
+            conversation_id = session.conversation_id,
+            response        = "".join(chunks),
+            data            = service.structured_answer
+        )
+        await self.send({"type": "end", **end.dict()})
+
+@router.websocket("/ws/{conversation_id}")
+async def chat_websocket(websocket: WebSocket, conversation_id: str):
+    """
+    Chat with a conversation over a WebSocket, the session of the conversation is kept
+    for the life of the connection. The client sends JSON messages:
+    ```
+    {"type": "message", "message": "string"}
+    ```
+    and gets the answers streamed as events, the deltas and then the whole answer:
+    ```
+    {"type": "delta", "delta": "string"}
+    {"type": "end", "conversation_id": "string", "response": "string", "data": {}}
+    ```
+    The server sends `{"type": "ping"}` every `WS_HEARTBEAT_INTERVAL` seconds, answered
+    with `{"type": "pong"}`. Errors come as `{"type": "error", "status": 429, "detail": "string"}`
+    (413: the message doesn't fit the context of the model, 429: too many messages
+    waiting for an answer). The connection is closed with the code 1013 when the process
+    has `WS_MAX_SESSIONS` sessions open, and 4404 when the conversation doesn't exist.
+    """
+    await websocket.accept()
+    if len(chat_channels) >= WS_MAX_SESSIONS:
+        await websocket.close(code = 1013, reason = "Too many sessions, try again later")
+        return
+
+    # The slot is taken while the session loads.
+    placeholder = object()
+    chat_channels.add(placeholder)
+    try:
+        db = SessionLocal()
+        try:
+            session = await run_in_threadpool(get_chat_session, db, conversation_id)
+        finally:
+            db.close()
+        if session is None:
+            await websocket.close(code = 4404, reason = "Conversation not found")
+            return
+
+        log.info("WebSocket session opened for conversation id: %s", conversation_id)
+        # NOTE: The channel updates its own copy, the cached session is updated by the
+        # turns (`save_chat_message`) like for the other chat routes.
+        channel = ChatChannel(websocket, session.copy())
+        chat_channels.add(channel)
+        chat_channels.discard(placeholder)
+        try:
+            await channel.run()
+        finally:
+            chat_channels.discard(channel)
+        log.info("WebSocket session closed for conversation id: %s", conversation_id)
+    finally:
+        chat_channels.discard(placeholder)
@@ -1,6 +1,8 @@
 from datetime import datetime
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, validator
+
+from agentsfwrk.providers import get_provider_names
 
 
 ##########################################
@@ -15,6 +17,7 @@ class ConversationCreate(ConversationBase):
 class Conversation(ConversationBase):
     id: str
     timestamp: datetime = datetime.utcnow()
+    summary: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -24,14 +27,38 @@ class AgentBase(BaseModel):
     first_message   : str
     response_shape  : str
     instructions    : str
+    provider        : Optional[str] = None
+    model           : Optional[str] = None
+    params          : Optional[dict] = None
+
+def check_provider(provider: Optional[str]) -> Optional[str]:
+    """
+    Check the provider of an agent is one of the configured providers.
+    """
+    if provider is not None and provider not in get_provider_names():
+        raise ValueError(f"Unknown provider {provider!r}, use {', '.join(get_provider_names())}")
+    return provider
 
 class AgentCreate(AgentBase):
-    pass
+    _check_provider = validator("provider", allow_reuse = True)(check_provider)
+
+class AgentUpdate(BaseModel):
+    id              : str
+    context         : Optional[str] = None
+    first_message   : Optional[str] = None
+    response_shape  : Optional[str] = None
+    instructions    : Optional[str] = None
+    provider        : Optional[str] = None
+    model           : Optional[str] = None
+    params          : Optional[dict] = None
+
+    _check_provider = validator("provider", allow_reuse = True)(check_provider)
 
 class Agent(AgentBase):
     id: str
     timestamp: datetime = datetime.utcnow()
     conversations: List[Conversation] = []
+    conversation_count: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -51,9 +78,24 @@ class Message(MessageBase):
     class Config:
         orm_mode = True
 
+class MessageImport(MessageBase):
+    # Historical messages keep their timestamp, the others get the import time.
+    timestamp: Optional[datetime] = None
+
+class MessageBulkCreate(MessageImport):
+    conversation_id: str
+
+class ConversationImport(ConversationBase):
+    # A conversation can be imported with its transcript.
+    messages: List[MessageImport] = []
+
 ##########################################
 # API schemas
 ##########################################
+class BulkCreateResponse(BaseModel):
+    count: int
+    ids: List[str]
+
 class UserMessage(BaseModel):
     conversation_id: str
     message: str
@@ -61,3 +103,37 @@ class UserMessage(BaseModel):
 class ChatAgentResponse(BaseModel):
     conversation_id: str
     response: str
+    data: Optional[dict] = None
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    key: Optional[str] = None
+    payload: dict
+    status: str
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
+class JobLatency(BaseModel):
+    count: int
+    wait_p50: Optional[float] = None
+    wait_p95: Optional[float] = None
+    run_p50: Optional[float] = None
+    run_p95: Optional[float] = None
+
+class JobQueueStatus(BaseModel):
+    depth: int
+    max_queued: int
+    oldest_queued_seconds: Optional[float] = None
+    running_here: int
+    jobs: Dict[str, Dict[str, int]]
+    latency: Dict[str, JobLatency]
@@ -0,0 +1,272 @@
+import uuid
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from agents import models
+from agents.api import schemas
+from agents.tokens import count_turn_tokens
+
+# NOTE: Async versions of the functions in `agents.crud`, to use with the sessions from
+# `agents.database.AsyncSessionLocal`. The ids and timestamps are generated here, so the
+# created rows are returned without the extra round trip of a refresh.
+
+async def get_agents(db: AsyncSession, skip: int = 0, limit: int = None, include_conversations: bool = False):
+    """
+    Get the agents ordered by creation, paginated with `skip` and `limit`
+    """
+    query = select(models.Agent).order_by(models.Agent.timestamp, models.Agent.id)
+    if include_conversations:
+        query = query.options(selectinload(models.Agent.conversations))
+    result = await db.execute(query.offset(skip).limit(limit))
+
+    return result.scalars().all()
+
+async def count_conversations(db: AsyncSession, agent_ids: list) -> dict:
+    """
+    Get the number of conversations of each agent, in a single query
+    """
+    result = await db.execute(
+        select(models.Conversation.agent_id, func.count(models.Conversation.id))
+        .where(models.Conversation.agent_id.in_(agent_ids))
+        .group_by(models.Conversation.agent_id)
+    )
+
+    return dict(result.all())
+
+async def get_agent(db: AsyncSession, agent_id: str):
+    """
+    Get an agent by its id
+    """
+    return await db.get(models.Agent, agent_id)
+
+async def create_agent(db: AsyncSession, agent: schemas.AgentCreate):
+    """
+    Create an agent in the database
+    """
+    db_agent = models.Agent(
+        id              = str(uuid.uuid4()),
+        timestamp       = datetime.utcnow(),
+        context         = agent.context,
+        first_message   = agent.first_message,
+        response_shape  = agent.response_shape,
+        instructions    = agent.instructions,
+        provider        = agent.provider,
+        model           = agent.model,
+        params          = agent.params
+    )
+    db.add(db_agent)
+    await db.commit()
+
+    return db_agent
+
+async def get_conversation(db: AsyncSession, conversation_id: str):
+    """
+    Get a conversation by its id
+    """
+    return await db.get(models.Conversation, conversation_id)
+
+async def get_conversations(db: AsyncSession, agent_id: str):
+    """
+    Get all conversations for an agent
+    """
+    result = await db.execute(select(models.Conversation).where(models.Conversation.agent_id == agent_id))
+
+    return result.scalars().all()
+
+async def create_conversation(db: AsyncSession, conversation: schemas.ConversationCreate):
+    """
+    Create a conversation
+    """
+    db_conversation = models.Conversation(
+        id          = str(uuid.uuid4()),
+        timestap    = datetime.utcnow(),
+        agent_id    = conversation.agent_id,
+    )
+    db.add(db_conversation)
+    await db.commit()
+
+    return db_conversation
+
+async def get_last_messages(db: AsyncSession, conversation_id: str, limit: int, since = None):
+    """
+    Get the `limit` most recent messages of a conversation newer than `since`,
+    ordered by timestamp
+    """
+    query = select(models.Message).where(models.Message.conversation_id == conversation_id)
+    if since is not None:
+        query = query.where(models.Message.timestamp > since)
+    query = query.order_by(models.Message.timestamp.desc(), models.Message.id.desc()).limit(limit)
+    result = await db.execute(query)
+
+    return result.scalars().all()[::-1]
+
+async def create_conversation_message(db: AsyncSession, message: schemas.MessageCreate, conversation_id: str):
+    """
+    Create a message for a conversation
+    """
+    db_message = models.Message(
+        id              = str(uuid.uuid4()),
+        timestamp       = datetime.utcnow(),
+        user_message    = message.user_message,
+        agent_message   = message.agent_message,
+        tokens          = count_turn_tokens(message.user_message, message.agent_message),
+        conversation_id = conversation_id
+    )
+    db.add(db_message)
+    await db.commit()
+
+    return db_message
+
+async def create_messages(db: AsyncSession, messages: List[dict]):
+    """
+    Insert message rows (dicts with the columns of the messages table) in a single
+    transaction, using an executemany insert
+    """
+    if messages:
+        await db.execute(insert(models.Message), messages)
+        await db.commit()
+
+async def create_job(db: AsyncSession, kind: str, payload: dict, key: Optional[str], max_attempts: int, run_at: datetime = None):
+    """
+    Create a queued job. With a `key` already used by a job, that job is returned
+    instead, queued again if it had failed
+    """
+    now = datetime.utcnow()
+    # NOTE: The jobs of a key are looked up before the insert, the turns of a conversation
+    # share their summary job. The unique key only settles the race of two inserts: with
+    # aiosqlite the failed insert can keep its cursor alive (in the cycle of the exception
+    # traceback) and the garbage collector reset it from the event loop, blocking it while
+    # the connection waits for the database lock.
+    if key is not None and (db_job := await _get_job_by_key(db, key)) is not None:
+        return await _requeue_failed_job(db, db_job, payload, max_attempts, run_at or now, now)
+
+    db_job = models.Job(
+        id              = str(uuid.uuid4()),
+        kind            = kind,
+        key             = key,
+        payload         = payload,
+        status          = "queued",
+        attempts        = 0,
+        max_attempts    = max_attempts,
+        run_at          = run_at or now,
+        created_at      = now
+    )
+    db.add(db_job)
+    try:
+        await db.commit()
+        return db_job, True
+    except IntegrityError:
+        if key is None:
+            raise
+        await db.rollback()
+
+    return await _requeue_failed_job(db, await _get_job_by_key(db, key), payload, max_attempts, run_at or now, now)
+
+async def _get_job_by_key(db: AsyncSession, key: str):
+    result = await db.execute(select(models.Job).where(models.Job.key == key))
+
+    return result.scalars().first()
+
+async def _requeue_failed_job(db: AsyncSession, db_job: models.Job, payload: dict, max_attempts: int, run_at: datetime, now: datetime):
+    if db_job.status == "failed":
+        db_job.status       = "queued"
+        db_job.payload      = payload
+        db_job.attempts     = 0
+        db_job.max_attempts = max_attempts
+        db_job.run_at       = run_at
+        db_job.created_at   = now
+        db_job.started_at   = db_job.finished_at = db_job.lease = db_job.error = None
+        await db.commit()
+        return db_job, True
+
+    return db_job, False
+
+async def get_job(db: AsyncSession, job_id: str):
+    """
+    Get a job by its id
+    """
+    return await db.get(models.Job, job_id)
+
+async def claim_jobs(db: AsyncSession, limit: int, lease: str, lease_until: datetime):
+    """
+    Take up to `limit` jobs ready to run: the queued ones whose time has come, and
+    the running ones whose lease expired (their worker is gone). They are marked as
+    running with the `lease` until `lease_until`, in a single statement so two workers
+    never take the same job
+    """
+    now = datetime.utcnow()
+    claimable = (models.Job.status.in_(("queued", "running")), models.Job.run_at <= now)
+    ready = select(models.Job.id).where(*claimable).order_by(models.Job.run_at).limit(limit)
+    result = await db.execute(
+        update(models.Job)
+        .where(models.Job.id.in_(ready), *claimable)
+        .values(status = "running", lease = lease, run_at = lease_until, started_at = now, attempts = models.Job.attempts + 1)
+        .returning(models.Job)
+        .execution_options(synchronize_session = False)
+    )
+    jobs = result.scalars().all()
+    await db.commit()
+
+    return jobs
+
+async def finish_job(db: AsyncSession, job_id: str, lease: str, **values) -> bool:
+    """
+    Release a job run under `lease`, updating it (e.g. as done, or queued again for a
+    retry). Returns false when the lease expired and the job was taken over by another
+    worker
+    """
+    result = await db.execute(
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.lease == lease)
+        .values(lease = None, **values)
+        .execution_options(synchronize_session = False)
+    )
+    await db.commit()
+
+    return result.rowcount == 1
+
+async def count_jobs(db: AsyncSession, status: str = None) -> dict:
+    """
+    Get the number of jobs of each kind and status, of a status if given
+    """
+    query = select(models.Job.kind, models.Job.status, func.count(models.Job.id)).group_by(models.Job.kind, models.Job.status)
+    if status is not None:
+        query = query.where(models.Job.status == status)
+    result = await db.execute(query)
+
+    return {(kind, job_status): count for kind, job_status, count in result.all()}
+
+async def oldest_queued_job(db: AsyncSession) -> Optional[datetime]:
+    """
+    Get the creation time of the oldest job waiting to run
+    """
+    result = await db.execute(select(func.min(models.Job.created_at)).where(models.Job.status == "queued"))
+
+    return result.scalar()
+
+async def get_finished_jobs(db: AsyncSession, limit: int):
+    """
+    Get the kind and times of the `limit` most recently finished jobs
+    """
+    result = await db.execute(
+        select(models.Job.kind, models.Job.status, models.Job.created_at, models.Job.started_at, models.Job.finished_at)
+        .where(models.Job.finished_at.is_not(None))
+        .order_by(models.Job.finished_at.desc())
+        .limit(limit)
+    )
+
+    return result.all()
+
+async def delete_finished_jobs(db: AsyncSession, before: datetime) -> int:
+    """
+    Delete the jobs finished (done or failed) before a time
+    """
+    result = await db.execute(delete(models.Job).where(models.Job.finished_at < before))
+    await db.commit()
+
+    return result.rowcount
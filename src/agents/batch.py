@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+from fastapi.concurrency import run_in_threadpool
+
+from agents.api.routes import load_chat_state, save_chat_message
+from agents.database import SessionLocal, dispose_engines
+from agents.history import summarize_history
+from agents.memory import message_memory
+from agents.writer import message_writer
+from agentsfwrk.integrations import FALLBACK_ANSWER
+from agentsfwrk.providers import close_aiosession
+from agentsfwrk.logger import get_multiprocessing_logger
+
+# Offline processing of chat turns and goal verifications, see `run_batch`:
+#     python -m agents.batch items.jsonl --output results.jsonl --concurrency 32 --processes 4
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 16))
+BATCH_CHECKPOINT_EVERY = int(os.getenv("BATCH_CHECKPOINT_EVERY", 100))
+
+TASKS = ("chat", "verify")
+
+def read_items(path: str) -> List[dict]:
+    """
+    Read the items of a batch, one JSON object per line:
+    ```
+    {"id": "string", "conversation_id": "string", "message": "string", "task": "chat"}
+    ```
+    `task` is `chat` (the default) or `verify`, the goal verification of the conversation
+    (no message needed). The items without `id` get their line number.
+    """
+    items = []
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(number))
+            item["id"] = str(item["id"])
+            item.setdefault("task", "chat")
+            if item["task"] not in TASKS:
+                raise ValueError(f"Line {number}: unknown task {item['task']!r}, use {', '.join(TASKS)}")
+            if "conversation_id" not in item or (item["task"] == "chat" and "message" not in item):
+                raise ValueError(f"Line {number}: missing conversation_id or message")
+            items.append(item)
+
+    return items
+
+def read_done(path: str) -> set:
+    """
+    Get the ids of the items already in the results file of a previous run.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                # A line cut by a crash, its item runs again.
+                continue
+
+    return done
+
+def group_by_conversation(items: List[dict]) -> Dict[str, List[dict]]:
+    """
+    Group the items by conversation, keeping their order within each conversation.
+    """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(item["conversation_id"], []).append(item)
+
+    return groups
+
+async def process_item(item: dict, log) -> dict:
+    """
+    Run an item: a chat turn, saved to the conversation like the ones of the chat
+    route, or a goal verification. The errors are returned in the result.
+    """
+    start = time.perf_counter()
+    result = {"id": item["id"], "conversation_id": item["conversation_id"], "task": item["task"]}
+    db = SessionLocal()
+    try:
+        session, service, agent_prompt, should_summarize = await run_in_threadpool(
+            load_chat_state, db, item["conversation_id"], item.get("message")
+        )
+        if session is None:
+            raise LookupError("Conversation not found")
+
+        if item["task"] == "verify":
+            result["data"] = await service.averify_goal_conversation(agent_prompt["model"], **agent_prompt["params"])
+        else:
+            response = await service.aanswer_to_prompt(
+                model           = agent_prompt["model"],
+                prompt          = item["message"],
+                response_shape  = agent_prompt["response_shape"],
+                **agent_prompt["params"]
+            )
+            # Unlike the chat route, the failed turns are not saved, they can run again.
+            if response.get("answer") == FALLBACK_ANSWER:
+                raise RuntimeError("The completion failed")
+            await save_chat_message(session.conversation_id, item["message"], response.get("answer"), agent_id = session.agent_id)
+            result["response"] = response.get("answer")
+            result["data"] = response.get("data")
+            if should_summarize:
+                await summarize_history(session.conversation_id)
+    except Exception as e:
+        log.error(f"Item {item['id']} failed: {e}")
+        result["error"] = str(e)
+    finally:
+        db.close()
+    result["elapsed"] = time.perf_counter() - start
+
+    return result
+
+async def run_shard(groups: Dict[str, List[dict]], concurrency: int, checkpoint_every: int, emit: Callable[[list], None], log):
+    """
+    Run the items of some conversations: `concurrency` conversations at a time, the
+    items of each one in order. Every `checkpoint_every` items the results are passed to
+    `emit`, once the messages of their turns are written to the database.
+    """
+    await message_writer.start()
+    conversations = asyncio.Queue()
+    for items in groups.values():
+        conversations.put_nowait(items)
+    results = []
+
+    async def checkpoint():
+        batch = results[:]
+        results.clear()
+        await message_writer.drain()
+        if batch:
+            emit(batch)
+
+    async def worker():
+        while not conversations.empty():
+            for item in conversations.get_nowait():
+                results.append(await process_item(item, log))
+                if len(results) >= checkpoint_every:
+                    await checkpoint()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        await checkpoint()
+    finally:
+        # Like the app shutdown: flush the queued messages before closing the connections.
+        await message_writer.stop()
+        await run_in_threadpool(message_memory.close)
+        await close_aiosession()
+        await dispose_engines()
+
+def _run_process(groups: Dict[str, List[dict]], concurrency: int, checkpoint_every: int, results: multiprocessing.Queue, log_file: str):
+    log = get_multiprocessing_logger(log_file)
+    try:
+        asyncio.run(run_shard(groups, concurrency, checkpoint_every, results.put, log))
+    finally:
+        results.put(None)
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    concurrency: int = BATCH_CONCURRENCY,
+    processes: int = 1,
+    checkpoint_every: int = BATCH_CHECKPOINT_EVERY,
+    log_file: str = None
+) -> dict:
+    """
+    Run the items of a batch file (see `read_items`) and append their results to
+    `output_path`, one JSON object per line.
+
+    The conversations are split between `processes`, each running `concurrency` of them
+    at a time; the items of a conversation run in order. The results are the checkpoint:
+    a run resumes by skipping the items already in the output. An item can run twice
+    if the job stops between saving its message and writing its result.
+    """
+    log = get_multiprocessing_logger(log_file)
+    items = read_items(input_path)
+    done = read_done(output_path)
+    groups = group_by_conversation([item for item in items if item["id"] not in done])
+    log.info(f"Batch of {len(items)} items, {len(done)} already done, {len(groups)} conversations to process")
+
+    stats = {"processed": 0, "errors": 0}
+    start = time.perf_counter()
+    with open(output_path, "a") as output:
+        if output.tell():
+            with open(output_path, "rb") as previous:
+                previous.seek(-1, os.SEEK_END)
+                if previous.read(1) != b"\n":
+                    # End the line cut by a crash, so the results don't get appended to it.
+                    output.write("\n")
+
+        def write(results: list):
+            for result in results:
+                output.write(json.dumps(result, default = str) + "\n")
+                stats["errors"] += "error" in result
+            output.flush()
+            os.fsync(output.fileno())
+            stats["processed"] += len(results)
+            log.info(f"Checkpoint: {stats['processed']} items processed ({stats['errors']} errors)")
+
+        if processes <= 1:
+            asyncio.run(run_shard(groups, concurrency, checkpoint_every, write, log))
+        else:
+            # The conversations are sharded by id, each process writes its messages and
+            # sends its results here, to a single writer of the output.
+            shards = [OrderedDict() for _ in range(processes)]
+            for conversation_id, conversation_items in groups.items():
+                shards[zlib.crc32(conversation_id.encode()) % processes][conversation_id] = conversation_items
+            context = multiprocessing.get_context("spawn")
+            results = context.Queue()
+            workers = [
+                context.Process(target = _run_process, args = (shard, concurrency, checkpoint_every, results, log_file))
+                for shard in shards if shard
+            ]
+            for worker in workers:
+                worker.start()
+            running = len(workers)
+            while running:
+                try:
+                    batch = results.get(timeout = 1)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers) and results.empty():
+                        log.error("The batch processes exited without finishing")
+                        break
+                    continue
+                if batch is None:
+                    running -= 1
+                else:
+                    write(batch)
+            for worker in workers:
+                worker.join()
+
+    stats["elapsed"] = time.perf_counter() - start
+    log.info(
+        f"Batch done: {stats['processed']} items in {stats['elapsed']:.1f}s "
+        f"({stats['processed'] / max(stats['elapsed'], 1e-9):.1f} items/s, {stats['errors']} errors)"
+    )
+
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run chat turns and goal verifications offline")
+    parser.add_argument("input", help = "JSONL file of items: conversation_id, message, and optionally id and task")
+    parser.add_argument("--output", help = "JSONL file of the results, also the checkpoint to resume from")
+    parser.add_argument("--concurrency", type = int, default = BATCH_CONCURRENCY, help = "Conversations run at a time, per process")
+    parser.add_argument("--processes", type = int, default = 1)
+    parser.add_argument("--checkpoint-every", type = int, default = BATCH_CHECKPOINT_EVERY, help = "Items between checkpoints")
+    parser.add_argument("--log-file")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+    run_batch(args.input, output, args.concurrency, args.processes, args.checkpoint_every, args.log_file)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,36 @@
 import uuid
-from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import func, insert, or_
+from sqlalchemy.orm import Session, selectinload
 from agents import models
 from agents.api import schemas
+from agents.tokens import count_turn_tokens
+
+def get_agents(db: Session, skip: int = 0, limit: int = None, include_conversations: bool = False):
+    """
+    Get the agents ordered by creation, paginated with `skip` and `limit`.
+    With `include_conversations` their conversations are loaded in a single extra
+    query, instead of one lazy load per agent.
+    """
+    query = db.query(models.Agent).order_by(models.Agent.timestamp, models.Agent.id)
+    if include_conversations:
+        query = query.options(selectinload(models.Agent.conversations))
+
+    return query.offset(skip).limit(limit).all()
 
-def get_agents(db: Session):
+def count_conversations(db: Session, agent_ids: list) -> dict:
     """
-    Get all agents
+    Get the number of conversations of each agent, in a single query
     """
-    return db.query(models.Agent).all()
+    counts = db.query(
+        models.Conversation.agent_id, func.count(models.Conversation.id)
+    ).filter(
+        models.Conversation.agent_id.in_(agent_ids)
+    ).group_by(models.Conversation.agent_id).all()
+
+    return dict(counts)
 
 def get_agent(db: Session, agent_id: str):
     """
@@ -24,7 +47,10 @@ def create_agent(db: Session, agent: schemas.AgentCreate):
         context         = agent.context,
         first_message   = agent.first_message,
         response_shape  = agent.response_shape,
-        instructions    = agent.instructions
+        instructions    = agent.instructions,
+        provider        = agent.provider,
+        model           = agent.model,
+        params          = agent.params
     )
     db.add(db_agent)
     db.commit()
@@ -32,6 +58,22 @@ def create_agent(db: Session, agent: schemas.AgentCreate):
 
     return db_agent
 
+def update_agent(db: Session, agent: schemas.AgentUpdate):
+    """
+    Update the given fields of an agent in the database.
+    Returns None if the agent doesn't exist.
+    """
+    db_agent = get_agent(db, agent.id)
+    if db_agent is None:
+        return None
+
+    for field, value in agent.dict(exclude = {"id"}, exclude_none = True).items():
+        setattr(db_agent, field, value)
+    db.commit()
+    db.refresh(db_agent)
+
+    return db_agent
+
 def get_conversation(db: Session, conversation_id: str):
     """
     Get a conversation by its id
@@ -58,11 +100,123 @@ def create_conversation(db: Session, conversation: schemas.ConversationCreate):
 
     return db_conversation
 
-def get_messages(db: Session, conversation_id: str):
+def get_message(db: Session, message_id: str):
+    """
+    Get a message by its id
+    """
+    return db.query(models.Message).filter(models.Message.id == message_id).first()
+
+def get_messages_by_ids(db: Session, message_ids: list):
+    """
+    Get messages by their ids, in no particular order
+    """
+    return db.query(models.Message).filter(models.Message.id.in_(message_ids)).all()
+
+def _messages_before(query, cursor: models.Message):
+    """
+    Filter the messages older than the cursor, ordered by (timestamp, id)
+    """
+    return query.filter(
+        models.Message.timestamp <= cursor.timestamp,
+        or_(models.Message.timestamp < cursor.timestamp, models.Message.id < cursor.id)
+    )
+
+def _messages_after(query, cursor: models.Message):
+    """
+    Filter the messages newer than the cursor, ordered by (timestamp, id)
+    """
+    return query.filter(
+        models.Message.timestamp >= cursor.timestamp,
+        or_(models.Message.timestamp > cursor.timestamp, models.Message.id > cursor.id)
+    )
+
+def _message_key(message: models.Message):
+    return (message.timestamp, message.id)
+
+def get_messages(db: Session, conversation_id: str, before: str = None, after: str = None, limit: int = None, pending: list = None):
+    """
+    Get the messages for a conversation ordered by timestamp.
+
+    Supports keyset pagination: `before` and `after` are message ids used as cursors,
+    only the messages older (or newer) than them are returned. With `limit`, the page
+    holds the messages right after `after` or, otherwise, the most recent ones.
+    Returns an empty list if a cursor doesn't belong to the conversation.
+
+    The `pending` messages (queued but maybe not written yet, see `agents.writer`) are
+    paginated along with the stored ones, and can be cursors.
+    """
+    pending = [mes for mes in pending or [] if mes.conversation_id == conversation_id]
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    for cursor_id, paginate, keep in (
+        (before, _messages_before, lambda key, cursor_key: key < cursor_key),
+        (after, _messages_after, lambda key, cursor_key: key > cursor_key)
+    ):
+        if cursor_id is None:
+            continue
+        cursor = get_message(db, cursor_id) or next((mes for mes in pending if mes.id == cursor_id), None)
+        if cursor is None or cursor.conversation_id != conversation_id:
+            return []
+        query = paginate(query, cursor)
+        pending = [mes for mes in pending if keep(_message_key(mes), _message_key(cursor))]
+
+    if limit is None or after is not None:
+        query = query.order_by(models.Message.timestamp, models.Message.id)
+        messages = query.limit(limit).all()
+    else:
+        # Take the tail of the conversation, newest first, and give it back in order.
+        query = query.order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+        messages = query.limit(limit).all()[::-1]
+    if not pending:
+        return messages
+
+    stored = {mes.id for mes in messages}
+    messages += [mes for mes in pending if mes.id not in stored]
+    messages.sort(key = _message_key)
+    if limit is not None:
+        messages = messages[:limit] if after is not None else messages[-limit:]
+    return messages
+
+def get_last_messages(db: Session, conversation_id: str, limit: int, since = None):
     """
-    Get all messages for a conversation
+    Get the `limit` most recent messages of a conversation newer than `since`,
+    ordered by timestamp
     """
-    return db.query(models.Message).filter(models.Message.conversation_id == conversation_id).all()
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if since is not None:
+        query = query.filter(models.Message.timestamp > since)
+    query = query.order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+
+    return query.limit(limit).all()[::-1]
+
+def get_first_messages(db: Session, conversation_id: str, limit: int, since = None):
+    """
+    Get the `limit` oldest messages of a conversation newer than `since`,
+    ordered by timestamp
+    """
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if since is not None:
+        query = query.filter(models.Message.timestamp > since)
+    query = query.order_by(models.Message.timestamp.asc(), models.Message.id.asc())
+
+    return query.limit(limit).all()
+
+def update_conversation_summary(db: Session, conversation_id: str, summary: str, summary_until, previous_until = None):
+    """
+    Update the rolling summary of a conversation. The update only applies if the
+    summary still covers up to `previous_until`, so concurrent updates don't overwrite
+    each other. Returns whether the summary was updated.
+    """
+    updated = db.query(models.Conversation).filter(
+        models.Conversation.id == conversation_id,
+        models.Conversation.summary_until.is_(None) if previous_until is None
+        else models.Conversation.summary_until == previous_until
+    ).update(
+        {"summary": summary, "summary_until": summary_until},
+        synchronize_session = False
+    )
+    db.commit()
+
+    return updated > 0
 
 def create_conversation_message(db: Session, message: schemas.MessageCreate, conversation_id: str):
     """
@@ -72,6 +226,7 @@ def create_conversation_message(db: Session, message: schemas.MessageCreate, con
         id              = str(uuid.uuid4()),
         user_message    = message.user_message,
         agent_message   = message.agent_message,
+        tokens          = count_turn_tokens(message.user_message, message.agent_message),
         conversation_id = conversation_id
     )
     db.add(db_message)
@@ -79,3 +234,88 @@ def create_conversation_message(db: Session, message: schemas.MessageCreate, con
     db.refresh(db_message)
 
     return db_message
+
+########################################
+# Bulk inserts
+########################################
+# NOTE: The bulk functions insert plain rows with an executemany insert in a single
+# transaction, no ORM objects are built. The ids and timestamps are generated here.
+
+def _timestamps(count: int) -> list:
+    # Increasing timestamps, so the rows of a batch keep their order when sorted.
+    now = datetime.utcnow()
+    return [now + timedelta(microseconds = i) for i in range(count)]
+
+def missing_ids(db: Session, model, ids: set, chunk_size: int = 1000) -> set:
+    """
+    Get the ids (of agents, conversations...) that don't exist, querying them in chunks
+    to stay under the limit of bound parameters
+    """
+    ids = list(ids)
+    found = set()
+    for start in range(0, len(ids), chunk_size):
+        found.update(row[0] for row in db.query(model.id).filter(model.id.in_(ids[start:start + chunk_size])))
+
+    return set(ids) - found
+
+def create_agents(db: Session, agents: List[schemas.AgentCreate]) -> List[str]:
+    """
+    Create agents in a single transaction, returns their ids in order
+    """
+    rows = [
+        {"id": str(uuid.uuid4()), "timestamp": timestamp, **agent.dict()}
+        for agent, timestamp in zip(agents, _timestamps(len(agents)))
+    ]
+    if rows:
+        db.execute(insert(models.Agent), rows)
+        db.commit()
+
+    return [row["id"] for row in rows]
+
+def message_rows(messages: list, conversation_id: str = None) -> List[dict]:
+    """
+    Build the rows of messages to insert, `conversation_id` is used for the messages
+    that don't have their own. The messages without timestamp get the current time.
+    """
+    timestamps = _timestamps(len(messages))
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "timestamp": getattr(mes, "timestamp", None) or timestamp,
+            "user_message": mes.user_message,
+            "agent_message": mes.agent_message,
+            "tokens": count_turn_tokens(mes.user_message, mes.agent_message),
+            "conversation_id": getattr(mes, "conversation_id", None) or conversation_id,
+        }
+        for mes, timestamp in zip(messages, timestamps)
+    ]
+
+def create_messages(db: Session, messages: List[dict], commit: bool = True):
+    """
+    Insert message rows (dicts with the columns of the messages table) in a single
+    transaction, using an executemany insert
+    """
+    if messages:
+        db.execute(insert(models.Message), messages)
+        if commit:
+            db.commit()
+
+def create_conversations(db: Session, conversations: List[schemas.ConversationImport]) -> List[str]:
+    """
+    Create conversations, with the messages of their transcripts, in a single
+    transaction. Returns the ids of the conversations in order.
+    """
+    rows = [
+        {"id": str(uuid.uuid4()), "timestap": timestamp, "agent_id": conversation.agent_id}
+        for conversation, timestamp in zip(conversations, _timestamps(len(conversations)))
+    ]
+    if not rows:
+        return []
+    messages = []
+    for conversation, row in zip(conversations, rows):
+        messages += message_rows(getattr(conversation, "messages", []), row["id"])
+    db.execute(insert(models.Conversation), rows)
+    create_messages(db, messages, commit = False)
+    db.commit()
+
+    return [row["id"] for row in rows]
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Iterator, List
+
+from sqlalchemy import select
+
+import agents.models
+from agents.database import engine
+
+# Streaming export of the conversations and messages, see `export_chunks`:
+#     python -m agents.export messages --agent-id <id> --since 2023-06-01 --format parquet --output messages.parquet
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+
+FORMATS = ("ndjson", "parquet")
+
+def _messages_query(agent_id: str = None, since: datetime = None, until: datetime = None):
+    Message, Conversation = agents.models.Message, agents.models.Conversation
+    query = select(
+        Message.id, Message.conversation_id, Conversation.agent_id, Message.timestamp,
+        Message.user_message, Message.agent_message
+    ).join(Conversation, Message.conversation_id == Conversation.id)
+    if agent_id is not None:
+        query = query.where(Conversation.agent_id == agent_id)
+    if since is not None:
+        query = query.where(Message.timestamp >= since)
+    if until is not None:
+        query = query.where(Message.timestamp < until)
+
+    return query.order_by(Message.conversation_id, Message.timestamp, Message.id)
+
+def _conversations_query(agent_id: str = None, since: datetime = None, until: datetime = None):
+    Conversation = agents.models.Conversation
+    query = select(
+        Conversation.id, Conversation.agent_id, Conversation.timestap.label("timestamp"),
+        Conversation.summary, Conversation.summary_until
+    )
+    if agent_id is not None:
+        query = query.where(Conversation.agent_id == agent_id)
+    if since is not None:
+        query = query.where(Conversation.timestap >= since)
+    if until is not None:
+        query = query.where(Conversation.timestap < until)
+
+    return query.order_by(Conversation.agent_id, Conversation.timestap, Conversation.id)
+
+EXPORTS = {
+    "messages": _messages_query,
+    "conversations": _conversations_query,
+}
+
+def export_chunks(
+    table: str,
+    agent_id: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[List[dict]]:
+    """
+    Get the rows of `messages` (with the agent of their conversation) or `conversations`,
+    of an agent and created in [`since`, `until`), in chunks of `chunk_size` rows.
+
+    The rows come from a server-side cursor (`stream_results`), only a chunk is held in
+    memory at a time, whatever the size of the export.
+
+    NOTE: The connection stays checked out, in a single read transaction, until the
+    generator is exhausted or closed. The messages still in the write-behind queue
+    are not exported yet.
+    """
+    query = EXPORTS[table](agent_id, since, until)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results = True, yield_per = chunk_size).execute(query)
+        for partition in result.mappings().partitions(chunk_size):
+            yield [dict(row) for row in partition]
+
+def _json_default(value):
+    # The timestamps in ISO format, like in the responses of the API.
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def ndjson_chunks(chunks: Iterator[List[dict]]) -> Iterator[bytes]:
+    """
+    Encode chunks of rows as NDJSON, a block of lines per chunk.
+    """
+    for rows in chunks:
+        yield "".join(json.dumps(row, default = _json_default) + "\n" for row in rows).encode()
+
+class _ChunkSink:
+    # Writable file-like that keeps the bytes written until they are taken, so a Parquet
+    # file can be streamed as its row groups are written.
+    def __init__(self) -> None:
+        self.closed = False
+        self._buffer = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._buffer.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        return data
+
+def _arrow_schema(table: str):
+    import pyarrow as pa
+
+    types = {str: pa.string(), datetime: pa.timestamp("us")}
+    columns = EXPORTS[table]().selected_columns
+
+    return pa.schema([(column.name, types[column.type.python_type]) for column in columns])
+
+def parquet_chunks(table: str, chunks: Iterator[List[dict]]) -> Iterator[bytes]:
+    """
+    Encode chunks of rows of `table` as a Parquet file, a row group per chunk (needs
+    `pyarrow`). The bytes are given as soon as each row group is written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(table)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_pylist(rows, schema = schema))
+            yield sink.take()
+    # The footer, written on close.
+    yield sink.take()
+
+def encode_chunks(table: str, chunks: Iterator[List[dict]], format: str = "ndjson") -> Iterator[bytes]:
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, use {', '.join(FORMATS)}")
+    return parquet_chunks(table, chunks) if format == "parquet" else ndjson_chunks(chunks)
+
+def export(table: str, output, format: str = "ndjson", **filters) -> int:
+    """
+    Write an export to a binary file object, returns the number of bytes written.
+    """
+    written = 0
+    for data in encode_chunks(table, export_chunks(table, **filters), format):
+        output.write(data)
+        written += len(data)
+
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description = "Export the conversations or messages, streamed from the database")
+    parser.add_argument("table", choices = list(EXPORTS))
+    parser.add_argument("--agent-id")
+    parser.add_argument("--since", type = datetime.fromisoformat, help = "ISO date or datetime (UTC), included")
+    parser.add_argument("--until", type = datetime.fromisoformat, help = "ISO date or datetime (UTC), excluded")
+    parser.add_argument("--format", choices = FORMATS, default = "ndjson")
+    parser.add_argument("--output", help = "File to write, the standard output by default")
+    parser.add_argument("--chunk-size", type = int, default = EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    filters = dict(agent_id = args.agent_id, since = args.since, until = args.until, chunk_size = args.chunk_size)
+    if args.output:
+        with open(args.output, "wb") as output:
+            export(args.table, output, args.format, **filters)
+    else:
+        export(args.table, sys.stdout.buffer, args.format, **filters)
+
+if __name__ == "__main__":
+    main()
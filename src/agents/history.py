@@ -0,0 +1,231 @@
+import os
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+import agents.crud
+from agents.database import SessionLocal
+from agents.memory import craft_memory_message
+from agents.tokens import ContextLimitError, budget_max_tokens, message_tokens
+from agents.sessions import ConversationSession, session_cache
+from agentsfwrk import integrations, logger
+from agentsfwrk.providers import get_provider
+
+log = logger.get_logger(__name__)
+
+SUMMARY_MODEL = os.getenv('HISTORY_SUMMARY_MODEL', 'gpt-3.5-turbo')
+# The summaries can go to a cheaper (e.g. local) provider than the chat, see `agentsfwrk.providers`.
+SUMMARY_PROVIDER = os.getenv('HISTORY_SUMMARY_PROVIDER')
+SUMMARY_MAX_TOKENS = 300
+
+class ContextWindowPolicy:
+    """
+    Controls how much of a conversation history is replayed into the prompt.
+
+    - `max_messages`: most recent messages (user/agent interactions) kept verbatim.
+    - `max_tokens`: token budget for the verbatim messages, older ones are dropped first.
+    - `summarize_batch`: older messages are folded into the conversation summary once
+      this many of them are out of the window, so summarization runs once per batch
+      and not on every turn.
+    """
+    def __init__(
+        self,
+        max_messages: int = None,
+        max_tokens: int = None,
+        summarize_batch: int = None
+    ) -> None:
+
+        self.max_messages = max_messages or int(os.getenv('HISTORY_MAX_MESSAGES', 10))
+        self.max_tokens = max_tokens or int(os.getenv('HISTORY_MAX_TOKENS', 2000))
+        self.summarize_batch = summarize_batch or int(os.getenv('HISTORY_SUMMARIZE_BATCH', 10))
+
+default_policy = ContextWindowPolicy()
+
+def craft_summary_message(summary: str) -> dict:
+    """
+    Craft the message carrying the summary of the earlier conversation.
+    """
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation with the user: {summary}"
+    }
+
+def select_window(messages: list, policy: ContextWindowPolicy = default_policy, tokens: list = None) -> list:
+    """
+    Select the most recent messages that fit in the policy, walking from the newest
+    message back until either limit is reached. The token counts of the messages
+    are the stored ones unless given in `tokens`.
+    """
+    window = []
+    total = 0
+    for index in range(len(messages) - 1, -1, -1):
+        mes = messages[index]
+        mes_tokens = tokens[index] if tokens is not None else message_tokens(mes)
+        if len(window) >= policy.max_messages or total + mes_tokens > policy.max_tokens:
+            break
+        window.append(mes)
+        total += mes_tokens
+    window.reverse()
+
+    return window
+
+def _get_unsummarized_tail(db: Session, conversation_id: str, summary_until, policy: ContextWindowPolicy):
+    """
+    Load the most recent unsummarized messages, enough to fill the window and to know
+    whether a batch of messages is ready to be folded into the summary.
+    """
+    return agents.crud.get_last_messages(
+        db,
+        conversation_id,
+        limit = policy.max_messages + policy.summarize_batch,
+        since = summary_until
+    )
+
+def load_session(db: Session, conversation, policy: ContextWindowPolicy = default_policy, pending: list = None) -> ConversationSession:
+    """
+    Load the session of a conversation: its summary and the tail of the messages newer
+    than the summary. Only the tail is loaded, bounded by the policy, so the cost doesn't
+    grow with the conversation. The `pending` messages, queued but maybe not written
+    yet, are added to it.
+    """
+    messages = _get_unsummarized_tail(db, conversation.id, conversation.summary_until, policy)
+    if pending:
+        stored = {mes.id for mes in messages}
+        messages += [mes for mes in pending if mes.id not in stored]
+
+    return ConversationSession(conversation, messages, max_messages = policy.max_messages + policy.summarize_batch)
+
+def build_history(session: ConversationSession, policy: ContextWindowPolicy = default_policy, memories: list = None, recent_messages: int = None):
+    """
+    Build the chat messages replaying the conversation history of a session within the policy.
+    Returns the chat messages and whether there are enough messages out of the window
+    to fold them into the summary.
+
+    With `memories`, the past messages recalled for the user message (see
+    `agents.memory`), only the `recent_messages` most recent messages of the window are
+    replayed, after the recalled ones. When nothing is recalled the whole window is replayed.
+    """
+    messages = session.messages
+    window = select_window(messages, policy, session.tokens)
+    should_summarize = len(messages) - len(window) >= policy.summarize_batch
+
+    chat_messages = []
+    if session.summary:
+        chat_messages.append(craft_summary_message(session.summary))
+    if memories:
+        window = window[len(window) - min(recent_messages, len(window)):]
+        chat_messages.append(craft_memory_message(memories))
+    for mes in window:
+        chat_messages.append(
+            {
+                "role": "user",
+                "content": mes.user_message
+            }
+        )
+        chat_messages.append(
+            {
+                "role": "assistant",
+                "content": mes.agent_message
+            }
+        )
+
+    log.debug("Conversation history: %d of %d unsummarized messages in the window", len(window), len(messages))
+
+    return chat_messages, should_summarize
+
+def _get_messages_to_fold(conversation_id: str, policy: ContextWindowPolicy):
+    """
+    Load the conversation and the oldest unsummarized messages out of the window, at
+    most a batch of them, so the summary always covers the conversation up to a point.
+    """
+    db = SessionLocal()
+    try:
+        conversation = agents.crud.get_conversation(db, conversation_id)
+        window = select_window(
+            agents.crud.get_last_messages(db, conversation_id, limit = policy.max_messages, since = conversation.summary_until),
+            policy
+        )
+        in_window = {mes.id for mes in window}
+        oldest = agents.crud.get_first_messages(
+            db,
+            conversation_id,
+            limit = policy.summarize_batch + 1,
+            since = conversation.summary_until
+        )
+        out_of_window = [mes for mes in oldest if mes.id not in in_window]
+        to_fold = out_of_window[:policy.summarize_batch]
+        following = out_of_window[len(to_fold):] + window
+        # NOTE: The summary covers the messages up to a timestamp, the messages sharing
+        # the timestamp of the first message left out are kept for the next batch.
+        while to_fold and following and to_fold[-1].timestamp >= following[0].timestamp:
+            to_fold.pop()
+        return conversation.summary, conversation.summary_until, to_fold
+    finally:
+        db.close()
+
+def _save_summary(conversation_id: str, summary: str, summary_until, previous_until):
+    db = SessionLocal()
+    try:
+        return agents.crud.update_conversation_summary(
+            db,
+            conversation_id,
+            summary = summary,
+            summary_until = summary_until,
+            previous_until = previous_until
+        )
+    finally:
+        db.close()
+
+async def summarize_history(conversation_id: str, policy: ContextWindowPolicy = default_policy) -> bool:
+    """
+    Fold the oldest batch of messages out of the window into the conversation summary.
+    Meant to run after the response has been sent to the user. Returns false when the
+    summary could not be written.
+    """
+    summary, summary_until, to_fold = await run_in_threadpool(_get_messages_to_fold, conversation_id, policy)
+    if len(to_fold) < policy.summarize_batch:
+        return True
+
+    transcript = "\n".join(
+        f"User: {mes.user_message}\nAgent: {mes.agent_message}" for mes in to_fold
+    )
+    service = integrations.OpenAIIntegrationService(
+        context = {
+            "role": "system",
+            "content": "You summarize conversations between a user and an AI agent. "
+                       "Keep the facts, preferences and open questions from the user."
+        },
+        instruction = None,
+        provider = get_provider(SUMMARY_PROVIDER)
+    )
+    prompt = (
+        f"Current summary of the conversation: {summary or 'None'}\n\n"
+        f"New messages:\n{transcript}\n\n"
+        "Write the updated summary of the whole conversation in a short paragraph."
+    )
+    try:
+        max_tokens = budget_max_tokens(service.messages + [{"role": "user", "content": prompt}], SUMMARY_MODEL, SUMMARY_MAX_TOKENS)
+    except ContextLimitError as e:
+        log.error(f"Conversation {conversation_id} summary could not be updated: {e}")
+        return False
+    response = await service.aanswer_to_prompt(
+        model       = SUMMARY_MODEL,
+        prompt      = prompt,
+        temperature = 0,
+        max_tokens  = max_tokens
+    )
+    if response.get('answer') == integrations.FALLBACK_ANSWER:
+        log.error(f"Conversation {conversation_id} summary could not be updated")
+        return False
+
+    updated = await run_in_threadpool(
+        _save_summary, conversation_id, response.get('answer'), to_fold[-1].timestamp, summary_until
+    )
+    if updated:
+        session_cache.fold(conversation_id, response.get('answer'), to_fold[-1].timestamp)
+    else:
+        # Someone else updated the summary, the session is loaded again on the next turn.
+        session_cache.delete(conversation_id)
+    log.info("Conversation %s summary updated with %d messages: %s", conversation_id, len(to_fold), updated)
+
+    return True
@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import agents.async_crud
+import agents.models
+from agents.database import AsyncSessionLocal
+from agentsfwrk import logger, metrics
+
+log = logger.get_logger(__name__)
+
+# Persistent queue of the work done after the chat responses (summaries, goal
+# verifications), see `JobQueue`. The app runs workers, more can run on their own:
+#     python -m agents.jobs --processes 4 --concurrency 8
+JOBS_ENABLED = os.getenv('JOBS_ENABLED', 'true').lower() == 'true'
+JOB_WORKERS_IN_APP = os.getenv('JOB_WORKERS_IN_APP', 'true').lower() == 'true'
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', 4))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', 5))
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', 300))
+JOB_MAX_QUEUED = int(os.getenv('JOB_MAX_QUEUED', 10000))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 7 * 24 * 3600))
+
+# Seconds between the deletions of the jobs finished for longer than the retention.
+_CLEANUP_INTERVAL = 60
+# Seconds a lease outlasts the timeout of its job, to save the outcome of the job before
+# another worker can take it over.
+_LEASE_MARGIN = 30
+
+job_wait_seconds = metrics.registry.histogram(
+    "job_wait_seconds", "Time the jobs waited in the queue before running", ("kind",)
+)
+job_run_seconds = metrics.registry.histogram(
+    "job_run_seconds", "Duration of the job runs", ("kind", "outcome")
+)
+jobs_enqueued = metrics.registry.counter(
+    "jobs_enqueued_total", "Jobs added to the queue", ("kind",)
+)
+jobs_rejected = metrics.registry.counter(
+    "jobs_rejected_total", "Jobs refused because the queue was full", ("kind",)
+)
+
+class JobQueueFullError(Exception):
+    """
+    Raised when a job is enqueued with `max_queued` jobs already waiting.
+    """
+    pass
+
+def _percentile(values: list, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class JobQueue:
+    """
+    Persistent queue of background jobs, in the `jobs` table of the database.
+
+    A job has a kind and a JSON payload, and is run by the handler registered for its
+    kind (see `handler`): an async function of the payload, whose return value is saved
+    as the result of the job. A job that raises is retried with an exponential backoff
+    (`retry_delay`, doubled on every attempt) up to `max_attempts` times, then marked
+    as failed.
+
+    Workers poll the table for the jobs ready to run and run up to `concurrency` of them
+    at a time, in the app (`start`) or in their own processes (`python -m agents.jobs`),
+    any number of them can share the table. A worker holds the jobs it runs for
+    `timeout` seconds (a lease): a job running longer is cancelled, and the job of a
+    worker that died is taken over by another one once its lease expires.
+
+    Enqueueing is refused past `max_queued` jobs waiting (backpressure), and a job with
+    the idempotency `key` of an existing one is not added twice.
+    """
+    def __init__(
+        self,
+        concurrency: int = JOB_CONCURRENCY,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        retry_delay: float = JOB_RETRY_DELAY,
+        timeout: float = JOB_TIMEOUT,
+        max_queued: int = JOB_MAX_QUEUED,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        retention: float = JOB_RETENTION,
+        session_factory = AsyncSessionLocal
+    ) -> None:
+
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.session_factory = session_factory
+        # The lease of the jobs run by this worker.
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._handlers: Dict[str, Callable[[dict], Awaitable]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        # Jobs waiting, counted at most every `poll_interval` seconds, see `depth`.
+        self._depth = 0
+        self._depth_counted_at = float("-inf")
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def running_count(self) -> int:
+        """
+        Number of jobs running in this worker.
+        """
+        return len(self._running)
+
+    @property
+    def queued_count(self) -> int:
+        """
+        Number of jobs waiting to run, as last counted (see `depth`).
+        """
+        return self._depth
+
+    def handler(self, kind: str):
+        """
+        Decorator registering the handler of a kind of jobs:
+        ```
+        @job_queue.handler("summarize")
+        async def summarize(payload: dict): ...
+        ```
+        """
+        def register(fn: Callable[[dict], Awaitable]):
+            self._handlers[kind] = fn
+            return fn
+
+        return register
+
+    async def start(self):
+        """
+        Start the worker polling the queue.
+        """
+        if self.running:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        log.info("Job worker %s started (concurrency: %d, kinds: %s)", self.worker_id, self.concurrency, ", ".join(self._handlers))
+
+    async def stop(self, grace: float = 10):
+        """
+        Stop the worker, waiting `grace` seconds for the jobs running. The ones still
+        running after that are cancelled and queued again.
+        """
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+        running = dict(self._running)
+        if running:
+            _, pending = await asyncio.wait(running.values(), timeout = grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions = True)
+            cancelled = [job_id for job_id, task in running.items() if task in pending]
+            if cancelled:
+                # They run again right away, not once their lease expires.
+                async with self.session_factory() as db:
+                    for job_id in cancelled:
+                        await agents.async_crud.finish_job(db, job_id, self.worker_id, status = "queued", run_at = datetime.utcnow())
+                log.warning("Job worker %s stopped with %d jobs running, queued again", self.worker_id, len(cancelled))
+        log.info("Job worker %s stopped", self.worker_id)
+
+    async def enqueue(self, kind: str, payload: dict, key: str = None, max_attempts: int = None, delay: float = 0) -> agents.models.Job:
+        """
+        Add a job to the queue, to run in `delay` seconds. With the `key` of a job
+        already in the queue (waiting, running or done), that job is returned instead,
+        a failed one is queued again. Raises `JobQueueFullError` when `max_queued` jobs
+        are waiting.
+        """
+        if await self.depth() >= self.max_queued:
+            jobs_rejected.inc(kind = kind)
+            raise JobQueueFullError(f"{self._depth} jobs are waiting, the queue is full")
+
+        async with self.session_factory() as db:
+            job, created = await agents.async_crud.create_job(
+                db,
+                kind = kind,
+                payload = payload,
+                key = key,
+                max_attempts = max_attempts or self.max_attempts,
+                run_at = datetime.utcnow() + timedelta(seconds = delay)
+            )
+        if created:
+            self._depth += 1
+            jobs_enqueued.inc(kind = kind)
+            if self._wakeup is not None:
+                self._wakeup.set()
+        log.debug("Job %s (%s) enqueued: %s", job.id, kind, created)
+
+        return job
+
+    async def depth(self) -> int:
+        """
+        Number of jobs waiting to run, at most `poll_interval` seconds old.
+        """
+        if time.monotonic() - self._depth_counted_at > self.poll_interval:
+            async with self.session_factory() as db:
+                counts = await agents.async_crud.count_jobs(db, status = "queued")
+            self._depth = sum(counts.values())
+            self._depth_counted_at = time.monotonic()
+
+        return self._depth
+
+    async def get(self, job_id: str) -> Optional[agents.models.Job]:
+        async with self.session_factory() as db:
+            return await agents.async_crud.get_job(db, job_id)
+
+    async def status(self, sample: int = 1000) -> dict:
+        """
+        State of the queue: the jobs of each kind by status, the age of the oldest job
+        waiting, and the latency of the `sample` most recently finished jobs (p50 and p95
+        seconds of waiting in the queue and of running).
+        """
+        async with self.session_factory() as db:
+            counts = await agents.async_crud.count_jobs(db)
+            oldest = await agents.async_crud.oldest_queued_job(db)
+            finished = await agents.async_crud.get_finished_jobs(db, sample)
+
+        kinds: Dict[str, dict] = {}
+        for (kind, status), count in counts.items():
+            kinds.setdefault(kind, {})[status] = count
+        times: Dict[str, tuple] = {}
+        for kind, _, created_at, started_at, finished_at in finished:
+            wait, run = times.setdefault(kind, ([], []))
+            if started_at is not None:
+                wait.append((started_at - created_at).total_seconds())
+                run.append((finished_at - started_at).total_seconds())
+        self._depth = sum(count for (_, status), count in counts.items() if status == "queued")
+        self._depth_counted_at = time.monotonic()
+
+        return {
+            "depth": self._depth,
+            "max_queued": self.max_queued,
+            "oldest_queued_seconds": (datetime.utcnow() - oldest).total_seconds() if oldest else None,
+            "running_here": self.running_count,
+            "jobs": kinds,
+            "latency": {
+                kind: {
+                    "count": len(wait),
+                    "wait_p50": _percentile(wait, 0.5),
+                    "wait_p95": _percentile(wait, 0.95),
+                    "run_p50": _percentile(run, 0.5),
+                    "run_p95": _percentile(run, 0.95),
+                }
+                for kind, (wait, run) in times.items()
+            },
+        }
+
+    async def _run(self):
+        cleaned_at = time.monotonic()
+        while not self._stopping:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._running)
+            claimed: List[agents.models.Job] = []
+            if free > 0:
+                try:
+                    async with self.session_factory() as db:
+                        claimed = await agents.async_crud.claim_jobs(
+                            db, free, self.worker_id, datetime.utcnow() + timedelta(seconds = self.timeout + _LEASE_MARGIN)
+                        )
+                except Exception as e:
+                    log.error(f"Exception occurred claiming jobs: {e}")
+            for job in claimed:
+                task = asyncio.create_task(self._run_job(job))
+                self._running[job.id] = task
+                task.add_done_callback(lambda _, job_id = job.id: self._done(job_id))
+
+            if time.monotonic() - cleaned_at > _CLEANUP_INTERVAL:
+                cleaned_at = time.monotonic()
+                try:
+                    async with self.session_factory() as db:
+                        deleted = await agents.async_crud.delete_finished_jobs(db, datetime.utcnow() - timedelta(seconds = self.retention))
+                    if deleted:
+                        log.info("Deleted %d finished jobs", deleted)
+                except Exception as e:
+                    log.error(f"Exception occurred deleting the finished jobs: {e}")
+
+            # More jobs may be ready when all the free slots were filled, look again as
+            # soon as a slot frees up. Otherwise wait for a job (or the next poll).
+            if free <= 0 or len(claimed) < free:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _done(self, job_id: str):
+        self._running.pop(job_id, None)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run_job(self, job: agents.models.Job):
+        if job.attempts == 1:
+            job_wait_seconds.observe((job.started_at - job.created_at).total_seconds(), kind = job.kind)
+        handler = self._handlers.get(job.kind)
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for the jobs of kind {job.kind!r}")
+            if job.attempts > job.max_attempts:
+                raise RuntimeError("Too many attempts, the workers running it stopped")
+            result = await asyncio.wait_for(handler(job.payload), self.timeout)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            if handler is not None and job.attempts < job.max_attempts:
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                log.warning(f"Job {job.id} ({job.kind}) failed, attempt {job.attempts} of {job.max_attempts}, retrying in {delay}s: {error}")
+                outcome, values = "retry", {"status": "queued", "run_at": datetime.utcnow() + timedelta(seconds = delay)}
+            else:
+                log.error(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+                outcome, values = "failed", {"status": "failed", "finished_at": datetime.utcnow()}
+            values["error"] = error
+        else:
+            outcome, values = "done", {"status": "done", "finished_at": datetime.utcnow(), "result": result, "error": None}
+        job_run_seconds.observe(time.perf_counter() - start, kind = job.kind, outcome = outcome)
+
+        try:
+            async with self.session_factory() as db:
+                saved = await agents.async_crud.finish_job(db, job.id, self.worker_id, **values)
+            if not saved:
+                log.warning(f"Job {job.id} ({job.kind}) was taken over by another worker, its lease expired")
+        except Exception as e:
+            # The job runs again once its lease expires.
+            log.error(f"Exception occurred saving job {job.id} ({job.kind}): {e}")
+
+job_queue = JobQueue()
+
+async def serve(concurrency: int = JOB_CONCURRENCY):
+    """
+    Run a worker until the process is interrupted (SIGINT or SIGTERM).
+    """
+    # The handlers of the jobs are registered with the routes that enqueue them.
+    import agents.api.routes  # noqa: F401
+    from agents.database import dispose_engines
+    from agents.memory import message_memory
+    from agentsfwrk.providers import close_aiosession
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    job_queue.concurrency = concurrency
+    await job_queue.start()
+    try:
+        await stopped.wait()
+    finally:
+        await job_queue.stop()
+        message_memory.close()
+        await close_aiosession()
+        await dispose_engines()
+
+def _run_process(concurrency: int, log_file: str):
+    logger.setup_applevel_logger(file_name = log_file)
+    try:
+        asyncio.run(serve(concurrency))
+    finally:
+        logger.stop_logging()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run workers of the job queue, until interrupted")
+    parser.add_argument("--processes", type = int, default = 1)
+    parser.add_argument("--concurrency", type = int, default = JOB_CONCURRENCY, help = "Jobs run at a time, per process")
+    parser.add_argument("--log-file")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        _run_process(args.concurrency, args.log_file)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target = _run_process, args = (args.concurrency, args.log_file)) for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    def terminate(signum, frame):
+        # The workers stop on SIGTERM, finishing (or queuing again) their jobs.
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the workers too.
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    main()
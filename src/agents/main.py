@@ -1,13 +1,70 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
-from agents.api.routes import router as ai_agents
-from agentsfwrk.logger import setup_applevel_logger
+from agents.api.routes import chat_channels, router as ai_agents
+from agents.database import dispose_engines, engine
+from agents.jobs import JOBS_ENABLED, JOB_WORKERS_IN_APP, job_queue
+from agents.memory import message_memory
+from agents.processing import agent_prompt_cache
+from agents.sessions import session_cache
+from agents.writer import MESSAGE_WRITE_BEHIND, message_writer
+from agentsfwrk import metrics
+from agentsfwrk.providers import close_aiosession
+from agentsfwrk.logger import setup_applevel_logger, stop_logging
 
 log = setup_applevel_logger(file_name = 'agents.log')
 
 app = FastAPI()
 app.include_router(router = ai_agents)
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.get("/")
 async def root():
     return {"message": "Hello there conversational ai user!"}
+
+def collect_metrics():
+    """
+    Gauges of the services, see `agentsfwrk.metrics`.
+    """
+    yield "message_writer_pending", "Messages queued and not written yet", {}, message_writer.pending_count
+    yield "agent_prompt_cache_size", "Agent prompts in the cache", {}, len(agent_prompt_cache)
+    yield "session_cache_size", "Conversation sessions in the cache", {}, len(session_cache)
+    yield "session_cache_bytes", "Estimated size of the cached conversation sessions", {}, session_cache.size_bytes
+    yield "websocket_sessions", "Open WebSocket chat sessions", {}, len(chat_channels)
+    if JOBS_ENABLED:
+        yield "jobs_queued", "Jobs waiting in the queue, as last counted", {}, job_queue.queued_count
+        yield "jobs_running", "Jobs running in this process", {}, job_queue.running_count
+    if message_memory.enabled:
+        yield "memory_index_messages", "Messages in the memory index", {}, len(message_memory.index)
+    pool = engine.pool
+    if hasattr(pool, "checkedout"):
+        yield "db_pool_checked_out", "Database connections in use", {}, pool.checkedout()
+
+metrics.registry.add_collector(collect_metrics)
+
+@app.get("/metrics", response_class = PlainTextResponse)
+async def get_metrics():
+    """
+    Metrics in the Prometheus text format: per stage durations of the chat requests,
+    completion calls (durations, retries, tokens), database statements and the state
+    of the caches, limiters and write queue.
+    """
+    return PlainTextResponse(metrics.registry.render(), media_type = "text/plain; version=0.0.4")
+
+@app.on_event("startup")
+async def startup():
+    if MESSAGE_WRITE_BEHIND:
+        await message_writer.start()
+    if JOBS_ENABLED and JOB_WORKERS_IN_APP:
+        await job_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Let the running jobs finish (or queue them again), then flush the queued messages
+    # before closing the connections.
+    await job_queue.stop()
+    await message_writer.stop()
+    message_memory.close()
+    await close_aiosession()
+    await dispose_engines()
+    stop_logging()
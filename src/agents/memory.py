@@ -0,0 +1,440 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import agents.crud
+import agents.models
+from agentsfwrk import logger
+from agentsfwrk.embeddings import Embedder, get_embedder
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock, run a single writer.
+    fcntl = None
+
+log = logger.get_logger(__name__)
+
+# Retrieval of the relevant past turns, see `MessageMemory`:
+#     python -m agents.memory build
+MEMORY_SCOPE = os.getenv('MEMORY_SCOPE', 'off')
+MEMORY_DIR = os.getenv('MEMORY_DIR', 'memory_index')
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', 4))
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', 0.1))
+MEMORY_RECENT_MESSAGES = int(os.getenv('MEMORY_RECENT_MESSAGES', 2))
+MEMORY_BATCH_SIZE = int(os.getenv('MEMORY_BATCH_SIZE', 256))
+
+SCOPES = ("off", "conversation", "agent")
+
+# Message ids are uuids, the column of ids has room for longer ones.
+_ID_DTYPE = np.dtype("S64")
+# Rows scored at a time by a full scan, bounds the temporary memory of a search.
+_SCAN_BLOCK = 65536
+
+class VectorIndex:
+    """
+    Append-only index of unit length embeddings of messages, searched by dot product.
+
+    Stored in the `path` directory as memory-mapped NumPy arrays, so the vectors live in
+    the page cache and not in the heap of the process:
+
+    - `vectors.f32`: the embeddings, `capacity x dim` float32.
+    - `ids.S64`, `conversations.i32`, `agents.i32`: per row, the message id and the codes
+      of its conversation and agent (the line of their id in `conversations.txt` and
+      `agents.txt`), so a search can be restricted to them.
+    - `meta.json`: the embedder, the dimensions and the rows in use.
+
+    The capacity doubles when full. The first process to open the index is its writer
+    (an exclusive lock on `lock`), the others open it read-only and see its rows as
+    `meta.json` is updated.
+    """
+    def __init__(self, path: str, dim: int, embedder: str, capacity: int = 4096) -> None:
+        self.path = path
+        self.dim = dim
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+
+        self._lock_file = open(os.path.join(path, "lock"), "a")
+        self.writable = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.writable = False
+                log.warning("Memory index %s is locked by another process, opened read-only", path)
+
+        self._meta_mtime = None
+        if os.path.exists(self._file("meta.json")):
+            self._load()
+        elif self.writable:
+            self.count = 0
+            self._keys = {"conversations": {}, "agents": {}}
+            self._open(capacity, create = True)
+            self._save_meta()
+        else:
+            raise RuntimeError(f"Memory index {path} is being created by another process")
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        self._meta_mtime = os.path.getmtime(self._file("meta.json"))
+        with open(self._file("meta.json")) as file:
+            meta = json.load(file)
+        if (meta["embedder"], meta["dim"]) != (self.embedder, self.dim):
+            raise ValueError(
+                f"Memory index {self.path} was built with {meta['embedder']} ({meta['dim']} dimensions), "
+                f"rebuild it for {self.embedder} ({self.dim} dimensions): python -m agents.memory build --rebuild"
+            )
+        self.count = meta["count"]
+        self._keys = {}
+        for kind in ("conversations", "agents"):
+            with open(self._file(f"{kind}.txt"), "a+") as file:
+                file.seek(0)
+                self._keys[kind] = {key: code for code, key in enumerate(file.read().splitlines())}
+        self._open(meta["capacity"])
+
+    def _open(self, capacity: int, create: bool = False):
+        mode = "r+" if self.writable else "r"
+        arrays = {}
+        for name, dtype, shape in (
+            ("vectors.f32", np.float32, (capacity, self.dim)),
+            ("ids.S64", _ID_DTYPE, (capacity,)),
+            ("conversations.i32", np.int32, (capacity,)),
+            ("agents.i32", np.int32, (capacity,)),
+        ):
+            if create or self.writable and os.path.getsize(self._file(name)) < np.dtype(dtype).itemsize * int(np.prod(shape)):
+                # Grow (or create) the file, the new rows read as zeros.
+                with open(self._file(name), "ab") as file:
+                    file.truncate(np.dtype(dtype).itemsize * int(np.prod(shape)))
+            arrays[name] = np.memmap(self._file(name), dtype = dtype, mode = mode, shape = shape)
+        self.capacity = capacity
+        self._vectors = arrays["vectors.f32"]
+        self._ids = arrays["ids.S64"]
+        self._conversation_codes = arrays["conversations.i32"]
+        self._agent_codes = arrays["agents.i32"]
+
+    def _save_meta(self):
+        meta = {"embedder": self.embedder, "dim": self.dim, "count": self.count, "capacity": self.capacity}
+        with open(self._file("meta.json.tmp"), "w") as file:
+            json.dump(meta, file)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    def _code(self, kind: str, key: str) -> int:
+        codes = self._keys[kind]
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(codes)
+            with open(self._file(f"{kind}.txt"), "a") as file:
+                file.write(key + "\n")
+        return code
+
+    def _refresh(self):
+        # Read-only: pick up the rows added by the writer.
+        mtime = os.path.getmtime(self._file("meta.json"))
+        if mtime != self._meta_mtime:
+            with self._lock:
+                self._load()
+
+    def add(self, ids: List[str], conversation_ids: List[str], agent_ids: List[str], vectors: np.ndarray):
+        """
+        Append the embeddings of messages.
+        """
+        if not self.writable:
+            raise RuntimeError(f"Memory index {self.path} is read-only in this process")
+        with self._lock:
+            if self.count + len(ids) > self.capacity:
+                capacity = self.capacity
+                while capacity < self.count + len(ids):
+                    capacity *= 2
+                self._open(capacity)
+            rows = slice(self.count, self.count + len(ids))
+            self._vectors[rows] = vectors
+            self._ids[rows] = [message_id.encode() for message_id in ids]
+            self._conversation_codes[rows] = [self._code("conversations", key) for key in conversation_ids]
+            self._agent_codes[rows] = [self._code("agents", key) for key in agent_ids]
+            self.count += len(ids)
+            # NOTE: The rows are counted once written, a crash loses the rows not counted
+            # yet (`build` indexes them again), never exposes half written ones.
+            self._save_meta()
+
+    def flush(self):
+        with self._lock:
+            if self.writable:
+                for array in (self._vectors, self._ids, self._conversation_codes, self._agent_codes):
+                    array.flush()
+
+    def ids(self) -> set:
+        """
+        Get the ids of the indexed messages.
+        """
+        return {message_id.decode() for message_id in self._ids[:self.count]}
+
+    def search(
+        self,
+        vector: np.ndarray,
+        k: int,
+        conversation_id: str = None,
+        agent_id: str = None,
+        exclude: Iterable[str] = ()
+    ) -> List[Tuple[str, float]]:
+        """
+        Get the `k` messages most similar to the (unit length) `vector`, optionally of a
+        conversation or an agent only, as (id, score) from the most similar.
+        """
+        if not self.writable:
+            self._refresh()
+        with self._lock:
+            count = self.count
+            vectors, ids = self._vectors, self._ids
+            codes, key = (
+                (self._conversation_codes, self._keys["conversations"].get(conversation_id)) if conversation_id is not None
+                else (self._agent_codes, self._keys["agents"].get(agent_id)) if agent_id is not None
+                else (None, None)
+            )
+        if count == 0 or (codes is not None and key is None):
+            return []
+
+        vector = np.asarray(vector, dtype = np.float32)
+        rows = None
+        if codes is not None:
+            rows = np.flatnonzero(codes[:count] == key)
+        if rows is not None and len(rows) * 8 < count:
+            # A few rows: gather them.
+            scores = vectors[rows] @ vector
+        else:
+            # Most rows: scan all of them in contiguous blocks, no copy of the vectors.
+            scores = np.empty(count, dtype = np.float32)
+            for start in range(0, count, _SCAN_BLOCK):
+                end = min(start + _SCAN_BLOCK, count)
+                np.dot(vectors[start:end], vector, out = scores[start:end])
+            if rows is not None:
+                scores = scores[rows]
+
+        exclude = set(exclude)
+        wanted = min(k + len(exclude), len(scores))
+        top = np.argpartition(-scores, wanted - 1)[:wanted] if wanted < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind = "stable")]
+        results = []
+        for index in top:
+            message_id = ids[rows[index] if rows is not None else index].decode()
+            if message_id not in exclude:
+                results.append((message_id, float(scores[index])))
+            if len(results) == k:
+                break
+
+        return results
+
+    def __len__(self):
+        return self.count
+
+def _message_text(user_message: str, agent_message: str) -> str:
+    return f"{user_message or ''}\n{agent_message or ''}"
+
+def craft_memory_message(messages: List[agents.models.Message]) -> dict:
+    """
+    Craft the message carrying the past turns relevant to the user message.
+    """
+    transcript = "\n".join(f"User: {mes.user_message}\nAgent: {mes.agent_message}" for mes in messages)
+    return {
+        "role": "system",
+        "content": f"Earlier messages with the user relevant to the conversation:\n{transcript}"
+    }
+
+class MessageMemory:
+    """
+    Semantic memory of the messages: the past turns most relevant to a user message,
+    retrieved from a `VectorIndex` of the messages of the conversation or of all the
+    conversations of its agent (`scope`), are injected into the prompt in place of the
+    older history.
+
+    The messages saved by the chats are queued and embedded in a batch before the next
+    search, the others (bulk imports, existing databases) are indexed with
+    `python -m agents.memory build`.
+
+    NOTE: With several workers only the first one writes to the index, the others search
+    it read-only; index their messages with `build`, or run a single worker.
+    """
+    def __init__(
+        self,
+        path: str = MEMORY_DIR,
+        scope: str = MEMORY_SCOPE,
+        top_k: int = MEMORY_TOP_K,
+        min_score: float = MEMORY_MIN_SCORE,
+        recent_messages: int = MEMORY_RECENT_MESSAGES,
+        batch_size: int = MEMORY_BATCH_SIZE,
+        embedder: Optional[Embedder] = None
+    ) -> None:
+
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown memory scope {scope!r}, use {', '.join(SCOPES)}")
+        self.path = path
+        self.scope = scope
+        self.top_k = top_k
+        self.min_score = min_score
+        self.recent_messages = recent_messages
+        self.batch_size = batch_size
+        self._embedder = embedder
+        self._index: Optional[VectorIndex] = None
+        self._pending: List[Tuple[str, str, str, str]] = []
+        self._lock = threading.Lock()
+        self._warned = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.scope != "off"
+
+    @property
+    def embedder(self) -> Embedder:
+        if self._embedder is None:
+            self._embedder = get_embedder()
+        return self._embedder
+
+    @property
+    def index(self) -> VectorIndex:
+        # Opened on first use, the app doesn't touch the files when the memory is off.
+        with self._lock:
+            if self._index is None:
+                self._index = VectorIndex(self.path, self.embedder.dim, self.embedder.name)
+        return self._index
+
+    def add(self, message: agents.models.Message, agent_id: str):
+        """
+        Queue a saved message to be indexed.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending.append((message.id, message.conversation_id, agent_id, _message_text(message.user_message, message.agent_message)))
+
+    def index_pending(self):
+        """
+        Embed and index the queued messages.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if not self.index.writable:
+            if not self._warned:
+                log.warning("The memory index is read-only in this process, index its messages with `python -m agents.memory build`")
+                self._warned = True
+            return
+        self.index_rows(
+            {"id": id, "conversation_id": conversation_id, "agent_id": agent_id, "text": text}
+            for id, conversation_id, agent_id, text in pending
+        )
+
+    def index_rows(self, rows: Iterable[dict]) -> int:
+        """
+        Embed and index messages in batches of `batch_size`, each row with the `id`,
+        `conversation_id` and `agent_id` of a message and its `text` (or its
+        `user_message` and `agent_message`). Returns the number of messages indexed.
+        """
+        batch, indexed = [], 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                indexed += self._index_batch(batch)
+                batch = []
+        if batch:
+            indexed += self._index_batch(batch)
+
+        return indexed
+
+    def _index_batch(self, rows: List[dict]) -> int:
+        texts = [row.get("text") or _message_text(row.get("user_message"), row.get("agent_message")) for row in rows]
+        self.index.add(
+            [row["id"] for row in rows],
+            [row["conversation_id"] for row in rows],
+            [row["agent_id"] for row in rows],
+            self.embedder.embed(texts)
+        )
+        return len(rows)
+
+    def search(self, query: str, conversation_id: str, agent_id: str, exclude: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """
+        Get the ids (and scores) of the `top_k` messages most relevant to a query, within
+        the scope, above `min_score`.
+        """
+        self.index_pending()
+        vector = self.embedder.embed([query])[0]
+        if not vector.any():
+            return []
+        filters = {"conversation_id": conversation_id} if self.scope == "conversation" else {"agent_id": agent_id}
+        results = self.index.search(vector, self.top_k, exclude = exclude, **filters)
+
+        return [(message_id, score) for message_id, score in results if score >= self.min_score]
+
+    def recall(self, db: Session, session, query: str) -> List[agents.models.Message]:
+        """
+        Get the past messages relevant to a user message of a conversation session, in
+        order by timestamp. The most recent messages of the session are replayed as they
+        are, they aren't recalled.
+        """
+        recent = session.messages[-self.recent_messages:] if self.recent_messages else []
+        results = self.search(query, session.conversation_id, session.agent_id, exclude = {mes.id for mes in recent})
+        if not results:
+            return []
+        ids = [message_id for message_id, _ in results]
+        messages = {mes.id: mes for mes in agents.crud.get_messages_by_ids(db, ids)}
+        # The messages still in the write-behind queue are in the session.
+        messages.update((mes.id, mes) for mes in session.messages if mes.id in ids)
+        log.debug("Recalled %d messages for conversation %s: %s", len(messages), session.conversation_id, results)
+
+        return sorted(messages.values(), key = lambda mes: (mes.timestamp, mes.id))
+
+    def close(self):
+        """
+        Index the queued messages and flush the index, e.g. on application shutdown.
+        """
+        if self._index is None and not self._pending:
+            return
+        self.index_pending()
+        self.index.flush()
+
+message_memory = MessageMemory()
+
+def build(rebuild: bool = False, chunk_size: int = 5000):
+    """
+    Index the messages of the database not indexed yet, or all of them with `rebuild`.
+    """
+    from agents.export import export_chunks
+
+    if rebuild and os.path.exists(message_memory.path):
+        with open(os.path.join(message_memory.path, "lock"), "a") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise RuntimeError(f"Memory index {message_memory.path} is in use by another process")
+            shutil.rmtree(message_memory.path)
+    index = message_memory.index
+    if not index.writable:
+        raise RuntimeError(f"Memory index {index.path} is in use by another process")
+    indexed = index.ids()
+    total = 0
+    for rows in export_chunks("messages", chunk_size = chunk_size):
+        total += message_memory.index_rows(row for row in rows if row["id"] not in indexed)
+        log.info("Indexed %d messages (%d in the index)", total, len(index))
+    index.flush()
+
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description = "Manage the memory index of the messages")
+    parser.add_argument("command", choices = ["build"])
+    parser.add_argument("--rebuild", action = "store_true", help = "Index all the messages again, from an empty index")
+    args = parser.parse_args()
+
+    logger.setup_applevel_logger()
+    build(rebuild = args.rebuild)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, String, DateTime, JSON
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, DateTime, JSON
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -15,28 +15,77 @@ class Agent(Base):
     response_shape     = Column(JSON,   nullable = False)
     instructions       = Column(String, nullable = False)
 
+    # Completion backend of the agent, the defaults of the app when not set.
+    provider           = Column(String, nullable = True)
+    model              = Column(String, nullable = True)
+    params             = Column(JSON,   nullable = True)
+
     conversations      = relationship("Conversation", back_populates = "agent")
 
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    __table_args__ = (
+        Index("ix_conversations_agent_id_timestap", "agent_id", "timestap"),
+    )
 
     id          = Column(String, primary_key = True, index = True)
     agent_id    = Column(String, ForeignKey("agents.id"))
     timestap    = Column(DateTime, default = datetime.utcnow)
 
+    # Rolling summary of the messages up to (and including) `summary_until`,
+    # those messages are no longer replayed verbatim into the prompt.
+    summary         = Column(String, nullable = True)
+    summary_until   = Column(DateTime, nullable = True)
+
     agent       = relationship("Agent", back_populates = "conversations")
     messages    = relationship("Message", back_populates = "conversation")
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Serves the messages of a conversation in order, the id breaks timestamp ties.
+        Index("ix_messages_conversation_id_timestamp", "conversation_id", "timestamp", "id"),
+    )
 
     id          = Column(String, primary_key = True, index = True)
     timestamp   = Column(DateTime, default = datetime.utcnow)
 
     user_message    = Column(String)
     agent_message   = Column(String)
+    # Tokens of the interaction replayed into a prompt, counted once when it's saved.
+    tokens          = Column(Integer, nullable = True)
 
     conversation_id = Column(String, ForeignKey("conversations.id"))
     conversation    = relationship("Conversation", back_populates = "messages")
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Serves the workers looking for the jobs to run, see `agents.jobs`.
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+        Index("ix_jobs_finished_at", "finished_at"),
+    )
+
+    id          = Column(String, primary_key = True, index = True)
+    kind        = Column(String, nullable = False)
+    # Idempotency key: a job enqueued again with the key of an existing one is not added.
+    key         = Column(String, nullable = True, unique = True)
+    payload     = Column(JSON,   nullable = False)
+
+    # `queued`, `running`, `done` or `failed`.
+    status          = Column(String,  nullable = False, default = "queued")
+    attempts        = Column(Integer, nullable = False, default = 0)
+    max_attempts    = Column(Integer, nullable = False)
+    # Queued: when the job can run (retries are delayed). Running: when the lease of its
+    # worker (`lease`) expires, another worker takes it over after that.
+    run_at          = Column(DateTime, nullable = False)
+    lease           = Column(String, nullable = True)
+
+    created_at      = Column(DateTime, default = datetime.utcnow)
+    started_at      = Column(DateTime, nullable = True)
+    finished_at     = Column(DateTime, nullable = True)
+    result          = Column(JSON,   nullable = True)
+    error           = Column(String, nullable = True)
@@ -1,4 +1,8 @@
 import json
+import os
+
+from agents.tokens import count_message_tokens
+from agentsfwrk.cache import LRUCache
 
 ########################################
 # Chat Properties
@@ -32,3 +36,45 @@ def craft_agent_chat_instructions(instructions: str, response_shape: str) -> dic
         "content": instructions + f"\n\nFollow a RFC8259 compliant JSON with a shape of: {json.dumps(response_shape)} format without deviation."
     }
     return agent_instructions
+
+########################################
+# Agent Prompt
+########################################
+# Model and sampling params of the agents that don't set their own.
+DEFAULT_CHAT_MODEL = os.getenv('CHAT_MODEL', 'gpt-3.5-turbo')
+DEFAULT_CHAT_PARAMS = {
+    "temperature": 0.5,
+    "max_tokens": 1000,
+    "frequency_penalty": 0.5,
+    "presence_penalty": 0
+}
+
+# Prebuilt agent prompt prefixes, shared by all the conversations of an agent.
+# Entries are invalidated when the agent is updated, the TTL bounds how long other
+# processes can keep a stale prefix.
+agent_prompt_cache = LRUCache(
+    max_size = int(os.getenv('AGENT_PROMPT_CACHE_SIZE', 1024)),
+    ttl = float(os.getenv('AGENT_PROMPT_CACHE_TTL', 300))
+)
+
+def craft_agent_prompt(agent) -> dict:
+    """
+    Craft the prompt prefix of an agent: its context, first message and instructions
+    for the chat endpoints, their token count, the response shape to
+    validate the answers with, and the provider, model and sampling params to chat with.
+    """
+    context = craft_agent_chat_context(agent.context)
+    first_message = craft_agent_chat_first_message(agent.first_message)
+    instructions = craft_agent_chat_instructions(agent.instructions, agent.response_shape)
+    model = agent.model or DEFAULT_CHAT_MODEL
+    agent_prompt = {
+        "context": context,
+        "first_message": first_message,
+        "instructions": instructions,
+        "tokens": sum(count_message_tokens(message, model) for message in (context, first_message, instructions)),
+        "response_shape": agent.response_shape,
+        "provider": agent.provider,
+        "model": model,
+        "params": {**DEFAULT_CHAT_PARAMS, **(agent.params or {})}
+    }
+    return agent_prompt
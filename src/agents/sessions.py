@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import agents.models
+from agents.tokens import message_tokens
+from agentsfwrk import logger, metrics
+
+log = logger.get_logger(__name__)
+
+# Conversation sessions kept in memory between turns, see `SessionCache`.
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 1800))
+SESSION_CACHE_MAX_BYTES = int(os.getenv('SESSION_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Rough overhead of a cached message (the object, its id and timestamp) on top of its text.
+_MESSAGE_OVERHEAD = 400
+# Seconds the writes to conversations without a session are remembered, longer than
+# loading a session takes.
+_WRITES_MEMORY = 60
+
+session_cache_requests = metrics.registry.counter(
+    "session_cache_requests_total", "Lookups of the conversation session cache", ("result",)
+)
+
+class ConversationSession:
+    """
+    What a chat turn needs from the database for a conversation: its agent, its
+    summary and the unsummarized tail of its messages (with their token counts).
+    The tail is bounded like the one loaded from the database, `max_messages`.
+    """
+    __slots__ = ("conversation_id", "agent_id", "summary", "summary_until", "messages", "tokens", "max_messages", "size", "last_used")
+
+    def __init__(self, conversation, messages: List[agents.models.Message], max_messages: int) -> None:
+        self.conversation_id = conversation.id
+        self.agent_id = conversation.agent_id
+        self.summary = conversation.summary
+        self.summary_until = conversation.summary_until
+        self.max_messages = max_messages
+        self.messages = []
+        self.tokens = []
+        self.size = len(self.summary or "")
+        for mes in messages:
+            self.append(mes)
+
+    def append(self, message: agents.models.Message):
+        """
+        Add a message of the conversation, in timestamp order.
+        """
+        index = len(self.messages)
+        while index and (self.messages[index - 1].timestamp, self.messages[index - 1].id) > (message.timestamp, message.id):
+            index -= 1
+        self.messages.insert(index, message)
+        self.tokens.insert(index, message_tokens(message))
+        self.size += _message_size(message)
+        while len(self.messages) > self.max_messages:
+            self.size -= _message_size(self.messages.pop(0))
+            self.tokens.pop(0)
+
+    def copy(self) -> "ConversationSession":
+        session = ConversationSession.__new__(ConversationSession)
+        for name in self.__slots__:
+            setattr(session, name, getattr(self, name))
+        session.messages = list(self.messages)
+        session.tokens = list(self.tokens)
+        return session
+
+    def fold(self, summary: str, summary_until):
+        """
+        Replace the messages up to `summary_until` with the new summary.
+        """
+        self.size -= len(self.summary or "")
+        self.summary = summary
+        self.summary_until = summary_until
+        self.size += len(summary or "")
+        while self.messages and self.messages[0].timestamp <= summary_until:
+            self.size -= _message_size(self.messages.pop(0))
+            self.tokens.pop(0)
+
+def _message_size(message: agents.models.Message) -> int:
+    return len(message.user_message or "") + len(message.agent_message or "") + _MESSAGE_OVERHEAD
+
+class SessionCache:
+    """
+    Per process cache of the conversation sessions, so a warm chat turn doesn't load
+    the conversation and its messages again.
+
+    Least recently used sessions are evicted past `max_size` sessions or `max_bytes`
+    (estimated) of text, and sessions idle for `ttl` seconds expire.
+
+    NOTE: The sessions are updated by the turns handled in this process. With several
+    workers, route the requests of a conversation to the same one (or keep the TTL short),
+    a turn handled by another worker is not seen until the session expires.
+    """
+    def __init__(
+        self,
+        max_size: int = SESSION_CACHE_SIZE,
+        ttl: float = SESSION_CACHE_TTL,
+        max_bytes: int = SESSION_CACHE_MAX_BYTES
+    ) -> None:
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # Last write to the conversations that had no session, see `set`.
+        self._uncached_writes: "OrderedDict[str, float]" = OrderedDict()
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, conversation_id: str) -> Optional[ConversationSession]:
+        """
+        Get a copy of the session of a conversation, safe to read while other turns
+        update the cached one.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            session = self._data.get(conversation_id)
+            if session is not None and session.last_used + self.ttl < time.monotonic():
+                self._pop(conversation_id)
+                self.evictions += 1
+                session = None
+            if session is None:
+                session_cache_requests.inc(result = "miss")
+                return None
+            session.last_used = time.monotonic()
+            self._data.move_to_end(conversation_id)
+            session = session.copy()
+        session_cache_requests.inc(result = "hit")
+        return session
+
+    def set(self, session: ConversationSession, loaded_at: float):
+        """
+        Cache a session loaded from the database, `loaded_at` being the `time.monotonic()`
+        before loading it. The session isn't cached if a message was added to the
+        conversation since, it could be missing it.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._uncached_writes.get(session.conversation_id, float("-inf")) >= loaded_at:
+                return
+            self._pop(session.conversation_id)
+            session.last_used = time.monotonic()
+            self._data[session.conversation_id] = session
+            self._bytes += session.size
+            self._evict()
+
+    def add_message(self, message: agents.models.Message):
+        """
+        Add the message of a turn to the session of its conversation, if it's cached.
+        """
+        with self._lock:
+            session = self._data.get(message.conversation_id)
+            if session is None:
+                self._remember_write(message.conversation_id)
+                return
+            size = session.size
+            session.append(message)
+            self._bytes += session.size - size
+            self._evict()
+
+    def fold(self, conversation_id: str, summary: str, summary_until):
+        """
+        Apply a new summary of a conversation to its session, if it's cached.
+        """
+        with self._lock:
+            session = self._data.get(conversation_id)
+            if session is None:
+                self._remember_write(conversation_id)
+                return
+            size = session.size
+            session.fold(summary, summary_until)
+            self._bytes += session.size - size
+
+    def delete(self, conversation_id: str):
+        """
+        Drop the session of a conversation changed elsewhere (e.g. messages imported),
+        it's loaded again from the database on the next turn.
+        """
+        with self._lock:
+            self._pop(conversation_id)
+            self._remember_write(conversation_id)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remember_write(self, conversation_id: str):
+        now = time.monotonic()
+        self._uncached_writes[conversation_id] = now
+        self._uncached_writes.move_to_end(conversation_id)
+        while self._uncached_writes and next(iter(self._uncached_writes.values())) < now - _WRITES_MEMORY:
+            self._uncached_writes.popitem(last = False)
+
+    def _pop(self, conversation_id: str):
+        session = self._data.pop(conversation_id, None)
+        if session is not None:
+            self._bytes -= session.size
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.max_size or (self.max_bytes and self._bytes > self.max_bytes)):
+            _, session = self._data.popitem(last = False)
+            self._bytes -= session.size
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+session_cache = SessionCache()
@@ -0,0 +1,170 @@
+import functools
+import json
+import os
+import re
+from typing import List, Optional, Tuple
+
+from agentsfwrk import logger
+
+log = logger.get_logger(__name__)
+
+########################################
+# Token counting
+########################################
+# NOTE: The counts come from the tokenizer of the model (`tiktoken`, optional) or, without
+# it, from an approximation. They are memoized by text: the agent prompts and the history
+# messages replayed on every turn are tokenized once.
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 65536))
+# Tokenizer of the stored messages, the default chat model's.
+DEFAULT_MODEL = os.getenv('CHAT_MODEL', 'gpt-3.5-turbo')
+
+# Tokens added by the chat format to every message, and to prime the reply.
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+
+# Pieces of text the tokenizers split words on (words with their leading space, runs of
+# digits, punctuation), the long ones are several tokens.
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+_CHARACTERS_PER_TOKEN = 6
+
+@functools.lru_cache(maxsize = None)
+def _get_encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # e.g. the encoding files can't be downloaded.
+        log.warning("No tokenizer for %s, token counts are approximated: %s", model, e)
+        return None
+
+def approximate_tokens(text: str) -> int:
+    """
+    Approximate token count of a text, splitting it like the BPE tokenizers do and
+    counting a token per `_CHARACTERS_PER_TOKEN` characters of the long pieces.
+    """
+    return sum(1 + (len(piece) - 1) // _CHARACTERS_PER_TOKEN for piece in _PIECES.findall(text))
+
+@functools.lru_cache(maxsize = TOKEN_COUNT_CACHE_SIZE)
+def _count_tokens(text: str, model: str) -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return approximate_tokens(text)
+    return len(encoding.encode(text, disallowed_special = ()))
+
+def count_tokens(text: Optional[str], model: str = DEFAULT_MODEL) -> int:
+    """
+    Count the tokens of a text for a model, memoized.
+    """
+    return _count_tokens(text, model) if text else 0
+
+def count_message_tokens(message: dict, model: str = DEFAULT_MODEL) -> int:
+    """
+    Count the tokens of a chat message, with the overhead of the chat format.
+    """
+    return MESSAGE_OVERHEAD + count_tokens(str(message.get("content") or ""), model) + ("name" in message)
+
+def count_messages_tokens(messages: List[dict], model: str = DEFAULT_MODEL) -> int:
+    """
+    Count the tokens of the prompt made of chat messages.
+    """
+    return REPLY_OVERHEAD + sum(count_message_tokens(message, model) for message in messages)
+
+def count_turn_tokens(user_message: Optional[str], agent_message: Optional[str], model: str = DEFAULT_MODEL) -> int:
+    """
+    Count the tokens a stored interaction takes when replayed into a prompt (the user
+    and the agent messages).
+    """
+    return 2 * MESSAGE_OVERHEAD + count_tokens(user_message, model) + count_tokens(agent_message, model)
+
+def message_tokens(message) -> int:
+    """
+    Get the tokens of a stored message, counted when it was saved (the older rows
+    are counted now).
+    """
+    if message.tokens is not None:
+        return message.tokens
+    return count_turn_tokens(message.user_message, message.agent_message)
+
+########################################
+# Context budget
+########################################
+# Context window of the models, in tokens: the prompt plus the completion. The longest
+# prefix of the model name applies, e.g. `gpt-4-0613` is a `gpt-4`.
+MODEL_CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    **json.loads(os.getenv('MODEL_CONTEXT_LIMITS', '{}'))
+}
+DEFAULT_CONTEXT_LIMIT = int(os.getenv('DEFAULT_CONTEXT_LIMIT', 4096))
+# A prompt that leaves less room than this for the completion is rejected.
+MIN_COMPLETION_TOKENS = int(os.getenv('MIN_COMPLETION_TOKENS', 64))
+
+class ContextLimitError(ValueError):
+    """
+    A prompt doesn't fit in the context window of the model.
+    """
+    def __init__(self, model: str, prompt_tokens: int, limit: int) -> None:
+        super().__init__(
+            f"The prompt takes {prompt_tokens} tokens, the context of {model} is {limit} tokens "
+            f"(with at least {MIN_COMPLETION_TOKENS} for the completion)"
+        )
+        self.prompt_tokens = prompt_tokens
+        self.limit = limit
+
+def context_limit(model: str) -> int:
+    """
+    Get the context window of a model, in tokens.
+    """
+    prefix = max((name for name in MODEL_CONTEXT_LIMITS if model.startswith(name)), key = len, default = None)
+    return MODEL_CONTEXT_LIMITS[prefix] if prefix is not None else DEFAULT_CONTEXT_LIMIT
+
+def budget_max_tokens(messages: List[dict], model: str, max_tokens: Optional[int] = None) -> int:
+    """
+    Size the `max_tokens` of a completion: what the prompt leaves of the context of the
+    model, at most `max_tokens`. Raises `ContextLimitError` when the prompt doesn't
+    leave `MIN_COMPLETION_TOKENS`.
+    """
+    prompt_tokens = count_messages_tokens(messages, model)
+    limit = context_limit(model)
+    available = limit - prompt_tokens
+    if available < MIN_COMPLETION_TOKENS:
+        raise ContextLimitError(model, prompt_tokens, limit)
+
+    return min(available, max_tokens) if max_tokens else available
+
+def fit_messages(messages: List[dict], model: str, max_tokens: Optional[int] = None, keep_first: int = 2) -> Tuple[List[dict], int]:
+    """
+    Fit a prompt in the context of the model: the oldest history messages are dropped
+    until `MIN_COMPLETION_TOKENS` are left for the completion. The `keep_first` messages
+    (the agent prompt), the system ones (summary, recalled messages) and the last one
+    (the user's) are kept. Returns the messages and the `max_tokens` of the completion,
+    see `budget_max_tokens`.
+    """
+    limit = context_limit(model)
+    counts = [count_message_tokens(message, model) for message in messages]
+    prompt_tokens = REPLY_OVERHEAD + sum(counts)
+    dropped = set()
+    index = keep_first
+    while index < len(messages) - 1 and limit - prompt_tokens < MIN_COMPLETION_TOKENS:
+        if messages[index].get("role") != "system":
+            # A turn at a time, the user message with the answer after it.
+            turn = [index]
+            if messages[index].get("role") == "user" and index + 1 < len(messages) - 1 and messages[index + 1].get("role") == "assistant":
+                turn.append(index + 1)
+            for dropped_index in turn:
+                dropped.add(dropped_index)
+                prompt_tokens -= counts[dropped_index]
+            index = turn[-1]
+        index += 1
+    if dropped:
+        log.info("Dropped %d history messages to fit the context of %s", len(dropped), model)
+        messages = [message for index, message in enumerate(messages) if index not in dropped]
+
+    return messages, budget_max_tokens(messages, model, max_tokens)
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import agents.async_crud
+import agents.models
+from agents.api import schemas
+from agents.database import AsyncSessionLocal
+from agents.tokens import count_turn_tokens
+from agentsfwrk import logger, metrics
+
+log = logger.get_logger(__name__)
+
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "true").lower() == "true"
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", 0.05))
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", 200))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", 10000))
+# Retries of a batch that fails to be written, after them its messages are logged and dropped.
+MESSAGE_WRITE_RETRIES = int(os.getenv("MESSAGE_WRITE_RETRIES", 5))
+# Retries on shutdown, not to hold it up.
+_STOP_RETRIES = 3
+
+messages_dropped = metrics.registry.counter(
+    "message_writer_dropped_total", "Messages the writer gave up writing to the database"
+)
+
+class MessageWriter:
+    """
+    Write-behind queue for the conversation messages.
+
+    Messages are queued and inserted in batches, from all conversations, in a single
+    transaction every `flush_interval` seconds or as soon as `flush_size` are waiting.
+    The queued messages are kept as pending until they are flushed, so the history of
+    a conversation can include its messages not yet in the database. A batch that still
+    fails after `retries` retries is logged and dropped, so it doesn't hold up the queue.
+    """
+    def __init__(
+        self,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        flush_size: int = MESSAGE_FLUSH_SIZE,
+        queue_size: int = MESSAGE_QUEUE_SIZE,
+        retries: int = MESSAGE_WRITE_RETRIES,
+        session_factory = AsyncSessionLocal
+    ) -> None:
+
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.queue_size = queue_size
+        self.retries = retries
+        self.session_factory = session_factory
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, List[agents.models.Message]] = {}
+        # Messages submitted and flushed (or given up on) so far, see `drain`.
+        self._submitted = 0
+        self._flushed = 0
+        # The pending messages are also read from the threadpool, when building the history.
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """
+        Start the background flushing task.
+        """
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize = self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        log.info("Message writer started (flush interval: %ss, flush size: %d)", self.flush_interval, self.flush_size)
+
+    async def stop(self):
+        """
+        Stop the background task, flushing every queued message first.
+        """
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        log.info("Message writer stopped")
+
+    async def submit(self, conversation_id: str, message: schemas.MessageCreate) -> agents.models.Message:
+        """
+        Queue a message for a conversation. The id and timestamp are set right away,
+        so the returned message can be used before it reaches the database.
+        Waits when the queue is full (backpressure).
+        """
+        db_message = agents.models.Message(
+            id              = str(uuid.uuid4()),
+            timestamp       = datetime.utcnow(),
+            user_message    = message.user_message,
+            agent_message   = message.agent_message,
+            tokens          = count_turn_tokens(message.user_message, message.agent_message),
+            conversation_id = conversation_id
+        )
+        with self._lock:
+            self._pending.setdefault(conversation_id, []).append(db_message)
+            self._submitted += 1
+        await self._queue.put(db_message)
+
+        return db_message
+
+    async def drain(self):
+        """
+        Wait until the messages submitted so far are flushed. The batches are flushed in
+        the order of the queue, the messages submitted meanwhile don't delay it.
+        """
+        target = self._submitted
+        while self.running and self._flushed < target:
+            await asyncio.sleep(self.flush_interval)
+
+    def pending(self, conversation_id: str) -> List[agents.models.Message]:
+        """
+        Get the messages of a conversation that are not in the database yet.
+        """
+        with self._lock:
+            return list(self._pending.get(conversation_id, []))
+
+    @property
+    def pending_count(self) -> int:
+        """
+        Number of messages, of all conversations, not in the database yet.
+        """
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = await self._queue.get()
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.flush_size:
+                    break
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            stopping = item is None
+            if stopping:
+                # Drain whatever was queued before the stop.
+                while not self._queue.empty():
+                    queued = self._queue.get_nowait()
+                    if queued is not None:
+                        batch.append(queued)
+            await self._flush(batch, retries = min(self.retries, _STOP_RETRIES) if stopping else self.retries)
+
+    async def _flush(self, batch: List[agents.models.Message], retries: int):
+        """
+        Insert a batch of messages, retrying with a backoff up to `retries` times.
+        The messages of a batch that can't be written are logged (one json row per
+        line, to write them again by hand) and dropped.
+        """
+        if not batch:
+            return
+
+        rows = [
+            {
+                "id": mes.id,
+                "timestamp": mes.timestamp,
+                "user_message": mes.user_message,
+                "agent_message": mes.agent_message,
+                "tokens": mes.tokens,
+                "conversation_id": mes.conversation_id,
+            }
+            for mes in batch
+        ]
+        attempt = 0
+        while True:
+            try:
+                async with self.session_factory() as db:
+                    await agents.async_crud.create_messages(db, rows)
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > retries:
+                    log.error(f"Could not write {len(batch)} messages, dropping them: {e}")
+                    for row in rows:
+                        log.error(f"Dropped message: {json.dumps(row, default = str)}")
+                    messages_dropped.inc(len(batch))
+                    break
+                retry_time = min(0.1 * 2 ** attempt, 5)
+                log.error(f"Exception occurred writing {len(batch)} messages: {e}. Retrying in {retry_time} seconds...")
+                await asyncio.sleep(retry_time)
+
+        with self._lock:
+            for mes in batch:
+                pending = self._pending.get(mes.conversation_id)
+                if pending:
+                    pending.remove(mes)
+                    if not pending:
+                        del self._pending[mes.conversation_id]
+            self._flushed += len(batch)
+        log.debug("Flushed %d messages to the database", len(batch))
+
+message_writer = MessageWriter()
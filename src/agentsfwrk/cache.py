@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+def completion_key(model: str, messages, **params) -> str:
+    """
+    Canonical hash of a completion request: same model, messages and sampling
+    params (in any order) give the same key.
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys = True,
+        separators = (",", ":"),
+        ensure_ascii = False,
+        default = str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LRUCache:
+    """
+    In-memory LRU cache where every entry expires after `ttl` seconds.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 3600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteCacheBackend:
+    """
+    Cache shared by the processes of a host, stored in a SQLite file.
+    """
+    def __init__(self, path: str = "completion_cache.db", ttl: float = 3600) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS completion_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, sqlite3 connections can't be shared between threads.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout = 5)
+            connection.execute("PRAGMA journal_mode = WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value FROM completion_cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO completion_cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl)
+            )
+            # Piggyback the cleanup of the expired entries on the writes.
+            connection.execute("DELETE FROM completion_cache WHERE expires <= ?", (time.time(),))
+
+class RedisCacheBackend:
+    """
+    Cache shared between hosts, stored in Redis (needs the `redis` package).
+    """
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: float = 3600, prefix: str = "completion:") -> None:
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str):
+        self.client.set(self.prefix + key, value, ex = int(self.ttl))
+
+class CompletionCache:
+    """
+    Cache of completion answers, in memory (LRU + TTL) and optionally in a shared backend.
+
+    Only deterministic requests are cached: the ones with `temperature` 0, unless
+    `allow_temperature` is set. Keeps hit/miss counters, see `stats`.
+    """
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 3600,
+        backend = None,
+        allow_temperature: bool = False
+    ) -> None:
+
+        self.memory = LRUCache(max_size = max_size, ttl = ttl)
+        self.backend = backend
+        self.allow_temperature = allow_temperature
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+
+    def cacheable(self, **params) -> bool:
+        """
+        Whether a request with these sampling params can be cached. The provider
+        defaults the temperature to 1.
+        """
+        if self.allow_temperature or params.get("temperature", 1) == 0:
+            return True
+        self.skips += 1
+        return False
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            try:
+                value = self.backend.get(key)
+            except Exception as e:
+                log.error(f"Exception occurred reading the completion cache backend: {e}")
+            if value is not None:
+                self.memory.set(key, value)
+        self._count(value)
+        return value
+
+    def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value)
+            except Exception as e:
+                log.error(f"Exception occurred writing the completion cache backend: {e}")
+
+    async def aget(self, key: str) -> Optional[str]:
+        """
+        Same as `get`, the shared backend is read in a thread to not block the event loop.
+        """
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            try:
+                value = await asyncio.to_thread(self.backend.get, key)
+            except Exception as e:
+                log.error(f"Exception occurred reading the completion cache backend: {e}")
+            if value is not None:
+                self.memory.set(key, value)
+        self._count(value)
+        return value
+
+    async def aset(self, key: str, value: str):
+        self.memory.set(key, value)
+        if self.backend is not None:
+            try:
+                await asyncio.to_thread(self.backend.set, key, value)
+            except Exception as e:
+                log.error(f"Exception occurred writing the completion cache backend: {e}")
+
+    def _count(self, value: Optional[str]):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "skips": self.skips,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.memory),
+            "evictions": self.memory.evictions,
+        }
+
+def get_completion_cache_from_env() -> Optional[CompletionCache]:
+    """
+    Build the completion cache configured in the environment, if any:
+    `COMPLETION_CACHE` is `off` (default), `memory`, `sqlite` or `redis`.
+    """
+    kind = os.getenv("COMPLETION_CACHE", "off").lower()
+    if kind in ("", "off", "false", "0"):
+        return None
+
+    ttl = float(os.getenv("COMPLETION_CACHE_TTL", 3600))
+    backend = None
+    if kind == "sqlite":
+        backend = SQLiteCacheBackend(os.getenv("COMPLETION_CACHE_PATH", "completion_cache.db"), ttl = ttl)
+    elif kind == "redis":
+        backend = RedisCacheBackend(os.getenv("COMPLETION_CACHE_REDIS_URL", "redis://localhost:6379/0"), ttl = ttl)
+    elif kind != "memory":
+        raise ValueError(f"Unknown completion cache: {kind}")
+
+    return CompletionCache(
+        max_size = int(os.getenv("COMPLETION_CACHE_SIZE", 1024)),
+        ttl = ttl,
+        backend = backend,
+        allow_temperature = os.getenv("COMPLETION_CACHE_ALLOW_TEMPERATURE", "false").lower() == "true"
+    )
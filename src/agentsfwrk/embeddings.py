@@ -0,0 +1,107 @@
+import importlib
+import os
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+# Embedder of the texts indexed for retrieval: `hashing`, or the import path of a
+# factory returning an `Embedder`, e.g. `mypackage.embedders:create_embedder`.
+DEFAULT_EMBEDDER = os.getenv('MEMORY_EMBEDDER', 'hashing')
+EMBEDDING_DIM = int(os.getenv('MEMORY_EMBEDDING_DIM', 256))
+
+class Embedder:
+    """
+    Interface of the embedding backends, run on the CPU of the app.
+
+    `embed` takes a batch of texts and returns a float32 array of shape
+    `(len(texts), dim)`, the rows normalized to unit length so the dot product of two
+    embeddings is their cosine similarity. `name` identifies the embeddings, an index
+    built with an embedder can only be searched with the same one.
+    """
+    name = "embedder"
+    dim = 0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+_WORD = re.compile(r"[a-z0-9']+")
+_STOP_WORDS = frozenset(
+    "a an and are as at be but by can do for from has have he her his how i if in is it its "
+    "me my no not of on or our she so that the their them there they this to was we were "
+    "what when where which who will with you your".split()
+)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale the rows to unit length, in place, leaving the zero rows alone.
+    """
+    norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    np.divide(vectors, norms, out = vectors, where = norms > 0)
+    return vectors
+
+class HashingEmbedder(Embedder):
+    """
+    Embeddings without a model: the words of a text (but the stop words) are hashed
+    into `dim` signed buckets, weighted by their log frequency. Fast and dependency free,
+    it matches texts sharing words, not synonyms or paraphrases. The more dimensions,
+    the fewer collisions between words.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM) -> None:
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+        # Bucket and sign of the words already seen, hashing is the costly part.
+        self._buckets: Dict[str, int] = {}
+
+    def _bucket(self, word: str) -> int:
+        bucket = self._buckets.get(word)
+        if bucket is None:
+            hashed = zlib.crc32(word.encode())
+            # The sign in the bucket: the collisions cancel out instead of adding up.
+            bucket = (hashed % self.dim + 1) * (1 if hashed & 0x80000000 else -1)
+            if len(self._buckets) < 1_000_000:
+                self._buckets[word] = bucket
+        return bucket
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        rows, buckets = [], []
+        for row, text in enumerate(texts):
+            for word in _WORD.findall((text or "").lower()):
+                if word not in _STOP_WORDS:
+                    rows.append(row)
+                    buckets.append(self._bucket(word))
+
+        vectors = np.zeros((len(texts), self.dim), dtype = np.float32)
+        if rows:
+            buckets = np.array(buckets, dtype = np.int64)
+            np.add.at(vectors, (np.array(rows), np.abs(buckets) - 1), np.sign(buckets).astype(np.float32))
+            # Log frequency, so a repeated word doesn't take over the text.
+            np.copysign(np.log1p(np.abs(vectors)), vectors, out = vectors)
+
+        return normalize(vectors)
+
+def create_embedder(name: str) -> Embedder:
+    """
+    Create an embedder: `hashing`, or the import path of a factory (`module:attribute`).
+    """
+    if name == "hashing":
+        return HashingEmbedder()
+    module, _, attribute = name.partition(":")
+    return getattr(importlib.import_module(module), attribute)()
+
+_embedder: Optional[Embedder] = None
+
+def get_embedder() -> Embedder:
+    """
+    Get the embedder configured in `MEMORY_EMBEDDER`, shared by the app.
+    """
+    global _embedder
+    if _embedder is None:
+        _embedder = create_embedder(DEFAULT_EMBEDDER)
+        log.info("Embedder: %s (%d dimensions)", _embedder.name, _embedder.dim)
+    return _embedder
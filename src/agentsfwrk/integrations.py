@@ -1,26 +1,76 @@
+import asyncio
+import contextlib
 import json
 import os
 import time
-from typing import Union
+from typing import AsyncIterator, Optional, Union
 
 import openai
 from openai.error import APIConnectionError, APIError, RateLimitError
 
 import agentsfwrk.logger as logger
+from agentsfwrk import metrics, ratelimit
+from agentsfwrk.cache import CompletionCache, completion_key, get_completion_cache_from_env
+from agentsfwrk.providers import (
+    CompletionProvider,
+    ProviderError,
+    ProviderRateLimitError,
+    get_provider,
+)
+from agentsfwrk.ratelimit import CircuitOpenError, LimiterTimeout, backoff_delay, get_limiter
+from agentsfwrk.singleflight import SingleFlight
+from agentsfwrk.structured import IncrementalJSONParser, ShapeError, ShapeValidator, compile_shape, loads
 
 log = logger.get_logger(__name__)
 
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# Answer given to the user when the provider keeps failing.
+FALLBACK_ANSWER = "Sorry, I'm having technical issues."
+
+# Opt-in cache of the completion answers, see `agentsfwrk.cache`.
+completion_cache = get_completion_cache_from_env()
+
+# Identical completions requested while one is in flight wait for it instead of
+# calling the provider again, see `agentsfwrk.singleflight`.
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true'
+single_flight = SingleFlight()
+
+def collect_metrics():
+    """
+    Gauges of the completion cache, the single-flight calls and the limiters, see `agentsfwrk.metrics`.
+    """
+    if completion_cache is not None:
+        for name, value in completion_cache.stats().items():
+            yield f"completion_cache_{name}", "Completion cache statistics", {}, value
+    for name, value in single_flight.stats().items():
+        yield f"single_flight_{name}", "Single-flight completion calls", {}, value
+    for key, limiter in ratelimit._limiters.items():
+        stats = limiter.stats()
+        yield "llm_limiter_breaker_open", "Whether the circuit breaker is open (1) or half-open (0.5)", {"limiter": key}, \
+            {"closed": 0, "half-open": 0.5, "open": 1}[stats["breaker"]]
+        yield "llm_limiter_available_requests", "Requests left in the bucket of the limiter", {"limiter": key}, stats["available_requests"]
+        yield "llm_limiter_available_tokens", "Tokens left in the bucket of the limiter", {"limiter": key}, stats["available_tokens"]
+
+metrics.registry.add_collector(collect_metrics)
+
+# Replies that don't match the response shape of the agent (once repaired) are fixed
+# by asking the model again for the failing fields only, see `agentsfwrk.structured`.
+STRUCTURED_REASK = os.getenv('STRUCTURED_REASK', 'true').lower() == 'true'
 
 class OpenAIIntegrationService:
     def __init__(
         self,
         context: Union[str, dict],
-        instruction: Union[str, dict]
+        instruction: Union[str, dict],
+        cache: Optional[CompletionCache] = None,
+        provider: Optional[CompletionProvider] = None
     ) -> None:
 
         self.context = context
         self.instructions = instruction
+        self.cache = cache if cache is not None else completion_cache
+        self.provider = provider if provider is not None else get_provider()
+        # Parsed reply of the last streamed answer, when a response shape was given.
+        self.structured_answer: Optional[dict] = None
 
         if isinstance(self.context, dict):
             self.messages = []
@@ -38,6 +88,23 @@ class OpenAIIntegrationService:
         """
         self.messages += messages
 
+    def _cache_key(self, model: str, **kwargs) -> Optional[str]:
+        """
+        Key of the current messages in the completion cache, None when they can't be cached.
+        """
+        if self.cache is None or not self.cache.cacheable(**kwargs):
+            return None
+        return completion_key(model, self.messages, provider = self.provider.name, **kwargs)
+
+    def _answer_from_cache(self, answer: str) -> dict:
+        self.messages.append(
+            {
+                'role': 'assistant',
+                'content': answer
+            }
+        )
+        return {"answer": answer}
+
     def answer_to_prompt(self, model: str, prompt: str, **kwargs):
         """
         Collects prompts from user, appends to messages from the same conversation
@@ -51,27 +118,244 @@ class OpenAIIntegrationService:
             }
         )
 
-        retry_exceptions = (APIError, APIConnectionError, RateLimitError)
+        cache_key = self._cache_key(model, **kwargs)
+        if cache_key is not None and (cached := self.cache.get(cache_key)) is not None:
+            return self._answer_from_cache(cached)
+
+        response = self._complete(model, self.messages, **kwargs)
+        if response is None:
+            return {
+                "answer": FALLBACK_ANSWER
+            }
+
+        response_message = response["content"]
+        response_data = {"answer": response_message}
+        self.messages.append(
+            {
+                'role': 'assistant',
+                'content': response_message
+            }
+        )
+
+        if cache_key is not None:
+            self.cache.set(cache_key, response_message)
+
+        return response_data
+
+    def _complete(self, model: str, messages: list, **kwargs) -> Optional[dict]:
+        """
+        Blocking version of `_acomplete`, for the callers without an event loop: the calls
+        go through the circuit breaker of the model and back off like the async ones, but
+        the buckets and the concurrency limit of the limiter are only awaitable. Returns
+        None when the last attempt fails or the breaker rejects the call.
+        """
+        limiter = get_limiter(model, self.provider.name)
+        labels = {"provider": self.provider.name, "model": model}
+
         for _ in range(3):
             try:
-                response = openai.ChatCompletion.create(
-                    model       = model,
-                    messages    = self.messages,
-                    **kwargs
+                trial = limiter.breaker.allow()
+            except CircuitOpenError as e:
+                metrics.llm_rejected.inc(**labels)
+                log.error(f"Call to {model} rejected: {e}")
+                return None
+            start = time.perf_counter()
+            try:
+                response = self.provider.complete(model, messages, **kwargs)
+            except ProviderError as e:
+                rate_limited = isinstance(e, ProviderRateLimitError)
+                metrics.llm_request_seconds.observe(
+                    time.perf_counter() - start, outcome = "rate_limited" if rate_limited else "error", **labels
                 )
-                break
-            except retry_exceptions as e:
+                if rate_limited:
+                    limiter.record_rate_limited(e.retry_after or backoff_delay(_))
+                else:
+                    limiter.record_failure()
                 if _ == 2:
                     log.error(f"Last attempt failed, Exception occurred: {e}.")
-                    return {
-                        "answer": "Sorry, I'm having technical issues."
-                    }
-                retry_time = getattr(e, 'retry_after', 3)
-                log.error(f"Exception occurred: {e}. Retrying in {retry_time} seconds...")
+                    return None
+                metrics.llm_retries.inc(reason = "rate_limited" if rate_limited else "error", **labels)
+                retry_time = backoff_delay(_, retry_after = e.retry_after)
+                log.error(f"Exception occurred: {e}. Retrying in {retry_time:.2f} seconds...")
                 time.sleep(retry_time)
+                continue
+            finally:
+                if trial is not None:
+                    limiter.breaker.end_trial(trial)
+            metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome = "success", **labels)
+            usage = response.get("usage")
+            limiter.record_success()
+            if usage:
+                metrics.llm_tokens.inc(usage.get("prompt_tokens", 0), kind = "prompt", **labels)
+                metrics.llm_tokens.inc(usage.get("completion_tokens", 0), kind = "completion", **labels)
+            return response
+
+    async def _acomplete(self, model: str, messages: list, stream: bool = False, **kwargs):
+        """
+        Call the provider through the rate limiter of the model (on that provider), retrying with a
+        jittered, non-blocking backoff. Returns the completion (or, with `stream`,
+        the iterator over its deltas, see `_held_deltas`), None when the last attempt
+        fails or the limiter rejects the call.
+        """
+        limiter = get_limiter(model, self.provider.name)
+        estimated_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4 + kwargs.get("max_tokens", 0)
+        labels = {"provider": self.provider.name, "model": model}
+
+        for _ in range(3):
+            queued = time.perf_counter()
+            try:
+                async with contextlib.AsyncExitStack() as slot:
+                    await slot.enter_async_context(limiter.acquire(tokens = estimated_tokens))
+                    start = time.perf_counter()
+                    metrics.stage_seconds.observe(start - queued, stage = "llm_queue")
+                    if stream:
+                        response = await self.provider.astream(model, messages, **kwargs)
+                        return self._held_deltas(response, slot.pop_all(), limiter, start, labels)
+                    response = await self.provider.acomplete(model, messages, **kwargs)
+                metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome = "success", **labels)
+                usage = response.get("usage")
+                limiter.record_success(estimated_tokens, usage["total_tokens"] if usage else None)
+                if usage:
+                    metrics.llm_tokens.inc(usage.get("prompt_tokens", 0), kind = "prompt", **labels)
+                    metrics.llm_tokens.inc(usage.get("completion_tokens", 0), kind = "completion", **labels)
+                return response
+            except (CircuitOpenError, LimiterTimeout) as e:
+                metrics.llm_rejected.inc(**labels)
+                log.error(f"Call to {model} rejected: {e}")
+                return None
+            except ProviderError as e:
+                rate_limited = isinstance(e, ProviderRateLimitError)
+                metrics.llm_request_seconds.observe(
+                    time.perf_counter() - start, outcome = "rate_limited" if rate_limited else "error", **labels
+                )
+                if rate_limited:
+                    limiter.record_rate_limited(e.retry_after or backoff_delay(_))
+                else:
+                    limiter.record_failure()
+                if _ == 2:
+                    log.error(f"Last attempt failed, Exception occurred: {e}.")
+                    return None
+                metrics.llm_retries.inc(reason = "rate_limited" if rate_limited else "error", **labels)
+                retry_time = backoff_delay(_, retry_after = e.retry_after)
+                log.error(f"Exception occurred: {e}. Retrying in {retry_time:.2f} seconds...")
+            await asyncio.sleep(retry_time)
+
+    async def _held_deltas(
+        self,
+        deltas: AsyncIterator[str],
+        slot: contextlib.AsyncExitStack,
+        limiter: ratelimit.ModelLimiter,
+        start: float,
+        labels: dict
+    ) -> AsyncIterator[str]:
+        """
+        Yield the deltas of a stream holding its limiter `slot` until the stream is
+        exhausted or closed, so the concurrency limit covers the whole stream. Its
+        outcome is recorded once it ends.
+        """
+        async with slot:
+            try:
+                async for delta in deltas:
+                    yield delta
+            except Exception as e:
+                rate_limited = isinstance(e, ProviderRateLimitError)
+                metrics.llm_request_seconds.observe(
+                    time.perf_counter() - start, outcome = "rate_limited" if rate_limited else "error", **labels
+                )
+                if rate_limited:
+                    limiter.record_rate_limited(e.retry_after or backoff_delay(0))
+                else:
+                    limiter.record_failure()
+                log.error(f"Exception occurred while streaming: {e}")
+                raise
+            metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome = "success", **labels)
+            limiter.record_success()
+
+    async def _astructure(self, model: str, validator: ShapeValidator, answer: str, **kwargs) -> Optional[dict]:
+        """
+        Parse and validate an answer against the response shape, repairing it when
+        possible. The fields that are still missing or invalid are asked again (only
+        them), with the answer in the conversation. Returns None when the answer can't
+        be made to match the shape.
+        """
+        try:
+            return validator.parse(answer)
+        except ShapeError as e:
+            error = e
+        if error.data is None or not STRUCTURED_REASK:
+            log.error(f"The answer doesn't match the response shape: {error}")
+            return None
+
+        sub_shape = validator.sub_shape(list(error.errors))
+        log.info(f"Asking again for the fields {list(sub_shape)}: {error.errors}")
+        messages = self.messages + [
+            {
+                'role': 'assistant',
+                'content': answer
+            },
+            {
+                'role': 'user',
+                'content': f"These fields of your reply are missing or invalid: {json.dumps(error.errors)}. "
+                           f"Reply only with a RFC8259 compliant JSON with a shape of: {json.dumps(sub_shape)}"
+            }
+        ]
+        response = await self._acomplete(model, messages, **kwargs)
+        if response is None:
+            return None
+        try:
+            fields = compile_shape(sub_shape).parse(response["content"])
+            return validator.validate({**error.data, **fields})
+        except ShapeError as e:
+            log.error(f"The answer doesn't match the response shape after asking again: {e}")
+            return None
+
+    async def aanswer_to_prompt(self, model: str, prompt: str, response_shape = None, **kwargs):
+        """
+        Async version of `answer_to_prompt`. Uses the pooled HTTP client and never
+        blocks the event loop, not even while backing off between retries.
+
+        With a `response_shape`, the answer is parsed and validated (see `_astructure`)
+        and returned as `data` along with the normalized JSON `answer`.
+        """
+        # Preserve the messages in the conversation
+        self.messages.append(
+            {
+                'role': 'user',
+                'content': prompt
+            }
+        )
+        validator = compile_shape(response_shape)
 
-        response_message = response.choices[0].message["content"]
+        cache_key = self._cache_key(model, **kwargs)
+        if cache_key is not None and (cached := await self.cache.aget(cache_key)) is not None:
+            response_data = self._answer_from_cache(cached)
+            if validator is not None:
+                try:
+                    response_data["data"] = validator.parse(cached)
+                except ShapeError as e:
+                    log.error(f"The cached answer doesn't match the response shape: {e}")
+            return response_data
+
+        if SINGLE_FLIGHT:
+            messages = list(self.messages)
+            response = await single_flight.do(
+                cache_key or completion_key(model, messages, provider = self.provider.name, **kwargs),
+                lambda: self._acomplete(model, messages, **kwargs)
+            )
+        else:
+            response = await self._acomplete(model, self.messages, **kwargs)
+        if response is None:
+            return {
+                "answer": FALLBACK_ANSWER
+            }
+
+        response_message = response["content"]
         response_data = {"answer": response_message}
+        if validator is not None:
+            data = await self._astructure(model, validator, response_message, **kwargs)
+            if data is not None:
+                response_message = json.dumps(data, ensure_ascii = False)
+                response_data = {"answer": response_message, "data": data}
         self.messages.append(
             {
                 'role': 'assistant',
@@ -79,8 +363,66 @@ class OpenAIIntegrationService:
             }
         )
 
+        if cache_key is not None:
+            await self.cache.aset(cache_key, response_message)
+
         return response_data
 
+    async def astream_answer_to_prompt(self, model: str, prompt: str, response_shape = None, **kwargs) -> AsyncIterator[str]:
+        """
+        Streaming version of `aanswer_to_prompt`. Yields the content deltas of the
+        response as they arrive, the assembled response is appended to the messages
+        once the stream ends.
+
+        With a `response_shape`, the reply is followed while it streams and its parsed
+        data is left in `structured_answer` once the stream ends.
+        """
+        self.messages.append(
+            {
+                'role': 'user',
+                'content': prompt
+            }
+        )
+        validator = compile_shape(response_shape)
+        self.structured_answer = None
+
+        cache_key = self._cache_key(model, **kwargs)
+        if cache_key is not None and (cached := await self.cache.aget(cache_key)) is not None:
+            yield cached
+            if validator is not None:
+                self.structured_answer = await self._astructure(model, validator, cached, **kwargs)
+            self._answer_from_cache(cached)
+            return
+
+        deltas = await self._acomplete(model, self.messages, stream = True, **kwargs)
+        if deltas is None:
+            chunks = [FALLBACK_ANSWER]
+            yield chunks[0]
+        else:
+            chunks = []
+            parser = IncrementalJSONParser()
+            try:
+                async for delta in deltas:
+                    chunks.append(delta)
+                    parser.feed(delta)
+                    yield delta
+            finally:
+                # Give the limiter slot back now, not when the iterator is collected.
+                await deltas.aclose()
+            if validator is not None:
+                # NOTE: The deltas are already sent, the answer is kept as streamed
+                # and only its parsed data is repaired.
+                self.structured_answer = await self._astructure(model, validator, parser.json_text, **kwargs)
+            if cache_key is not None:
+                await self.cache.aset(cache_key, "".join(chunks))
+
+        self.messages.append(
+            {
+                'role': 'assistant',
+                'content': "".join(chunks)
+            }
+        )
+
     def answer_to_simple_prompt(self, model: str, prompt: str, **kwargs) -> dict:
         """
         Collects context and appends a prompt from a user and return response from
@@ -104,7 +446,7 @@ class OpenAIIntegrationService:
                     log.error(f"Last attempt failed, Exception occurred: {e}.")
                     return {
                         "intent": False,
-                        "answer": "Sorry, I'm having technical issues."
+                        "answer": FALLBACK_ANSWER
                     }
                 retry_time = getattr(e, 'retry_after', 3)
                 log.error(f"Exception occurred: {e}. Retrying in {retry_time} seconds...")
@@ -113,7 +455,7 @@ class OpenAIIntegrationService:
         response_message = response.choices[0].text
 
         try:
-            response_data = json.loads(response_message)
+            response_data = loads(response_message)
             answer_text = response_data.get('answer')
             if answer_text is not None:
                 self.messages = self.messages + f"\n<Client>: {prompt} \n" + f"<Agent>: {answer_text} \n"
@@ -146,26 +488,32 @@ class OpenAIIntegrationService:
         messages = self.messages.copy()
         messages.append(self.instructions)
 
-        retry_exceptions = (APIError, APIConnectionError, RateLimitError)
-        for _ in range(3):
-            try:
-                response = openai.ChatCompletion.create(
-                    model       = model,
-                    messages    = messages,
-                    **kwargs
-                )
-                break
-            except retry_exceptions as e:
-                if _ == 2:
-                    log.error(f"Last attempt failed, Exception occurred: {e}.")
-                    raise
-                retry_time = getattr(e, 'retry_after', 3)
-                log.error(f"Exception occurred: {e}. Retrying in {retry_time} seconds...")
-                time.sleep(retry_time)
+        response = self._complete(model, messages, **kwargs)
+        if response is None:
+            raise ProviderError(f"The goal of the conversation could not be verified with {model}")
+
+        return self._parse_goal(response["content"])
 
-        response_message = response.choices[0].message["content"]
+    async def averify_goal_conversation(self, model: str, **kwargs):
+        """
+        Async version of `verify_goal_conversation`, the call goes through the rate
+        limiter of the model like the chat turns.
+        """
+        messages = self.messages.copy()
+        messages.append(self.instructions)
+
+        response = await self._acomplete(model, messages, **kwargs)
+        if response is None:
+            raise ProviderError(f"The goal of the conversation could not be verified with {model}")
+
+        return self._parse_goal(response["content"])
+
+    def _parse_goal(self, response_message: str) -> dict:
+        """
+        Parse the answer of a goal verification, it must hold a `summary`.
+        """
         try:
-            response_data = json.loads(response_message)
+            response_data = loads(response_message)
             if response_data.get('summary') is None:
                 raise ValueError("The response from the model is not valid. Missing summary.")
         except ValueError as e:
@@ -1,27 +1,167 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import multiprocessing
+import os
+import queue
+import random
 import sys
+from datetime import datetime, timezone
+from typing import Optional
 
 APP_LOGGER_NAME = 'CaiApp'
 
-def setup_applevel_logger(logger_name = APP_LOGGER_NAME, file_name = None):
+# Logging settings, see `setup_applevel_logger`.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+LOG_MAX_LENGTH = int(os.getenv('LOG_MAX_LENGTH', 2000))
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 1.0))
+
+# Attributes of every `LogRecord`, anything else was passed in `extra`.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+def _truncate(message: str, max_length: int) -> str:
+    if max_length and len(message) > max_length:
+        return f"{message[:max_length]}... [{len(message) - max_length} more characters]"
+    return message
+
+class TruncatingFormatter(logging.Formatter):
+    """
+    Text formatter that cuts the messages longer than `max_length` characters.
+    """
+    def __init__(self, fmt: str = None, max_length: int = LOG_MAX_LENGTH) -> None:
+        super().__init__(fmt)
+        self.max_length = max_length
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = _truncate(record.message, self.max_length)
+        return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record, with the fields given in `extra` and the messages
+    longer than `max_length` characters cut.
+    """
+    def __init__(self, max_length: int = LOG_MAX_LENGTH) -> None:
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": _truncate(record.getMessage(), self.max_length),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default = str, ensure_ascii = False)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a `rate` fraction of the records below `WARNING`, all the others.
+    """
+    def __init__(self, rate: float = LOG_SAMPLE_RATE) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    `QueueHandler` that leaves the formatting of the records to the listener thread,
+    the logging call only puts the record in the queue.
+
+    NOTE: The arguments of the message are formatted later, so they must not be
+    changed after the logging call (log copies or immutable values).
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # The traceback doesn't survive the call, format it now.
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def stop_logging():
+    """
+    Stop the listener of the async logging, writing the records still queued.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def configure_levels(logger_name: str = APP_LOGGER_NAME, levels: str = LOG_LEVELS):
     """
-    Setup the logger for the application
+    Set the level of some loggers, from e.g. `agents.api.routes=INFO,agentsfwrk=WARNING`.
+    The names are relative to the application logger.
+    """
+    for setting in filter(None, (part.strip() for part in levels.split(","))):
+        name, _, level = setting.partition("=")
+        logging.getLogger(f"{logger_name}.{name.strip()}").setLevel(level.strip().upper())
+
+def setup_applevel_logger(
+    logger_name = APP_LOGGER_NAME,
+    file_name = None,
+    level: str = LOG_LEVEL,
+    fmt: str = LOG_FORMAT,
+    async_mode: bool = LOG_ASYNC,
+    sample_rate: float = LOG_SAMPLE_RATE,
+    stream = None
+):
+    """
+    Setup the logger for the application.
+
+    In `async_mode` the logging calls only queue the records, a listener thread
+    formats and writes them, so the disk and stdout I/O are off the request path.
+    `fmt` is `text` or `json`, `sample_rate` is the fraction of the records below
+    `WARNING` that are kept. The levels of single loggers can be set in `LOG_LEVELS`.
     """
+    global _listener
+    stop_logging()
+
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    sh = logging.StreamHandler(sys.stdout)
+    logger.setLevel(level)
+    if fmt == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TruncatingFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handlers = []
+    sh = logging.StreamHandler(stream or sys.stdout)
     sh.setFormatter(formatter)
-    logger.handlers.clear()
-    logger.addHandler(sh)
+    handlers.append(sh)
     if file_name:
         fh = logging.FileHandler(file_name)
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        handlers.append(fh)
+
+    logger.handlers.clear()
+    if async_mode:
+        qh = LazyQueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(qh.queue, *handlers, respect_handler_level = True)
+        _listener.start()
+        handlers = [qh]
+    for handler in handlers:
+        if sample_rate < 1:
+            handler.addFilter(SamplingFilter(sample_rate))
+        logger.addHandler(handler)
+    configure_levels(logger_name)
 
     return logger
 
+atexit.register(stop_logging)
+
 def get_multiprocessing_logger(file_name = None):
     """
     Setup the logger for the application for multiprocessing
@@ -0,0 +1,298 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+# With the metrics disabled every recording call returns right away.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Latency buckets (seconds), from a fast database query to a slow completion.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += self.samples()
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """
+    Monotonic counter, e.g. the number of retries.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. durations) in cumulative buckets.
+    """
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per labels: the count of each bucket (plus +Inf), the sum and the count.
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block.
+        """
+        if not METRICS_ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: dict) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+_NULL_TIMER = contextlib.nullcontext()
+
+class Registry:
+    """
+    The metrics of the process, plus collectors that report the current value of
+    gauges (e.g. cache sizes) when the metrics are rendered.
+    """
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, dict, float]]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, dict, float]]]):
+        """
+        Add a function returning gauge samples, as `(name, documentation, labels, value)`.
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = [metric.render() for metric in metrics]
+
+        gauges: Dict[str, Tuple[str, List[str]]] = {}
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                log.error(f"Exception occurred collecting metrics: {e}")
+                continue
+            for name, documentation, labels, value in samples:
+                names = tuple(labels)
+                line = f"{name}{_format_labels(names, tuple(labels.values()))} {_format_value(value)}"
+                gauges.setdefault(name, (documentation, []))[1].append(line)
+        for name, (documentation, lines) in gauges.items():
+            blocks.append("\n".join([f"# HELP {name} {documentation}", f"# TYPE {name} gauge"] + lines))
+
+        return "\n".join(blocks) + "\n"
+
+registry = Registry()
+
+########################################
+# Metrics of the services
+########################################
+stage_seconds = registry.histogram(
+    "agents_stage_seconds", "Duration of the stages of the chat requests", ("stage",)
+)
+http_request_seconds = registry.histogram(
+    "http_request_seconds", "Duration of the HTTP requests", ("method", "route", "status")
+)
+llm_request_seconds = registry.histogram(
+    "llm_request_seconds", "Duration of the calls to the completion providers", ("provider", "model", "outcome")
+)
+llm_retries = registry.counter(
+    "llm_retries_total", "Completion calls retried", ("provider", "model", "reason")
+)
+llm_rejected = registry.counter(
+    "llm_rejected_total", "Completion calls rejected by the client-side limiter", ("provider", "model")
+)
+llm_tokens = registry.counter(
+    "llm_tokens_total", "Tokens used by the completions", ("provider", "model", "kind")
+)
+db_queries = registry.counter(
+    "db_queries_total", "Database statements executed", ("engine",)
+)
+db_query_seconds = registry.histogram(
+    "db_query_seconds", "Duration of the database statements", ("engine",)
+)
+
+def stage(name: str):
+    """
+    Context manager timing a stage of a request, e.g. `with metrics.stage("history_load"):`.
+    """
+    return stage_seconds.time(stage = name)
+
+def instrument_engine(engine, name: str = "sync"):
+    """
+    Count and time the statements executed by a SQLAlchemy engine (for an async
+    engine, pass its `sync_engine`).
+    """
+    if not METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - conn.info.pop("query_start", time.perf_counter()), engine = name)
+        db_queries.inc(engine = name)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the duration of the HTTP requests, until the last byte
+    of the response is sent (so streamed responses are measured whole).
+    """
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            # The route template, so the paths with ids don't make a label each.
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - start,
+                method = scope["method"],
+                route = getattr(route, "path", "unmatched"),
+                status = status
+            )
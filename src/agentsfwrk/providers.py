@@ -0,0 +1,355 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+import openai
+from openai.error import APIConnectionError, APIError, RateLimitError
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+openai.api_key = os.getenv('OPENAI_API_KEY')
+
+# Size of the pooled HTTP client shared by all the async calls to the providers.
+HTTP_POOL_SIZE = int(os.getenv('OPENAI_HTTP_POOL_SIZE', 100))
+HTTP_TIMEOUT = float(os.getenv('OPENAI_HTTP_TIMEOUT', 60))
+
+_aiosession: Optional[aiohttp.ClientSession] = None
+
+def get_aiosession() -> aiohttp.ClientSession:
+    """
+    Get the pooled HTTP client used by the async calls, creating it if needed.
+    Must be called from within the running event loop.
+    """
+    global _aiosession
+    if _aiosession is None or _aiosession.closed:
+        _aiosession = aiohttp.ClientSession(
+            connector   = aiohttp.TCPConnector(limit = HTTP_POOL_SIZE),
+            timeout     = aiohttp.ClientTimeout(total = HTTP_TIMEOUT)
+        )
+    return _aiosession
+
+async def close_aiosession():
+    """
+    Close the pooled HTTP client, e.g. on application shutdown.
+    """
+    global _aiosession
+    if _aiosession is not None and not _aiosession.closed:
+        await _aiosession.close()
+    _aiosession = None
+
+class ProviderError(Exception):
+    """
+    A completion call failed in a way worth retrying.
+    """
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ProviderRateLimitError(ProviderError):
+    """
+    The provider rate limited the call.
+    """
+
+class UnknownProviderError(ValueError):
+    """
+    No provider is configured with that name.
+    """
+
+class CompletionProvider:
+    """
+    Interface of the chat completion backends.
+
+    `complete` and `acomplete` return a dict with the `content` of the answer and the
+    token `usage` (if known). `astream` returns, once the call is accepted, an async
+    iterator over the content deltas. Failures worth a retry raise `ProviderError`.
+    """
+    name = "provider"
+
+    def complete(self, model: str, messages: List[dict], **params) -> dict:
+        raise NotImplementedError
+
+    async def acomplete(self, model: str, messages: List[dict], **params) -> dict:
+        raise NotImplementedError
+
+    async def astream(self, model: str, messages: List[dict], **params) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """
+    Seconds to wait before retrying, as requested by the provider (if it did).
+    """
+    retry_after = getattr(e, 'retry_after', None) or (getattr(e, 'headers', None) or {}).get('retry-after')
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+class OpenAIProvider(CompletionProvider):
+    """
+    OpenAI chat completions, or any OpenAI compatible server (e.g. llama.cpp or vLLM)
+    when given its `api_base`. With `model`, every call uses that model instead of
+    the requested one.
+    """
+    def __init__(
+        self,
+        name: str = "openai",
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> None:
+
+        self.name = name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+
+    def _request_params(self, model: str) -> dict:
+        params = {"model": self.model or model}
+        if self.api_base:
+            params["api_base"] = self.api_base
+        if self.api_key:
+            params["api_key"] = self.api_key
+        return params
+
+    def _error(self, e: Exception) -> ProviderError:
+        if isinstance(e, RateLimitError):
+            return ProviderRateLimitError(str(e), _retry_after(e))
+        return ProviderError(str(e), _retry_after(e))
+
+    @staticmethod
+    def _result(response) -> dict:
+        return {
+            "content": response.choices[0].message["content"],
+            "usage": response.get("usage"),
+        }
+
+    def complete(self, model: str, messages: List[dict], **params) -> dict:
+        try:
+            response = openai.ChatCompletion.create(messages = messages, **self._request_params(model), **params)
+        except (APIError, APIConnectionError, RateLimitError) as e:
+            raise self._error(e) from e
+        return self._result(response)
+
+    async def acomplete(self, model: str, messages: List[dict], **params) -> dict:
+        session_token = openai.aiosession.set(get_aiosession())
+        try:
+            response = await openai.ChatCompletion.acreate(messages = messages, **self._request_params(model), **params)
+        except (APIError, APIConnectionError, RateLimitError) as e:
+            raise self._error(e) from e
+        finally:
+            openai.aiosession.reset(session_token)
+        return self._result(response)
+
+    async def astream(self, model: str, messages: List[dict], **params) -> AsyncIterator[str]:
+        session_token = openai.aiosession.set(get_aiosession())
+        try:
+            response = await openai.ChatCompletion.acreate(
+                messages = messages, stream = True, **self._request_params(model), **params
+            )
+        except (APIError, APIConnectionError, RateLimitError) as e:
+            raise self._error(e) from e
+        finally:
+            openai.aiosession.reset(session_token)
+
+        async def deltas():
+            async for chunk in response:
+                delta = chunk.choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+        return deltas()
+
+class FakeProvider(CompletionProvider):
+    """
+    Deterministic in-process provider for load tests: the same messages always get
+    the same answer, after `latency` seconds.
+    """
+    def __init__(self, name: str = "fake", latency: float = 0.0, token_delay: float = 0.0) -> None:
+        self.name = name
+        self.latency = latency
+        self.token_delay = token_delay
+
+    def _answer(self, messages: List[dict]) -> str:
+        digest = hashlib.sha256(json.dumps(messages, sort_keys = True).encode("utf-8")).hexdigest()
+        prompt = messages[-1]["content"] if messages else ""
+        return json.dumps({"answer": f"Fake answer {digest[:8]} to: {prompt[:100]}"})
+
+    def _result(self, messages: List[dict]) -> dict:
+        content = self._answer(messages)
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "content": content,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def complete(self, model: str, messages: List[dict], **params) -> dict:
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def acomplete(self, model: str, messages: List[dict], **params) -> dict:
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+    async def astream(self, model: str, messages: List[dict], **params) -> AsyncIterator[str]:
+        await asyncio.sleep(self.latency)
+        words = self._answer(messages).split(" ")
+
+        async def deltas():
+            for i, word in enumerate(words):
+                yield word if i == 0 else " " + word
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+
+        return deltas()
+
+class RoutingProvider(CompletionProvider):
+    """
+    Routes the calls between providers. With the `fallback` strategy the providers are
+    tried in order, with `latency` the fastest one so far (moving average) goes first,
+    and a random one every `explore` fraction of the calls so the others are re-measured.
+    The next provider is tried when one fails.
+    """
+    def __init__(
+        self,
+        providers: List[CompletionProvider],
+        name: str = "routing",
+        strategy: str = "fallback",
+        explore: float = 0.05,
+        smoothing: float = 0.2
+    ) -> None:
+
+        if strategy not in ("fallback", "latency"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.name = name
+        self.providers = providers
+        self.strategy = strategy
+        self.explore = explore
+        self.smoothing = smoothing
+        self.latencies: Dict[str, Optional[float]] = {provider.name: None for provider in providers}
+
+    def _order(self) -> List[CompletionProvider]:
+        if self.strategy == "fallback":
+            return list(self.providers)
+        # Providers without measurements first, so they get measured.
+        ordered = sorted(
+            self.providers,
+            key = lambda provider: (self.latencies[provider.name] is not None, self.latencies[provider.name] or 0)
+        )
+        if len(ordered) > 1 and random.random() < self.explore:
+            ordered.insert(0, ordered.pop(random.randrange(1, len(ordered))))
+        return ordered
+
+    def _record(self, provider: CompletionProvider, latency: float):
+        previous = self.latencies[provider.name]
+        self.latencies[provider.name] = latency if previous is None else (
+            self.smoothing * latency + (1 - self.smoothing) * previous
+        )
+
+    def _record_failure(self, provider: CompletionProvider, e: Exception):
+        log.error(f"Provider {provider.name} failed: {e}")
+        # A failure counts as a call that timed out, so the provider drops in the latency order.
+        self._record(provider, HTTP_TIMEOUT)
+
+    def complete(self, model: str, messages: List[dict], **params) -> dict:
+        error = None
+        for provider in self._order():
+            start = time.perf_counter()
+            try:
+                result = provider.complete(model, messages, **params)
+            except ProviderError as e:
+                self._record_failure(provider, e)
+                error = e
+                continue
+            self._record(provider, time.perf_counter() - start)
+            return result
+        raise error
+
+    async def acomplete(self, model: str, messages: List[dict], **params) -> dict:
+        error = None
+        for provider in self._order():
+            start = time.perf_counter()
+            try:
+                result = await provider.acomplete(model, messages, **params)
+            except ProviderError as e:
+                self._record_failure(provider, e)
+                error = e
+                continue
+            self._record(provider, time.perf_counter() - start)
+            return result
+        raise error
+
+    async def astream(self, model: str, messages: List[dict], **params) -> AsyncIterator[str]:
+        # NOTE: Only the time to open the stream is measured.
+        error = None
+        for provider in self._order():
+            start = time.perf_counter()
+            try:
+                deltas = await provider.astream(model, messages, **params)
+            except ProviderError as e:
+                self._record_failure(provider, e)
+                error = e
+                continue
+            self._record(provider, time.perf_counter() - start)
+            return deltas
+        raise error
+
+DEFAULT_PROVIDER = os.getenv('LLM_PROVIDER', 'openai')
+
+def _create_provider(name: str, settings: dict, providers: Dict[str, CompletionProvider]) -> CompletionProvider:
+    settings = dict(settings)
+    kind = settings.pop("type", "openai")
+    if kind == "openai":
+        return OpenAIProvider(name = name, **settings)
+    if kind == "fake":
+        return FakeProvider(name = name, **settings)
+    if kind == "routing":
+        members = [providers[member] for member in settings.pop("providers")]
+        return RoutingProvider(members, name = name, **settings)
+    raise ValueError(f"Unknown provider type: {kind}")
+
+def _providers_from_env() -> Dict[str, CompletionProvider]:
+    """
+    Create the providers configured in `LLM_PROVIDERS`, a json of name to settings, e.g.
+    `{"local": {"type": "openai", "api_base": "http://localhost:8080/v1", "model": "llama-3-8b"},
+    "auto": {"type": "routing", "providers": ["local", "openai"], "strategy": "latency"}}`.
+    Routing providers can only use the providers defined before them.
+    """
+    providers = {"openai": OpenAIProvider(), "fake": FakeProvider()}
+    for name, settings in json.loads(os.getenv("LLM_PROVIDERS", "{}")).items():
+        providers[name] = _create_provider(name, settings, providers)
+    return providers
+
+_providers: Optional[Dict[str, CompletionProvider]] = None
+
+def get_provider_names() -> List[str]:
+    """
+    Get the names of the configured providers.
+    """
+    global _providers
+    if _providers is None:
+        _providers = _providers_from_env()
+    return list(_providers)
+
+def get_provider(name: Optional[str] = None) -> CompletionProvider:
+    """
+    Get a configured provider by name, the default one (`LLM_PROVIDER`) if not given.
+    """
+    global _providers
+    if _providers is None:
+        _providers = _providers_from_env()
+    name = name or DEFAULT_PROVIDER
+    if name not in _providers:
+        raise UnknownProviderError(f"Unknown provider: {name}")
+    return _providers[name]
@@ -0,0 +1,246 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import time
+from typing import Dict, Optional
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+class LimiterTimeout(Exception):
+    """
+    Raised when a call can't get its turn before its deadline.
+    """
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the circuit breaker is open: the provider is failing, calls fail fast.
+    """
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 20, retry_after: Optional[float] = None) -> float:
+    """
+    Exponential backoff with full jitter, so the callers that failed together don't
+    retry together. Never shorter than the `retry_after` given by the provider.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate_per_minute`, up to `capacity` (a minute worth by default).
+    Waiters are served in order.
+    """
+    def __init__(self, rate_per_minute: float, capacity: float = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1, deadline: Optional[float] = None):
+        """
+        Take `amount` tokens, waiting for the refill. Raises `LimiterTimeout` if they
+        won't be available before the `deadline` (a `time.monotonic` value).
+        """
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                wait = max(self.paused_until - now, (amount - self.tokens) / self.rate if self.tokens < amount else 0)
+                if wait <= 0:
+                    self.tokens -= amount
+                    return
+                if deadline is not None and now + wait > deadline:
+                    raise LimiterTimeout(f"Rate limit: {wait:.2f}s wait exceeds the deadline")
+                await asyncio.sleep(wait)
+
+    def refund(self, amount: float):
+        """
+        Give back tokens taken in excess (e.g. when the estimate was above the usage),
+        or take more with a negative amount.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for a while, e.g. when the provider answers with a 429.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, calls then fail fast for
+    `reset_timeout` seconds. After that one trial call is let through (half-open):
+    success closes the circuit, failure opens it again. A trial ending without either
+    (rate limited, cancelled...) lets the next call try.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial: Optional[object] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> Optional[object]:
+        """
+        Raise `CircuitOpenError` if the call can't go through. Returns the trial
+        held by the call when the circuit is half-open, to end it with `end_trial`.
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self._trial is not None):
+            raise CircuitOpenError("The provider is failing, circuit breaker is open")
+        if state == "half-open":
+            self._trial = object()
+            return self._trial
+        return None
+
+    def end_trial(self, trial: Optional[object] = None):
+        """
+        End the half-open trial (only `trial`, if given) without recording an outcome.
+        """
+        if trial is None or self._trial is trial:
+            self._trial = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial is not None:
+                log.error(f"Circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self._trial = None
+
+class ModelLimiter:
+    """
+    Client-side governor of the calls to a model: requests/min and tokens/min buckets,
+    a bounded number of concurrent calls, a deadline for the queued calls and a
+    circuit breaker.
+    """
+    def __init__(
+        self,
+        rpm: float = 3500,
+        tpm: float = 90000,
+        max_concurrency: int = 32,
+        timeout: float = 30,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30
+    ) -> None:
+
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.rejected = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, tokens: float = 0, timeout: Optional[float] = None):
+        """
+        Wait for the turn of a call estimated to use `tokens`, for up to `timeout` seconds.
+        Raises `CircuitOpenError` or `LimiterTimeout` when the call should not be made.
+        """
+        try:
+            trial = self.breaker.allow()
+        except CircuitOpenError:
+            self.rejected += 1
+            raise
+        # NOTE: The outcome of the call is recorded by the caller, a trial left without
+        # one (limiter timeout, cancelled or failed call) is ended here so the breaker
+        # doesn't stay half-open with a trial that never ends.
+        try:
+            try:
+                deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+                await self.requests.acquire(1, deadline)
+                await self.tokens.acquire(tokens, deadline)
+                try:
+                    await asyncio.wait_for(self.semaphore.acquire(), max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    raise LimiterTimeout("Concurrency limit: no slot before the deadline")
+            except LimiterTimeout:
+                self.rejected += 1
+                raise
+            try:
+                yield self
+            finally:
+                self.semaphore.release()
+        finally:
+            if trial is not None:
+                self.breaker.end_trial(trial)
+
+    def record_success(self, estimated_tokens: float = 0, used_tokens: Optional[float] = None):
+        self.breaker.record_success()
+        if used_tokens is not None:
+            self.tokens.refund(estimated_tokens - used_tokens)
+
+    def record_failure(self):
+        self.breaker.record_failure()
+
+    def record_rate_limited(self, retry_after: float):
+        """
+        The provider rate limited us: hold every call to this model, not just the one
+        that got the 429. The provider answered, a half-open trial ends without failure.
+        """
+        self.requests.pause(retry_after)
+        self.breaker.end_trial()
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.state,
+            "rejected": self.rejected,
+            "available_requests": self.requests.tokens,
+            "available_tokens": self.tokens.tokens,
+        }
+
+def _limits_from_env() -> Dict[str, dict]:
+    """
+    Per model limits, from the `LLM_RATE_LIMITS` json, e.g. `{"gpt-4": {"rpm": 200, "tpm": 40000}}`.
+    Limits of a model on a given provider use the `provider/model` key.
+    """
+    return json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
+
+_limiters: Dict[str, ModelLimiter] = {}
+
+def get_limiter(model: str, provider: Optional[str] = None) -> ModelLimiter:
+    """
+    Get the limiter of a model (on a provider), created with the limits from the environment.
+    """
+    key = f"{provider}/{model}" if provider else model
+    limiter = _limiters.get(key)
+    if limiter is None:
+        settings = {
+            "rpm": float(os.getenv("LLM_RPM", 3500)),
+            "tpm": float(os.getenv("LLM_TPM", 90000)),
+            "max_concurrency": int(os.getenv("LLM_MAX_CONCURRENCY", 32)),
+            "timeout": float(os.getenv("LLM_QUEUE_TIMEOUT", 30)),
+            "failure_threshold": int(os.getenv("LLM_BREAKER_THRESHOLD", 5)),
+            "reset_timeout": float(os.getenv("LLM_BREAKER_RESET", 30)),
+        }
+        limits = _limits_from_env()
+        settings.update(limits.get(key, limits.get(model, {})))
+        limiter = _limiters[key] = ModelLimiter(**settings)
+    return limiter
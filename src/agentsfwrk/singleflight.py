@@ -0,0 +1,65 @@
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+class _Flight:
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller starts
+    the call, the ones arriving while it's in flight wait for it and get the same result.
+
+    A waiter that is cancelled (e.g. its client disconnected) stops waiting without
+    affecting the others, the call itself is only cancelled once nobody waits for it.
+    """
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        """
+        Get the result of `fn()`, shared with the concurrent calls of the same `key`.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.calls += 1
+        else:
+            self.collapsed += 1
+            log.debug("Joined the in-flight call %s (%d waiting)", key[:12], flight.waiters)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # Callers arriving from now on start a new call.
+                self._forget(key, flight)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+            "in_flight": self.in_flight,
+        }
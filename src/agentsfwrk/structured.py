@@ -0,0 +1,350 @@
+import functools
+import json
+import re
+from typing import Dict, List, Optional, Union
+
+import agentsfwrk.logger as logger
+
+log = logger.get_logger(__name__)
+
+class ShapeError(ValueError):
+    """
+    A reply doesn't match the response shape. `errors` maps the failing fields to the
+    reason, `data` is what could be parsed (None when the reply is not JSON at all).
+    """
+    def __init__(self, message: str, errors: Dict[str, str] = None, data: Optional[dict] = None) -> None:
+        super().__init__(message)
+        self.errors = errors or {}
+        self.data = data
+
+########################################
+# Repair
+########################################
+# NOTE: The fixes are regex substitutions over the text outside the strings, joined
+# in one piece, so nothing inside the strings is touched. Replies are often large,
+# a python loop over their characters (or strings) would be much slower than parsing.
+_STRINGS = re.compile(r'("(?:[^"\\]|\\.)*")', re.DOTALL)
+_SEPARATOR = "\x00"
+_TRAILING_COMMA = re.compile(r',(?=\s*[}\]])')
+_PY_LITERALS = re.compile(r'\b(True|False|None)\b')
+_PY_TO_JSON = {"True": "true", "False": "false", "None": "null"}
+_BRACKETS = re.compile(r'[{}\[\]]')
+_CLOSING = {"{": "}", "[": "]"}
+_PARTIAL_LITERAL = re.compile(r'([:\[,]\s*)([tfn][a-z]*)$')
+_LITERALS = {"t": "true", "f": "false", "n": "null"}
+_DANGLING_KEY = re.compile(r'([{,])\s*"(?:[^"\\]|\\.)*"$', re.DOTALL)
+
+# Raw control characters (e.g. new lines) in strings are accepted.
+_decoder = json.JSONDecoder(strict = False)
+
+def _complete_prefix(text: str) -> Optional[str]:
+    """
+    The complete JSON value at the start of the text (dropping what follows), if any.
+    """
+    try:
+        return text[:_decoder.raw_decode(text)[1]]
+    except ValueError:
+        return None
+
+def repair_json(text: str) -> str:
+    """
+    Fix the usual malformations of the JSON written by a model: markdown code fences,
+    prose around the object, trailing commas, python literals, and a reply cut off
+    before its end (the open strings and brackets are closed). Raw control characters
+    in strings are left as they are, `loads` accepts them.
+    """
+    fence = text.find("```")
+    if fence != -1:
+        # Skip the language of the fence, e.g. ```json
+        body = text.find("\n", fence)
+        end = text.find("```", fence + 3)
+        text = text[body if body != -1 and (end == -1 or body < end) else fence + 3:end if end != -1 else len(text)]
+    start = min((i for i in (text.find("{"), text.find("[")) if i != -1), default = -1)
+    if start == -1:
+        return text.strip()
+    text = text[start:]
+    if (complete := _complete_prefix(text)) is not None:
+        return complete
+
+    # Odd parts are the strings, the last one can be cut off (left in the last even part).
+    parts = _STRINGS.split(text)
+    open_string = ""
+    if (quote := parts[-1].find('"')) != -1:
+        parts[-1], open_string = parts[-1][:quote], parts[-1][quote:]
+    outside = _TRAILING_COMMA.sub('', _SEPARATOR.join(parts[0::2]))
+    if "True" in outside or "False" in outside or "None" in outside:
+        outside = _PY_LITERALS.sub(lambda m: _PY_TO_JSON[m.group()], outside)
+    fixed = outside.split(_SEPARATOR)
+    if len(fixed) == len(parts[0::2]):
+        parts[0::2] = fixed
+    text = "".join(parts)
+    if not open_string and (complete := _complete_prefix(text)) is not None:
+        return complete
+
+    # Cut off reply: close the open string, drop a dangling separator or key,
+    # and close the open brackets.
+    if open_string:
+        backslashes = len(open_string) - len(open_string.rstrip("\\"))
+        text += open_string[:len(open_string) - backslashes % 2] + '"'
+    stack = []
+    for bracket in _BRACKETS.finditer(outside):
+        char = bracket.group()
+        if char in _CLOSING:
+            stack.append(_CLOSING[char])
+        elif stack:
+            stack.pop()
+
+    text = text.rstrip()
+    text = _PARTIAL_LITERAL.sub(lambda m: m.group(1) + _LITERALS[m.group(2)[0]], text)
+    text = re.sub(r'(?<=\d)[.eE+-]+$', '', text)
+    text = re.sub(r'[,:]\s*$', '', text)
+    if stack and stack[-1] == "}":
+        text = _DANGLING_KEY.sub(r'\1', text).rstrip(",")
+    return re.sub(r',(\s*)$', r'\1', text) + "".join(reversed(stack))
+
+def loads(text: str):
+    """
+    `json.loads` that repairs the reply when it isn't valid JSON as is.
+    Raises `ValueError` when it can't be repaired.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    repaired = repair_json(text)
+    log.info("Repaired a malformed JSON reply")
+    return _decoder.decode(repaired)
+
+########################################
+# Response shape
+########################################
+_TYPE_NAMES = {
+    "str": str, "string": str, "text": str,
+    "int": int, "integer": int,
+    "float": float, "number": float,
+    "bool": bool, "boolean": bool,
+    "list": list, "array": list,
+    "dict": dict, "object": dict,
+}
+
+class ShapeValidator:
+    """
+    Validator compiled from a `response_shape`: an example of the reply, where each
+    value gives the type of its field, either as a value (`true`, `0`, `[...]`,
+    `{...}`) or as a type name (`"bool"`, `"number"`...). Any other string is
+    a description of a string field, `null` accepts anything.
+    """
+    def __init__(self, shape: dict) -> None:
+        self.shape = shape
+        self.fields = {key: self._compile(value) for key, value in shape.items()}
+
+    @classmethod
+    def _compile(cls, value):
+        if isinstance(value, dict):
+            return cls(value)
+        if isinstance(value, list):
+            return [cls._compile(value[0]) if value else None]
+        if isinstance(value, bool):
+            return bool
+        if isinstance(value, (int, float)):
+            return float
+        if isinstance(value, str):
+            return _TYPE_NAMES.get(value.strip().lower(), str)
+        return None
+
+    @staticmethod
+    def _check(spec, value, path: str, errors: Dict[str, str]):
+        """
+        Check (and coerce, when it's lossless) a value, returns the value to keep.
+        """
+        if spec is None:
+            return value
+        if isinstance(spec, ShapeValidator):
+            if not isinstance(value, dict):
+                errors[path] = "expected an object"
+                return value
+            return spec._validate(value, path + ".", errors)
+        if isinstance(spec, list):
+            if not isinstance(value, list):
+                errors[path] = "expected a list"
+                return value
+            return [ShapeValidator._check(spec[0], item, f"{path}[{i}]", errors) for i, item in enumerate(value)]
+        if spec is bool:
+            if isinstance(value, str) and value.lower() in ("true", "false"):
+                return value.lower() == "true"
+            if not isinstance(value, bool):
+                errors[path] = "expected a boolean"
+            return value
+        if spec in (int, float):
+            if isinstance(value, str):
+                try:
+                    value = float(value) if spec is float else int(value)
+                except ValueError:
+                    pass
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors[path] = "expected a number"
+            return value
+        if spec is str:
+            if isinstance(value, (dict, list)) or value is None:
+                errors[path] = "expected a string"
+                return value
+            return value if isinstance(value, str) else json.dumps(value)
+        if not isinstance(value, spec):
+            errors[path] = f"expected {spec.__name__}"
+        return value
+
+    def _validate(self, data: dict, prefix: str, errors: Dict[str, str]) -> dict:
+        validated = dict(data)
+        for key, spec in self.fields.items():
+            if key not in data:
+                if spec is not None:
+                    errors[prefix + key] = "missing"
+                continue
+            validated[key] = self._check(spec, data[key], prefix + key, errors)
+        return validated
+
+    def validate(self, data) -> dict:
+        """
+        Validate parsed data, coercing the values that can be (e.g. `"true"` to `true`).
+        Raises `ShapeError` with the failing fields.
+        """
+        if not isinstance(data, dict):
+            raise ShapeError("The reply is not a JSON object", {"": "expected an object"})
+        errors = {}
+        validated = self._validate(data, "", errors)
+        if errors:
+            raise ShapeError(f"The reply doesn't match the response shape: {errors}", errors, validated)
+        return validated
+
+    def parse(self, text: str) -> dict:
+        """
+        Parse (repairing it if needed) and validate a reply.
+        """
+        try:
+            data = loads(text)
+        except ValueError as e:
+            raise ShapeError(f"The reply is not valid JSON: {e}")
+        return self.validate(data)
+
+    def sub_shape(self, fields: List[str]) -> dict:
+        """
+        The part of the shape with the given top level fields (nested paths are
+        reduced to their top level field).
+        """
+        keys = {re.split(r'[.\[]', field, 1)[0] for field in fields}
+        return {key: value for key, value in self.shape.items() if key in keys}
+
+@functools.lru_cache(maxsize = 1024)
+def _compile_shape(canonical: str) -> Optional[ShapeValidator]:
+    try:
+        shape = loads(canonical)
+    except ValueError:
+        return None
+    # The shape is sometimes stored as a JSON encoded string.
+    if isinstance(shape, str):
+        return _compile_shape(shape)
+    return ShapeValidator(shape) if isinstance(shape, dict) else None
+
+def compile_shape(shape: Union[str, dict, None]) -> Optional[ShapeValidator]:
+    """
+    Get the (cached) validator of a response shape, None if the shape is not a JSON
+    object (e.g. a free text description), in which case replies aren't validated.
+    """
+    if not shape:
+        return None
+    if not isinstance(shape, str):
+        shape = json.dumps(shape, sort_keys = True)
+    return _compile_shape(shape)
+
+########################################
+# Streaming
+########################################
+_SPECIAL = {False: re.compile(r'[{}\[\]"]'), True: re.compile(r'["\\]')}
+
+class IncrementalJSONParser:
+    """
+    Follows a JSON reply while it is streamed: each delta is scanned once, so the end of
+    the object is known as soon as it arrives (`done`) without parsing the whole text
+    on every delta. `partial` gives a best effort parse of the reply so far.
+    """
+    def __init__(self) -> None:
+        self._chunks: List[str] = []
+        self._length = 0
+        self._start: Optional[int] = None
+        self._end: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    @property
+    def done(self) -> bool:
+        return self._end is not None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def feed(self, delta: str):
+        offset = self._length
+        self._chunks.append(delta)
+        self._length += len(delta)
+        if self.done:
+            return
+
+        pos = 0
+        if self._escaped and delta:
+            self._escaped = False
+            pos = 1
+        while True:
+            match = _SPECIAL[self._in_string].search(delta, pos)
+            if match is None:
+                return
+            char = match.group()
+            pos = match.end()
+            if self._in_string:
+                if char == "\\":
+                    if pos >= len(delta):
+                        self._escaped = True
+                        return
+                    pos += 1
+                else:
+                    self._in_string = False
+            elif self._start is None and char not in "{[":
+                # Prose before the object (e.g. a code fence), skip it.
+                continue
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._start is None:
+                    self._start = offset + match.start()
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end = offset + pos
+                    return
+
+    @property
+    def json_text(self) -> str:
+        """
+        The reply without the prose around the JSON (once its start was found).
+        """
+        text = self.text
+        return text if self._start is None else text[self._start:self._end]
+
+    def partial(self):
+        """
+        Best effort parse of the reply so far, None if there is nothing to parse yet.
+        """
+        if self._start is None:
+            return None
+        try:
+            return _decoder.decode(repair_json(self.json_text))
+        except ValueError:
+            return None
+
+    def result(self):
+        """
+        Parse the complete reply, repairing it if needed. Raises `ValueError`.
+        """
+        return loads(self.json_text)
@@ -1,51 +1,118 @@
+import json
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 
 API_URL = "http://0.0.0.0:8000/agents"  # We will use our local URL and port defined of our microservice for this example
 
+# NOTE: Streamlit reruns this script on every interaction. The lists of agents and
+# conversations are cached for a few seconds, and the messages of a conversation are
+# kept in the session state: only the ones newer than the last one seen are fetched.
+AGENTS_TTL = 60
+CONVERSATIONS_TTL = 30
+MESSAGES_TTL = 5
+# Messages shown when a conversation is opened, the older ones are loaded on demand.
+MESSAGES_PAGE_SIZE = 50
+# Seconds to connect to the API and to wait for its responses (the streamed ones
+# between two tokens).
+REQUEST_TIMEOUT = (5, 60)
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    HTTP session shared by the reruns and the users of the app, its connections to the
+    API are kept alive and reused instead of opening one per request
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = 32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+def api_get(path: str, **params):
+    """
+    Get a JSON response from the API. The `None` params are left out, the errors are
+    raised (so they are not cached)
+    """
+    response = get_http_session().get(API_URL + path, params = params, timeout = REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    return response.json()
+
+@st.cache_data(ttl = AGENTS_TTL, show_spinner = False)
 def get_agents():
     """
     Get the list of available agents from the API
     """
-    response = requests.get(API_URL + "/get-agents")
-    if response.status_code == 200:
-        agents = response.json()
-        return agents
-
-    return []
+    return api_get("/get-agents", include_conversations = False, limit = 1000)
 
+@st.cache_data(ttl = CONVERSATIONS_TTL, show_spinner = False)
 def get_conversations(agent_id: str):
     """
     Get the list of conversations for the agent with the given ID
     """
-    response = requests.get(API_URL + "/get-conversations", params = {"agent_id": agent_id})
-    if response.status_code == 200:
-        conversations = response.json()
-        return conversations
-
-    return []
+    return api_get("/get-conversations", agent_id = agent_id)
 
-def get_messages(conversation_id: str):
+@st.cache_data(ttl = MESSAGES_TTL, show_spinner = False)
+def get_messages(conversation_id: str, before: str = None, after: str = None, limit: int = None):
     """
-    Get the list of messages for the conversation with the given ID
+    Get messages of the conversation with the given ID, ordered by timestamp: the
+    `limit` most recent ones older than the message `before`, or the ones newer than
+    the message `after`
     """
-    response = requests.get(API_URL + "/get-messages", params = {"conversation_id": conversation_id})
-    if response.status_code == 200:
-        messages = response.json()
-        return messages
+    return api_get("/get-messages", conversation_id = conversation_id, before = before, after = after, limit = limit)
 
-    return []
-
-def send_message(agent_id, message):
+def load_messages(conversation_id: str) -> dict:
+    """
+    Get the messages of the conversation seen so far, kept in the session state between
+    reruns: the last page when the conversation is opened, then only the newer ones
+    """
+    key = f"messages:{conversation_id}"
+    state = st.session_state.get(key)
+    if state is None or not state["messages"]:
+        page = get_messages(conversation_id, limit = MESSAGES_PAGE_SIZE)
+        state = st.session_state[key] = {"messages": page, "has_older": len(page) == MESSAGES_PAGE_SIZE}
+    else:
+        # NOTE: Skip the messages already seen, in case a page overlaps the previous one.
+        seen = {mes["id"] for mes in state["messages"]}
+        state["messages"] += [
+            mes for mes in get_messages(conversation_id, after = state["messages"][-1]["id"]) if mes["id"] not in seen
+        ]
+
+    return state
+
+def load_older_messages(state: dict, conversation_id: str):
     """
-    Send a message to the agent with the given ID
+    Add the page of messages before the oldest one seen
     """
-    payload = {"conversation_id": agent_id, "message": message}
-    response = requests.post(API_URL + "/chat-agent", json = payload)
-    if response.status_code == 200:
-        return response.json()
+    older = get_messages(conversation_id, before = state["messages"][0]["id"], limit = MESSAGES_PAGE_SIZE)
+    state["messages"][:0] = older
+    state["has_older"] = len(older) == MESSAGES_PAGE_SIZE
 
-    return {"response": "Error"}
+def stream_message(conversation_id, message):
+    """
+    Send a message to the conversation with the given ID and yield the response
+    tokens as the agent generates them
+    """
+    payload = {"conversation_id": conversation_id, "message": message}
+    try:
+        with get_http_session().post(API_URL + "/chat-agent/stream", json = payload, stream = True, timeout = REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                yield "Error"
+                return
+
+            for line in response.iter_lines(decode_unicode = True):
+                # Server-Sent Events: the token deltas come in the `data` lines, the
+                # final `end` event repeats the full response so we stop there.
+                if line.startswith("event: end"):
+                    break
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: "):])["delta"]
+    finally:
+        # The conversation has a new message, the next rerun fetches it.
+        get_messages.clear()
 
 def main():
     st.set_page_config(page_title = "🤗💬 AIChat")
@@ -53,18 +120,29 @@ def main():
     with st.sidebar:
         st.title("Conversational Agent Chat")
 
+        if st.button("Refresh"):
+            st.cache_data.clear()
+            for key in [key for key in st.session_state if key.startswith("messages:")]:
+                del st.session_state[key]
+
+        try:
+            agents = get_agents()
+        except requests.RequestException as e:
+            st.error(f"The agents could not be loaded: {e}")
+            st.stop()
+
         # Dropdown to select agent
-        agents = get_agents()
         agent_ids = [agent["id"] for agent in agents]
         selected_agent = st.selectbox("Select an Agent:", agent_ids)
 
+        selected_agent_context = selected_agent_first_message = None
         for agent in agents:
             if agent["id"] == selected_agent:
                 selected_agent_context = agent["context"]
                 selected_agent_first_message = agent["first_message"]
 
         # Dropdown to select conversation
-        conversations = get_conversations(selected_agent)
+        conversations = get_conversations(selected_agent) if selected_agent else []
         conversation_ids = [conversation["id"] for conversation in conversations]
         selected_conversation = st.selectbox("Select a Conversation:", conversation_ids)
 
@@ -78,12 +156,22 @@ def main():
     st.title("Chat")
     st.write("This is a chat interface for the selected agent and conversation. You can send messages to the agent and see its responses.")
     st.write(f"**Agent Context**: {selected_agent_context}")
+    if selected_conversation is None:
+        return
+
+    try:
+        state = load_messages(selected_conversation)
+        if state["has_older"] and st.button("Load older messages"):
+            load_older_messages(state, selected_conversation)
+    except requests.RequestException as e:
+        st.error(f"The messages could not be loaded: {e}")
+        st.stop()
+
+    if not state["has_older"]:
+        with st.chat_message("assistant"):
+            st.write(selected_agent_first_message)
 
-    messages = get_messages(selected_conversation)
-    with st.chat_message("assistant"):
-        st.write(selected_agent_first_message)
-
-    for message in messages:
+    for message in state["messages"]:
         with st.chat_message("user"):
             st.write(message["user_message"])
         with st.chat_message("assistant"):
@@ -93,10 +181,13 @@ def main():
     if prompt := st.chat_input("Send a message:"):
         with st.chat_message("user"):
             st.write(prompt)
-        with st.spinner("Thinking..."):
-            response = send_message(selected_conversation, prompt)
-            with st.chat_message("assistant"):
-                st.write(response["response"])
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            response = ""
+            for delta in stream_message(selected_conversation, prompt):
+                response += delta
+                placeholder.markdown(response + "▌")
+            placeholder.markdown(response)
 
 if __name__ == "__main__":
     main()